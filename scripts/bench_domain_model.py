@@ -0,0 +1,63 @@
+"""
+Microbenchmark of the per-fill allocations and time of the match loop.
+
+"before" copies dict backed bets with copy.deepcopy as the match loop used to,
+"after" uses the slotted Bet with its explicit copy constructors.
+
+    python -m scripts.bench_domain_model [fills]
+"""
+import copy
+import sys
+import timeit
+import tracemalloc
+
+from src.domain_model import Bet
+
+
+class LegacyBet:
+    def __init__(self, event_id, sport, bet_id, brokerage_id, user_id, on_team_abbrev, amount=None, odds=None):
+        self.event_id = event_id
+        self.sport = sport
+        self.bet_id = bet_id
+        self.brokerage_id = brokerage_id
+        self.user_id = user_id
+        self.on_team_abbrev = on_team_abbrev
+        self.amount = amount
+        self.odds = odds
+
+
+def fill_before(bet, popped_bet):
+    tmp_bet_copy = copy.deepcopy(bet)
+    tmp_bet_copy.amount = 1.0
+    tmp_popped_bet_copy = copy.deepcopy(popped_bet)
+    tmp_popped_bet_copy.amount = 2.0
+    return tmp_bet_copy, tmp_popped_bet_copy
+
+
+def fill_after(bet, popped_bet):
+    return bet.with_amount(amount=1.0), popped_bet.with_amount(amount=2.0)
+
+
+def measure(name, fill, bet_cls, fills):
+    bet = bet_cls("202012060kan", "football", 1, 1, 1, "KAN", 20.0, 200)
+    popped_bet = bet_cls("202012060kan", "football", 2, 1, 1, "DEN", 10.0, -200)
+
+    seconds = timeit.timeit(lambda: fill(bet, popped_bet), number=fills)
+
+    tracemalloc.start()
+    kept = [fill(bet, popped_bet) for _ in range(1000)]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+
+    print(f"{name:<7} {seconds / fills * 1e6:8.3f} us/fill {current / 1000:8.1f} bytes/fill")
+
+
+def main():
+    fills = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    measure("before", fill_before, LegacyBet, fills)
+    measure("after", fill_after, Bet, fills)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Throughput benchmark of BetExecutor.handle_record on seeded synthetic order flow.
+
+Runs offline against MockRedis and MockKinesis, or against fakeredis for the
+lua engine. It reports records/sec, handle_record latency percentiles per
+action, redis round trips and commands per record, and output records per
+input record. Every run is appended to --results together with the commit and
+the run parameters, and compared with the last stored run that used the same
+parameters.
+
+    python -m scripts.bench_executor [--engine redis] [--seed 0] [--events 10] [--records 10000] ...
+"""
+import argparse
+import subprocess
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from json import dumps, loads
+from pathlib import Path
+
+from scripts.order_flow import OrderFlow
+from src import codec
+from src.bet_executer import BetExecutor
+from src.instrumentation import InstrumentedRedis
+from src.logger import LoggerFactory
+from src.metrics import Metrics
+from src.mock_kinesis import MockKinesis
+from src.mock_redis import MockRedis
+
+
+def percentile(values: list, q: float) -> float:
+    return values[min(int(q * len(values)), len(values) - 1)] if values else 0.0
+
+
+def redis_client_for(engine: str):
+    if engine == "lua":
+        import fakeredis
+        return fakeredis.FakeStrictRedis()
+    return MockRedis()
+
+
+def run(args) -> map:
+    flow = OrderFlow(
+        seed=args.seed,
+        events=args.events,
+        records=args.records,
+        depth=args.depth,
+        spread=args.spread,
+        mix=tuple(args.mix),
+        mean_amount=args.mean_amount
+    )
+    records = flow.generate()
+    redis_client = redis_client_for(args.engine)
+    flow.set_statuses(redis_client=redis_client)
+    metrics = Metrics()
+    kinesis_client = MockKinesis()
+    bet_executor = BetExecutor(
+        logger=LoggerFactory().get_logger(name=__name__, log_level="WARNING"),
+        redis_client=InstrumentedRedis(client=redis_client, metrics=metrics),
+        kinesis_client=kinesis_client,
+        output_stream_name="bench",
+        engine=args.engine,
+        member_encoding=args.member_encoding
+    )
+
+    latencies = defaultdict(list)
+    started = time.perf_counter()
+    for record in records:
+        action = codec.loads(record["Data"])["action"]
+        record_started = time.perf_counter()
+        bet_executor.handle_record(record=record)
+        latencies[action].append(time.perf_counter() - record_started)
+    elapsed = time.perf_counter() - started
+    counters, _, _ = metrics.snapshot()
+
+    return {
+        "records": len(records),
+        "seconds": round(elapsed, 4),
+        "records_per_sec": round(len(records) / elapsed, 1),
+        "round_trips_per_record": round(counters[("redis_round_trips", ())] / len(records), 3),
+        "commands_per_record": round(counters[("redis_commands", ())] / len(records), 3),
+        "outputs_per_record": round(len(kinesis_client.streams.get("bench", [])) / len(records), 3),
+        "latency_us": {
+            action: {
+                "count": len(values),
+                "p50": round(percentile(sorted(values), 0.5) * 1e6, 1),
+                "p99": round(percentile(sorted(values), 0.99) * 1e6, 1),
+                "p999": round(percentile(sorted(values), 0.999) * 1e6, 1)
+            }
+            for action, values in sorted(latencies.items())
+        }
+    }
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def previous_result(path: Path, params: map) -> map:
+    if not path.exists():
+        return None
+    previous = None
+    for line in path.read_text().splitlines():
+        result = loads(line)
+        if result["params"] == params:
+            previous = result
+    return previous
+
+
+def report(result: map, previous: map):
+    metrics = result["metrics"]
+    print(f"commit {result['commit']} engine {result['params']['engine']} seed {result['params']['seed']}")
+    for name in ("records_per_sec", "round_trips_per_record", "commands_per_record", "outputs_per_record"):
+        line = f"  {name:<24} {metrics[name]:>12}"
+        if previous is not None:
+            before = previous["metrics"][name]
+            line += f"   was {before} at {previous['commit']}" + (f" ({(metrics[name] - before) / before:+.1%})" if before else "")
+        print(line)
+    print(f"  {'latency us':<24} {'count':>8} {'p50':>10} {'p99':>10} {'p999':>10}")
+    for action, latency in metrics["latency_us"].items():
+        print(f"  {action:<24} {latency['count']:>8} {latency['p50']:>10} {latency['p99']:>10} {latency['p999']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark BetExecutor on synthetic order flow")
+    parser.add_argument("--engine", default="redis", choices=["redis", "memory", "lua"])
+    parser.add_argument("--member-encoding", default="json", choices=["compact", "json"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--events", type=int, default=10)
+    parser.add_argument("--records", type=int, default=10000)
+    parser.add_argument("--depth", type=int, default=20, help="resting bets seeded per side of every book")
+    parser.add_argument("--spread", type=float, default=150, help="standard deviation of limit odds around the line")
+    parser.add_argument("--mix", type=float, nargs=3, default=[0.7, 0.2, 0.1], metavar=("LIMIT", "MARKET", "CANCEL"))
+    parser.add_argument("--mean-amount", type=float, default=25.0)
+    parser.add_argument("--results", default="bench_results/executor.jsonl", help="file runs are appended to, empty to not store")
+    args = parser.parse_args()
+
+    params = {name: value for name, value in vars(args).items() if name != "results"}
+    result = {
+        "commit": current_commit(),
+        "time": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "params": params,
+        "metrics": run(args)
+    }
+    path = Path(args.results) if args.results else None
+    report(result=result, previous=previous_result(path, params) if path else None)
+    if path:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("a") as f:
+            f.write(dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
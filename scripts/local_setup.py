@@ -1,11 +1,15 @@
+import os
 import subprocess
 
+# more than one shard needs EVENT_LEASE_TTL_MS and MATCHING_ENGINE=lua set on every task
+INCOMING_SHARD_COUNT = os.environ.get("INCOMING_SHARD_COUNT", "1")
+
 
 cmd = """
 awslocal kinesis create-stream \
     --stream-name bexh-incoming \
-    --shard-count 1
-"""
+    --shard-count {}
+""".format(INCOMING_SHARD_COUNT)
 try:
     print(cmd)
     print(subprocess.getoutput(cmd))
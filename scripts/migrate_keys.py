@@ -0,0 +1,127 @@
+"""
+Moves the keys of every event from one key layout to the other, e.g. onto
+a new redis with the hash tagged layout, ready for a redis cluster once the
+runtime supports one:
+
+    python -m scripts.migrate_keys --source redis://old:6379/0 --target redis://new:6379/0 --to hash-tagged
+
+Keys are copied with DUMP and RESTORE, keeping their ttl, and deleted from the
+source once restored unless --keep is given. Keys already in the target
+layout are left alone, so the script can be run again after an interruption.
+Executors must be stopped while it runs, and whatever writes the
+event:{event_id} statuses has to switch to the new layout at the same time.
+
+The price levels and bet index of every queue in the target are then
+rebuilt from its members. Books written before the levels were kept need the
+levels before their first pop, and books written before the index need it
+for their bets to be cancelled without LEGACY_CANCEL_SCAN=true. Running with
+--to legacy against the old redis only rebuilds them.
+"""
+import argparse
+
+from redis import StrictRedis
+
+from src import keys
+from src.exchange import Exchange
+
+
+def migrate(source, target, to_layout: str, batch_size: int = 500, keep: bool = False, dry_run: bool = False) -> map:
+    """
+    :return: number of keys moved by prefix
+    """
+    moved = {}
+    for prefix in keys.EVENT_KEY_PREFIXES:
+        batch = []
+        for key in source.scan_iter(match=f"{prefix}:*", count=batch_size):
+            key = key.decode("utf-8") if isinstance(key, bytes) else key
+            _, event_id, team_abbrev = keys.parse_event_key(key)
+            new_key = keys.event_key(prefix, event_id, team_abbrev, layout=to_layout)
+            if new_key == key:
+                continue
+            batch.append((key, new_key))
+            if len(batch) >= batch_size:
+                moved[prefix] = moved.get(prefix, 0) + _move(source, target, batch, keep=keep, dry_run=dry_run)
+                batch = []
+        if batch:
+            moved[prefix] = moved.get(prefix, 0) + _move(source, target, batch, keep=keep, dry_run=dry_run)
+    return moved
+
+
+def _move(source, target, batch: [(str, str)], keep: bool, dry_run: bool) -> int:
+    pipe = source.pipeline(transaction=False)
+    for key, _ in batch:
+        pipe.dump(key)
+        pipe.pttl(key)
+    results = pipe.execute()
+    restored = []
+    # the keys of a batch hash to many slots, so they are restored one by one
+    for (key, new_key), data, ttl_ms in zip(batch, results[::2], results[1::2]):
+        if data is None:
+            # deleted since the scan
+            continue
+        if not dry_run:
+            target.restore(new_key, max(ttl_ms, 0), data, replace=True)
+        restored.append(key)
+    if restored and not keep and not dry_run:
+        pipe = source.pipeline(transaction=False)
+        for key in restored:
+            pipe.delete(key)
+        pipe.execute()
+    return len(restored)
+
+
+def rebuild_levels(client, batch_size: int = 500) -> int:
+    """
+    Keys are read in the current key layout, queues in the other one are skipped.
+
+    :return: number of queues whose levels were rebuilt
+    """
+    exchange = Exchange(redis_client=client)
+    return _rebuild_queues(client=client, rebuild=exchange.rebuild_levels, batch_size=batch_size)
+
+
+def rebuild_indexes(client, batch_size: int = 500) -> int:
+    """
+    Keys are read in the current key layout, queues in the other one are skipped.
+
+    :return: number of queues whose bet index was rebuilt
+    """
+    exchange = Exchange(redis_client=client)
+    return _rebuild_queues(client=client, rebuild=exchange.rebuild_index, batch_size=batch_size)
+
+
+def _rebuild_queues(client, rebuild, batch_size: int) -> int:
+    rebuilt = 0
+    for key in client.scan_iter(match="pq:*", count=batch_size):
+        key = key.decode("utf-8") if isinstance(key, bytes) else key
+        _, event_id, team_abbrev = keys.parse_event_key(key)
+        if Exchange.queue_name(event_id, team_abbrev) != key:
+            continue
+        rebuild(event_id=event_id, team_abbrev=team_abbrev)
+        rebuilt += 1
+    return rebuilt
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move the redis keys of every event to another key layout")
+    parser.add_argument("--source", required=True, help="redis url to read the keys from")
+    parser.add_argument("--target", help="redis url to write the keys to, the source when not given")
+    parser.add_argument("--to", default=keys.HASH_TAGGED, choices=[keys.LEGACY, keys.HASH_TAGGED])
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--keep", action="store_true", help="leave the source keys in place")
+    parser.add_argument("--dry-run", action="store_true", help="only count the keys that would move")
+    args = parser.parse_args()
+
+    source = StrictRedis.from_url(args.source)
+    target = source if args.target is None else StrictRedis.from_url(args.target)
+    moved = migrate(source=source, target=target, to_layout=args.to, batch_size=args.batch_size, keep=args.keep, dry_run=args.dry_run)
+    for prefix in keys.EVENT_KEY_PREFIXES:
+        print(f"{prefix}: {moved.get(prefix, 0)}")
+    if not args.dry_run:
+        keys.set_layout(args.to)
+        print(f"levels rebuilt: {rebuild_levels(client=target, batch_size=args.batch_size)}")
+        print(f"indexes rebuilt: {rebuild_indexes(client=target, batch_size=args.batch_size)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""
+Seeded synthetic order flow for the executor benchmarks.
+
+Every event gets a betting line. Both teams' odds are quoted on the same
+scale, and a home bet crosses away bets whose odds are at or above its own.
+Limit odds are spread around the line, so the spread sets how often a new bet
+crosses the book. Each book is seeded with depth resting bets per side, with
+home bets above the line and away bets below it, so the seed bets rest. The
+flow that follows mixes limit, market and cancel records by weight. Cancels target a
+random bet that was submitted earlier on the event, which may already have been
+filled. Every event can end with an INACTIVE_EVENT.
+
+Writes a flow for scripts.replay as record data per line plus event statuses:
+
+    python -m scripts.order_flow flow.jsonl statuses.jsonl [--seed 0] [--events 10] [--records 10000]
+"""
+import argparse
+import random
+from datetime import datetime, timedelta, timezone
+from json import dumps, loads
+
+from src.domain_model import StatusDetails
+from src.exchange import Exchange
+
+TEAMS = [
+    ("DEN", "Denver Broncos"), ("KAN", "Kansas City Chiefs"), ("BUF", "Buffalo Bills"), ("MIA", "Miami Dolphins"),
+    ("NWE", "New England Patriots"), ("NYJ", "New York Jets"), ("BAL", "Baltimore Ravens"), ("PIT", "Pittsburgh Steelers")
+]
+
+
+class OrderFlow:
+    def __init__(
+        self,
+        seed: int = 0,
+        events: int = 10,
+        records: int = 10000,
+        depth: int = 20,
+        spread: float = 150,
+        mix: (float, float, float) = (0.7, 0.2, 0.1),
+        mean_amount: float = 25.0,
+        inactive: bool = True
+    ):
+        """
+        :param spread: standard deviation of limit odds around the line
+        :param mix: weights of limit, market and cancel records
+        :param mean_amount: mean bet amount, amounts are log-normal
+        """
+        self._random = random.Random(seed)
+        self._events = events
+        self._records = records
+        self._depth = depth
+        self._spread = spread
+        self._mix = mix
+        self._mean_amount = mean_amount
+        self._inactive = inactive
+        self._start = datetime(2020, 12, 6, 18, 0, tzinfo=timezone.utc)
+        self._sequence_number = 0
+        self._bet_id = 0
+        self.events = [self._new_event(i) for i in range(events)]
+
+    def set_statuses(self, redis_client):
+        for event_id, status_details in self.statuses():
+            redis_client.set(name=Exchange.status_name(event_id), value=str(status_details))
+
+    def statuses(self) -> [(str, StatusDetails)]:
+        return [
+            (event["event_id"], StatusDetails(status="ACTIVE", home_team_abbrev=event["home"][0], away_team_abbrev=event["away"][0]))
+            for event in self.events
+        ]
+
+    def generate(self) -> [map]:
+        records = []
+        for event in self.events:
+            for _ in range(self._depth):
+                records.append(self._limit_bet(event=event, is_home=True, resting=True))
+                records.append(self._limit_bet(event=event, is_home=False, resting=True))
+        for _ in range(self._records):
+            event = self._random.choice(self.events)
+            action = self._random.choices(("limit", "market", "cancel"), weights=self._mix)[0]
+            if action == "cancel" and event["bets"]:
+                records.append(self._cancel_bet(event=event))
+            elif action == "market":
+                records.append(self._market_bet(event=event, is_home=self._random.random() < 0.5))
+            else:
+                records.append(self._limit_bet(event=event, is_home=self._random.random() < 0.5, resting=False))
+        if self._inactive:
+            records.extend(self._inactive_event(event=event) for event in self.events)
+        return records
+
+    def _new_event(self, i: int) -> map:
+        home, away = self._random.sample(TEAMS, 2)
+        return {
+            "event_id": f"2020{i:08d}{home[0].lower()}",
+            "home": home,
+            "away": away,
+            "line": self._random.choice((-1, 1)) * self._random.randint(100, 300),
+            "bets": []
+        }
+
+    def _record(self, action: str, value: map) -> map:
+        self._sequence_number += 1
+        data = {"action": action, "timestamp": self._start.strftime("%Y-%m-%dT%H:%M:%SZ"), "value": value}
+        return {
+            "SequenceNumber": str(self._sequence_number),
+            "ApproximateArrivalTimestamp": self._start + timedelta(milliseconds=self._sequence_number),
+            "Data": dumps(data).encode("utf-8"),
+            "PartitionKey": value["event_id"]
+        }
+
+    def _bet_value(self, event: map, is_home: bool, order_type: str) -> map:
+        self._bet_id += 1
+        return {
+            "event_id": event["event_id"],
+            "sport": "football",
+            "bet_id": self._bet_id,
+            "brokerage_id": self._random.randint(1, 5),
+            "user_id": self._random.randint(1, 1000),
+            "amount": round(self._random.lognormvariate(0, 0.75) * self._mean_amount / 1.3248, 2) or 0.01,
+            "order_type": order_type,
+            "on_team_abbrev": event["home" if is_home else "away"][0]
+        }
+
+    def _limit_bet(self, event: map, is_home: bool, resting: bool) -> map:
+        value = self._bet_value(event=event, is_home=is_home, order_type="limit")
+        # seed bets sit on the side of the line that does not cross
+        offset = abs(self._random.gauss(0, self._spread)) if resting else self._random.gauss(0, self._spread)
+        value["odds"] = self._american_odds(event["line"] + offset if is_home else event["line"] - offset)
+        event["bets"].append(value)
+        return self._record(action="NEW_LIMIT_BET", value=value)
+
+    def _market_bet(self, event: map, is_home: bool) -> map:
+        return self._record(action="NEW_MARKET_BET", value=self._bet_value(event=event, is_home=is_home, order_type="market"))
+
+    def _cancel_bet(self, event: map) -> map:
+        bet = event["bets"].pop(self._random.randrange(len(event["bets"])))
+        return self._record(action="CANCEL_BET", value={
+            "event_id": bet["event_id"],
+            "sport": bet["sport"],
+            "bet_id": bet["bet_id"],
+            "brokerage_id": bet["brokerage_id"],
+            "user_id": bet["user_id"],
+            "odds": bet["odds"],
+            "on_team_abbrev": bet["on_team_abbrev"]
+        })
+
+    def _inactive_event(self, event: map) -> map:
+        return self._record(action="INACTIVE_EVENT", value={
+            "event_id": event["event_id"],
+            "sport": "football",
+            "home_team_abbrev": event["home"][0],
+            "away_team_abbrev": event["away"][0],
+            "home_team_name": event["home"][1],
+            "away_team_name": event["away"][1],
+            "home_team_score": 24,
+            "away_team_score": 21,
+            "winning_team_abbrev": event["home"][0],
+            "losing_team_abbrev": event["away"][0],
+            "date": self._start.strftime("%Y-%m-%dT%H:%M:%SZ")
+        })
+
+    @staticmethod
+    def _american_odds(odds: float) -> int:
+        odds = int(round(odds / 5) * 5)
+        if -100 < odds < 100:
+            return 100 if odds >= 0 else -100
+        return odds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write seeded synthetic order flow")
+    parser.add_argument("records_path")
+    parser.add_argument("statuses_path")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--events", type=int, default=10)
+    parser.add_argument("--records", type=int, default=10000)
+    args = parser.parse_args()
+
+    flow = OrderFlow(seed=args.seed, events=args.events, records=args.records)
+    with open(args.records_path, "wb") as f:
+        for record in flow.generate():
+            f.write(record["Data"] + b"\n")
+    with open(args.statuses_path, "w") as f:
+        for event_id, status_details in flow.statuses():
+            f.write(dumps({"event_id": event_id, **loads(str(status_details))}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Replays recorded input records through BetExecutor offline, as fast as it can.
+
+Runs against MockRedis and MockKinesis, or fakeredis for the lua engine, so
+no Kinesis, DynamoDB or redis server is needed. Records are read from
+
+- jsonl: one record per line, either a kinesis record whose Data is base64
+  encoded as `aws kinesis get-records` prints it, or the record data itself
+- length-prefixed: the record data of each record after its length as a
+  4 byte big endian integer
+
+Event statuses are read from a jsonl file of {"event_id", "status",
+"home_team_abbrev", "away_team_abbrev"}. The clock is frozen at --clock, so
+the outputs of two runs over the same records are byte for byte the same
+when the engines agree:
+
+    python -m scripts.replay records.jsonl --statuses statuses.jsonl --engine memory --out memory.jsonl
+    python -m scripts.replay records.jsonl --statuses statuses.jsonl --engine lua --out lua.jsonl
+    cmp memory.jsonl lua.jsonl
+"""
+import argparse
+import cProfile
+import pstats
+import time
+from base64 import b64decode
+from datetime import datetime
+from json import dumps, loads
+
+from src import codec, utils
+from src.bet_executer import BetExecutor
+from src.domain_model import StatusDetails
+from src.exchange import Exchange
+from src.logger import LoggerFactory
+from src.member_codec import decode_member
+from src.mock_kinesis import MockKinesis
+from src.mock_redis import MockRedis
+
+OUTPUT_STREAM_NAME = "replay"
+
+
+def read_records(path: str, record_format: str):
+    with open(path, "rb") as f:
+        if record_format == "length-prefixed":
+            while True:
+                header = f.read(4)
+                if len(header) < 4:
+                    return
+                yield {"Data": f.read(int.from_bytes(header, "big"))}
+        else:
+            for line in f:
+                if not line.strip():
+                    continue
+                value = loads(line)
+                if "Data" in value:
+                    yield {**value, "Data": b64decode(value["Data"])}
+                else:
+                    yield {"Data": line.rstrip(b"\n")}
+
+
+def read_statuses(path: str) -> [(str, StatusDetails)]:
+    statuses = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                value = loads(line)
+                event_id = value.pop("event_id")
+                statuses.append((event_id, StatusDetails(**value)))
+    return statuses
+
+
+def redis_client_for(engine: str):
+    if engine == "lua":
+        import fakeredis
+        return fakeredis.FakeStrictRedis()
+    return MockRedis()
+
+
+def replay(args) -> map:
+    utils.set_clock(lambda: datetime.strptime(args.clock, "%Y-%m-%dT%H:%M:%SZ"))
+    redis_client = redis_client_for(args.engine)
+    statuses = read_statuses(args.statuses)
+    for event_id, status_details in statuses:
+        redis_client.set(name=Exchange.status_name(event_id), value=str(status_details))
+    kinesis_client = MockKinesis()
+    bet_executor = BetExecutor(
+        logger=LoggerFactory().get_logger(name=__name__, log_level="WARNING"),
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        output_stream_name=OUTPUT_STREAM_NAME,
+        engine=args.engine,
+        member_encoding=args.member_encoding
+    )
+
+    profile = cProfile.Profile() if args.profile else None
+    records = 0
+    handle_seconds = 0.0
+    started = time.perf_counter()
+    for record in read_records(path=args.records, record_format=args.format):
+        record_started = time.perf_counter()
+        if profile is not None:
+            profile.enable()
+        bet_executor.handle_record(record=record)
+        if profile is not None:
+            profile.disable()
+        handle_seconds += time.perf_counter() - record_started
+        records += 1
+    elapsed = time.perf_counter() - started
+    utils.set_clock()
+
+    outputs = kinesis_client.streams.get(OUTPUT_STREAM_NAME, [])
+    with open(args.out, "wb") as f:
+        for data in outputs:
+            f.write(data + b"\n")
+    if args.books:
+        write_books(path=args.books, redis_client=redis_client, statuses=statuses)
+    if profile is not None:
+        profile.dump_stats(args.profile)
+        pstats.Stats(profile).sort_stats("cumulative").print_stats(args.profile_lines)
+
+    return {
+        "records": records,
+        "outputs": len(outputs),
+        "seconds": round(elapsed, 4),
+        "records_per_sec": round(records / elapsed, 1) if elapsed else 0.0,
+        "handle_record_us": round(handle_seconds / records * 1e6, 1) if records else 0.0
+    }
+
+
+def write_books(path: str, redis_client, statuses: [(str, StatusDetails)]):
+    """
+    Writes the bets resting on every book decoded, so books written with
+    different member encodings compare equal.
+    """
+    with open(path, "w") as f:
+        for event_id, status_details in statuses:
+            for team_abbrev in (status_details.home_team_abbrev, status_details.away_team_abbrev):
+                items = redis_client.zrange(name=Exchange.queue_name(event_id, team_abbrev), start=0, end=-1, withscores=True)
+                bets = [codec.loads(str(decode_member(data=data, event_id=event_id, team_abbrev=team_abbrev, score=score))) for data, score in items]
+                f.write(dumps({"event_id": event_id, "team_abbrev": team_abbrev, "bets": bets}) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded records through BetExecutor offline")
+    parser.add_argument("records", help="file of recorded input records")
+    parser.add_argument("--format", default="jsonl", choices=["jsonl", "length-prefixed"])
+    parser.add_argument("--statuses", required=True, help="jsonl file of event statuses to start from")
+    parser.add_argument("--engine", default="memory", choices=["redis", "memory", "lua"])
+    parser.add_argument("--member-encoding", default="json", choices=["compact", "json"])
+    parser.add_argument("--out", required=True, help="file the output records are written to, one per line")
+    parser.add_argument("--books", help="file the final books are written to")
+    parser.add_argument("--clock", default="2020-12-06T18:00:00Z", help="frozen time of every output")
+    parser.add_argument("--profile", help="file to write cProfile stats of handle_record to")
+    parser.add_argument("--profile-lines", type=int, default=25)
+    args = parser.parse_args()
+
+    print(dumps(replay(args)))
+
+
+if __name__ == "__main__":
+    main()
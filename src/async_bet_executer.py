@@ -0,0 +1,184 @@
+import asyncio
+from contextvars import ContextVar
+
+from src.async_exchange import AsyncExchange
+from src.bet_executer import BetExecutor
+from src.member_codec import JSON
+from src.logger import Logger
+from src.event_leases import EventLeases
+from src.market_data import MarketDataPublisher
+from src.publisher import AsyncKinesisPublisher
+from src.status_cache import StatusCache
+from src.worker_pool import RecordTicket
+from src import codec
+
+# (exchange, publisher) of the record the current task handles
+_record_io = ContextVar("record_io")
+
+
+class AsyncBetExecutor(BetExecutor):
+    """
+    Runs the BetExecutor handlers on an async exchange and publisher.
+
+    Up to max_in_flight records are handled concurrently. Records of the same
+    event are chained so each one starts only after the previous one for that
+    event has finished.
+
+    Every record gets an exchange and publisher of its own, so the writes an
+    exchange defers and the records a publisher buffers all belong to one
+    record, and to the slot of its event on a cluster. asyncio gives each
+    task a copy of the context, so the handlers reach them as self._exchange
+    and self._publisher through a context variable.
+    """
+    def __init__(
+        self,
+        logger: Logger,
+        redis_client,
+        kinesis_client,
+        output_stream_name: str,
+        engine: str = "redis",
+        member_encoding: str = JSON,
+        status_cache: StatusCache = None,
+        max_in_flight: int = 100,
+        market_data: MarketDataPublisher = None,
+        replay_guard_ttl_seconds: float = None,
+        event_leases: EventLeases = None,
+        legacy_cancel_scan: bool = False
+    ):
+        """
+        :param redis_client: redis.asyncio client
+        :param engine: Engine = Literal["redis", "lua"]
+        """
+        if engine not in ("redis", "lua"):
+            raise ValueError(f"Engine {engine} can not run async")
+        super().__init__(
+            logger=logger,
+            redis_client=redis_client,
+            kinesis_client=kinesis_client,
+            output_stream_name=output_stream_name,
+            engine=engine,
+            member_encoding=member_encoding,
+            status_cache=status_cache,
+            market_data=market_data,
+            replay_guard_ttl_seconds=replay_guard_ttl_seconds,
+            event_leases=event_leases,
+            legacy_cancel_scan=legacy_cancel_scan
+        )
+        self._max_in_flight = max_in_flight
+        # created by the first submit, asyncio primitives bind to the loop they are created on before python 3.10
+        self._in_flight = None
+        # event_id -> task of the last record submitted for the event
+        self._event_tasks = {}
+        # the first record that failed, later submits raise it like the sync executor stops at it
+        self._failure = None
+
+    def _setup_io(
+        self,
+        redis_client,
+        kinesis_client,
+        output_stream_name: str,
+        member_encoding: str,
+        status_cache: StatusCache,
+        event_leases: EventLeases,
+        legacy_cancel_scan: bool
+    ):
+        # each record creates its own in _handle_after
+        self._redis_client = redis_client
+        self._member_encoding = member_encoding
+        self._legacy_cancel_scan = legacy_cancel_scan
+        self._status_cache = status_cache
+        self._kinesis_client = kinesis_client
+        self._output_stream_name = output_stream_name
+
+    @property
+    def _exchange(self) -> AsyncExchange:
+        return _record_io.get()[0]
+
+    @property
+    def _publisher(self) -> AsyncKinesisPublisher:
+        return _record_io.get()[1]
+
+    async def handle_record(self, record: map):
+        await (await self.submit(record=record))
+
+    async def submit(self, record: map, ticket: RecordTicket = None) -> asyncio.Task:
+        """
+        Starts handling a record once there is room in flight.
+
+        :param ticket: marked done once the record has been handled
+        :raises Exception: the error of the first record that failed
+        """
+        self.raise_failure()
+        if self._in_flight is None:
+            self._in_flight = asyncio.Semaphore(self._max_in_flight)
+        await self._in_flight.acquire()
+        data = codec.loads(record['Data'])
+        event_id = data["value"].get("event_id")
+        task = asyncio.ensure_future(self._handle_after(previous=self._event_tasks.get(event_id), data=data, ticket=ticket))
+        self._event_tasks[event_id] = task
+        task.add_done_callback(lambda done_task: self._finish(event_id=event_id, task=done_task))
+        return task
+
+    async def drain(self):
+        tasks = list(self._event_tasks.values())
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    def raise_failure(self):
+        """
+        Raises the error of the first record that failed, if any has.
+        """
+        if self._failure is not None:
+            raise self._failure
+
+    def _finish(self, event_id: str, task: asyncio.Task):
+        self._in_flight.release()
+        if self._failure is None and not task.cancelled() and task.exception() is not None:
+            self._failure = task.exception()
+        if self._event_tasks.get(event_id) is task:
+            del self._event_tasks[event_id]
+
+    async def _handle_after(self, previous: asyncio.Task, data: map, ticket: RecordTicket):
+        if previous is not None:
+            # a failed record may have left the book half written, so the event's chain stops with its error
+            await previous
+        _record_io.set((
+            AsyncExchange(
+                redis_client=self._redis_client,
+                member_encoding=self._member_encoding,
+                status_cache=self._status_cache,
+                event_leases=self._event_leases,
+                legacy_cancel_scan=self._legacy_cancel_scan
+            ),
+            AsyncKinesisPublisher(logger=self._logger, kinesis_client=self._kinesis_client, stream_name=self._output_stream_name)
+        ))
+        try:
+            await self._run_async(steps=self._handle(action=data["action"], value=data["value"]))
+        except Exception:
+            # the exchange only holds this record's mark
+            self._exchange.discard_handled()
+            raise
+        finally:
+            await self._flush_async(event_id=data["value"].get("event_id"))
+        if ticket is not None:
+            ticket.done = True
+
+    async def _flush_async(self, event_id: str):
+        try:
+            await self._exchange.flush()
+            await self._publisher.flush()
+        except Exception:
+            self._exchange.discard_handled()
+            raise
+        finally:
+            self._mark_book(event_id=event_id)
+        await self._exchange.flush_handled()
+
+    async def _run_async(self, steps):
+        result = None
+        while True:
+            try:
+                method, kwargs = steps.send(result)
+            except StopIteration:
+                return
+            result = await getattr(self._exchange, method)(**kwargs)
@@ -0,0 +1,150 @@
+import asyncio
+
+from redis.exceptions import WatchError
+
+from src.domain_model import Bet, PriceLevel, StatusDetails
+from src.event_leases import EventLeases, LeaseHeldError
+from src.exchange import Exchange
+from src.handled_records import HandledRecords
+from src.match_script import MATCH_SCRIPT
+from src.price_levels import PriceLevels
+from src.priority_queue import PriorityQueue
+
+
+class AsyncExchange(Exchange):
+    """
+    Exchange on a redis.asyncio client.
+
+    Commands and replies are built and decoded by the Exchange helpers so the
+    redis layout and round trips are the same as the sync exchange, only the
+    I/O is awaited.
+    """
+    async def submit_bet(self, bet: Bet):
+        await self.submit_bets(bets=[bet])
+
+    async def submit_bets(self, bets: [Bet]):
+        pipe = self._submit_pipeline(bets=bets)
+        if pipe is not None:
+            await pipe.execute()
+
+    async def pop_bets(self, event_id: str, team_abbrev: str, is_home_team: bool, count: int) -> [Bet]:
+        queue_name = self.queue_name(event_id, team_abbrev)
+        if is_home_team:
+            values = await self._pq.pop_min(queue_name=queue_name, count=count)
+        else:
+            values = await self._pq.pop_max(queue_name=queue_name, count=count)
+        return self._decode_popped(values=values, event_id=event_id, team_abbrev=team_abbrev)
+
+    async def peek_bets(self, event_id: str, team_abbrev: str, is_home_team: bool, start: int, count: int) -> [Bet]:
+        queue_name = self.queue_name(event_id, team_abbrev)
+        if is_home_team:
+            values = await self._pq.peek_min(queue_name=queue_name, start=start, count=count)
+        else:
+            values = await self._pq.peek_max(queue_name=queue_name, start=start, count=count)
+        return self._decode_peeked(values=values, event_id=event_id, team_abbrev=team_abbrev)
+
+    async def pop_bet(self, event_id: str, team_abbrev: str, is_home_team: bool) -> Bet:
+        return next(iter(await self.pop_bets(event_id=event_id, team_abbrev=team_abbrev, is_home_team=is_home_team, count=1)), None)
+
+    async def purge_bets(self, event_id: str, home_team_abbrev: str, away_team_abbrev: str) -> [Bet]:
+        pipe = self._purge_pipeline(
+            event_id=event_id,
+            home_team_abbrev=home_team_abbrev,
+            away_team_abbrev=away_team_abbrev,
+            pipe=await self._fenced_pipeline(event_id=event_id)
+        )
+        results = await self._execute_fenced(pipe=pipe, event_id=event_id)
+        return self._decode_purged(results=results, event_id=event_id, home_team_abbrev=home_team_abbrev, away_team_abbrev=away_team_abbrev)
+
+    async def get_status(self, event_id: str) -> StatusDetails:
+        status_details = self._cached_status(event_id=event_id)
+        if status_details is not None:
+            return status_details
+        return self._decode_status(event_id=event_id, res=await self._r.get(name=self.status_name(event_id)))
+
+    async def remove_bet(self, bet: Bet) -> Bet:
+        queue_name = self.queue_name(bet.event_id, bet.on_team_abbrev)
+        index_name = self.index_name(bet.event_id, bet.on_team_abbrev)
+        data = await self._index.get_member(index_name=index_name, bet_id=self.index_field(bet))
+        if data is None and self._legacy_cancel_scan:
+            # bets submitted before the index existed are only found by score
+            values = await self._pq.get_items_in_range(queue_name=queue_name, min_score=bet.odds, max_score=bet.odds)
+            data = self._member_with_bet_id(values=values, bet=bet)
+        if data is None:
+            return None
+        pipe = self._remove_pipeline(bet=bet, data=data, pipe=await self._fenced_pipeline(event_id=bet.event_id))
+        return self._decode_removed(bet=bet, data=data, results=await self._execute_fenced(pipe=pipe, event_id=bet.event_id))
+
+    async def _fenced_pipeline(self, event_id: str):
+        pipe = self._r.pipeline(transaction=True)
+        if self._event_leases is None:
+            return pipe
+        lease_name = EventLeases.lease_name(event_id)
+        await pipe.watch(lease_name)
+        if not self._holds_lease(event_id=event_id, held=await pipe.get(lease_name)):
+            await pipe.reset()
+            raise self._lease_lost(event_id=event_id)
+        pipe.multi()
+        return pipe
+
+    async def _execute_fenced(self, pipe, event_id: str) -> list:
+        try:
+            return await pipe.execute()
+        except WatchError:
+            raise self._lease_lost(event_id=event_id)
+
+    async def match_bet(self, bet: Bet, other_team_abbrev: str, other_is_home: bool, is_market: bool) -> (bool, list):
+        if self._match_script is None:
+            self._match_script = self._r.register_script(MATCH_SCRIPT)
+        return self._decode_fills(
+            res=await self._match_script(**self._match_script_call(bet=bet, other_team_abbrev=other_team_abbrev, other_is_home=other_is_home, is_market=is_market)),
+            bet=bet,
+            other_team_abbrev=other_team_abbrev
+        )
+
+    async def book_levels(self, event_id: str, team_abbrev: str, is_home_team: bool, depth: int = None) -> [PriceLevel]:
+        values = await PriceLevels(redis_client=self._r).get_all(levels_name=self.levels_name(event_id, team_abbrev))
+        return self._sorted_levels(values=values, is_home_team=is_home_team, depth=depth)
+
+    async def top_of_book(self, event_id: str, team_abbrev: str, is_home_team: bool) -> PriceLevel:
+        return next(iter(await self.book_levels(event_id=event_id, team_abbrev=team_abbrev, is_home_team=is_home_team, depth=1)), None)
+
+    async def rebuild_levels(self, event_id: str, team_abbrev: str):
+        async def rebuild(pipe):
+            items = await PriorityQueue(redis_client=pipe).get_all_items(queue_name=self.queue_name(event_id, team_abbrev))
+            self._write_rebuilt_levels(pipe=pipe, event_id=event_id, team_abbrev=team_abbrev, items=items)
+
+        await self._r.transaction(rebuild, self.queue_name(event_id, team_abbrev))
+
+    async def is_handled(self, event_id: str, key: str) -> bool:
+        return bool(await HandledRecords(redis_client=self._r).contains(handled_name=self.handled_name(event_id), key=key))
+
+    async def mark_handled(self, event_id: str, key: str, ttl_seconds: float):
+        super().mark_handled(event_id=event_id, key=key, ttl_seconds=ttl_seconds)
+
+    async def flush(self):
+        pipe = self._flush_pipeline()
+        if pipe is not None:
+            await pipe.execute()
+
+    async def flush_handled(self):
+        pipe = self._flush_handled_pipeline()
+        if pipe is not None:
+            await pipe.execute()
+
+    async def hold_lease(self, event_id: str) -> bool:
+        while True:
+            try:
+                # renewals are rare, so the sync leases run off the loop instead of having an async twin
+                is_new_lease = await asyncio.get_running_loop().run_in_executor(None, self._event_leases.hold, event_id)
+                break
+            except LeaseHeldError as e:
+                # only the records of this event wait, each event is its own chain of tasks
+                await asyncio.sleep(e.retry_in_ms / 1000)
+        if not is_new_lease:
+            return False
+        await self.evict_event(event_id=event_id)
+        return True
+
+    async def evict_event(self, event_id: str):
+        super().evict_event(event_id=event_id)
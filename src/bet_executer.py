@@ -1,85 +1,355 @@
+from time import monotonic
+
 from src.exchange import Exchange
+from src.order_book import InMemoryExchange
+from src.member_codec import JSON
 from src.logger import Logger
-from src.domain_model import Bet, CancelBet, InactiveEvent, LimitBet, MarketBet, ExecutedBet, ExecutedBets
-from json import loads
-import copy
+from src.market_data import MarketDataPublisher
+from src.publisher import KinesisPublisher
+from src.status_cache import StatusCache
+from src.sweep_planner import plan_sweep
+from src.domain_model import Bet, InactiveEvent, ExecutedBet, ExecutedBets
+from src.event_leases import EventLeases, LeaseHeldError
+from src import codec
 
 
 class BetExecutor:
-    def __init__(self, logger: Logger, redis_client, kinesis_client, output_stream_name: str):
-        self._exchange = Exchange(redis_client=redis_client)
+    """
+    Handlers are generators that yield the exchange calls they need as
+    (method name, kwargs) and get the result sent back, so the same matching
+    logic runs here against the sync exchange and in AsyncBetExecutor
+    against the async one.
+    """
+    # upper bound on how many resting bets a sweep pops in one round trip
+    MAX_POP_COUNT = 64
+    # how many resting bets a market bet's liquidity check reads first, doubled up to MAX_PEEK_COUNT
+    PEEK_COUNT = 16
+    # reads do not hold resting bets off the book, so deep books are planned in larger pages than they are popped
+    MAX_PEEK_COUNT = 1024
+    # prefix of a record's key in the replay guard, followed by its bet_id
+    REPLAY_KEY_PREFIXES = {"NEW_LIMIT_BET": "L", "NEW_MARKET_BET": "M", "CANCEL_BET": "C", "INACTIVE_EVENT": "I"}
+
+    def __init__(
+        self,
+        logger: Logger,
+        redis_client,
+        kinesis_client,
+        output_stream_name: str,
+        engine: str = "redis",
+        member_encoding: str = JSON,
+        status_cache: StatusCache = None,
+        market_data: MarketDataPublisher = None,
+        replay_guard_ttl_seconds: float = None,
+        event_leases: EventLeases = None,
+        legacy_cancel_scan: bool = False
+    ):
+        """
+        :param engine: Engine = Literal["redis", "memory", "lua"]
+        :param member_encoding: MemberEncoding = Literal["compact", "json"]
+        :param status_cache: event status cache shared with the exchange, none to always read redis
+        :param market_data: told about every event once its record is written back, none to not publish depth
+        :param replay_guard_ttl_seconds: how long handled records are remembered so replays are skipped, none to handle every record
+        :param event_leases: leases shared by the executors of this task, records of an event another task holds are parked when given
+        :param legacy_cancel_scan: cancels of bets missing from the index scan their odds, until scripts/migrate_keys.py has indexed every book
+        """
+        self._engine = engine
         self._logger = logger
-        self._kinesis_client = kinesis_client
-        self._output_stream_name = output_stream_name
+        self._setup_io(
+            redis_client=redis_client,
+            kinesis_client=kinesis_client,
+            output_stream_name=output_stream_name,
+            member_encoding=member_encoding,
+            status_cache=status_cache,
+            event_leases=event_leases,
+            legacy_cancel_scan=legacy_cancel_scan
+        )
+        self._market_data = market_data
+        self._replay_guard_ttl_seconds = replay_guard_ttl_seconds
+        # events that have had a record that was not a replay, so later records are new too
+        self._replay_checked_events = set()
+        self._event_leases = event_leases
+        # event_id -> (data, sequence number) of the records waiting for a lease another task holds, in arrival order
+        self._parked = {}
+        # event_id -> monotonic time the lease of its parked records is tried again
+        self._retry_parked_at = {}
+        self._parked_sequence_numbers = set()
+
+    def _setup_io(
+        self,
+        redis_client,
+        kinesis_client,
+        output_stream_name: str,
+        member_encoding: str,
+        status_cache: StatusCache,
+        event_leases: EventLeases,
+        legacy_cancel_scan: bool
+    ):
+        """
+        Creates the exchange and publisher every record goes through.
+        """
+        if self._engine == "memory":
+            # the in memory books are read whole, so every bet is found without the index
+            self._exchange = InMemoryExchange(redis_client=redis_client, member_encoding=member_encoding, status_cache=status_cache, event_leases=event_leases)
+        else:
+            self._exchange = Exchange(
+                redis_client=redis_client,
+                member_encoding=member_encoding,
+                status_cache=status_cache,
+                event_leases=event_leases,
+                legacy_cancel_scan=legacy_cancel_scan
+            )
+        self._publisher = KinesisPublisher(logger=self._logger, kinesis_client=kinesis_client, stream_name=output_stream_name)
 
     def handle_record(self, record: map):
-        data = loads(record['Data'].decode("utf-8"))
-        action = data["action"]
-        value = data["value"]
-
+        self._handle_data(data=codec.loads(record['Data']), sequence_number=record.get("SequenceNumber"))
+
+    def handle_data(self, data: map, sequence_number: str = None):
+        """
+        Handles a record whose Data was already decoded, e.g. to pick the worker it goes to.
+        """
+        self._handle_data(data=data, sequence_number=sequence_number)
+
+    def _handle_data(self, data: map, sequence_number: str = None):
+        self.retry_parked()
+        event_id = data["value"].get("event_id")
+        if event_id in self._parked:
+            self._park(event_id=event_id, records=[(data, sequence_number)])
+            return
+        try:
+            self._run(steps=self._handle(action=data["action"], value=data["value"]))
+        except LeaseHeldError as e:
+            self._park(event_id=event_id, records=[(data, sequence_number)], retry_in_ms=e.retry_in_ms)
+        except Exception:
+            self._unmark_handled(data=data)
+            raise
+        finally:
+            self._flush(event_id=event_id)
+
+    def handle_records(self, records: [map]):
+        """
+        Handles a batch of records grouped by event_id, in arrival order within
+        each event. Each group looks up the event status once and flushes the
+        exchange and publisher once.
+        """
+        self.retry_parked()
+        groups = {}
+        for record in records:
+            data = codec.loads(record['Data'])
+            groups.setdefault(data["value"].get("event_id"), []).append((data, record.get("SequenceNumber")))
+
+        for event_id, group in groups.items():
+            if event_id in self._parked:
+                self._park(event_id=event_id, records=group)
+                continue
+            self._handle_group(event_id=event_id, group=group)
+
+    def _handle_group(self, event_id: str, group: [(map, str)]):
+        """
+        Parks the rest of the group once the lease of the event turns out to be held by another task.
+        """
+        statuses = {}
+        try:
+            for i, (data, _) in enumerate(group):
+                try:
+                    self._handle_in_group(data=data, statuses=statuses)
+                except LeaseHeldError as e:
+                    self._park(event_id=event_id, records=group[i:], retry_in_ms=e.retry_in_ms)
+                    return
+                except Exception:
+                    self._unmark_handled(data=data)
+                    raise
+        finally:
+            self._flush(event_id=event_id)
+
+    def _unmark_handled(self, data: map):
+        """
+        A record that raised is not handled, even though what it wrote before
+        is flushed, so it is not skipped when replayed.
+        """
+        if self._replay_guard_ttl_seconds is not None:
+            self._exchange.unmark_handled(event_id=data["value"].get("event_id"), key=self._replay_key(action=data["action"], value=data["value"]))
+
+    def _handle_in_group(self, data: map, statuses: map):
+        self._run(steps=self._handle(action=data["action"], value=data["value"]), statuses=statuses)
+
+    def is_parked(self, sequence_number: str) -> bool:
+        """
+        :return: whether the record is waiting for the lease of its event, so it must not be checkpointed yet
+        """
+        return sequence_number in self._parked_sequence_numbers
+
+    @property
+    def has_parked(self) -> bool:
+        return bool(self._parked)
+
+    def retry_parked(self):
+        """
+        Handles the parked records of every event whose lease is due to be
+        tried again. Called before each record, and by idle consumer loops.
+        """
+        if not self._parked:
+            return
+        now = monotonic()
+        for event_id in [event_id for event_id, retry_at in self._retry_parked_at.items() if retry_at <= now]:
+            del self._retry_parked_at[event_id]
+            group = self._parked.pop(event_id)
+            self._parked_sequence_numbers.difference_update(sequence_number for _, sequence_number in group)
+            self._handle_group(event_id=event_id, group=group)
+
+    def _park(self, event_id: str, records: [(map, str)], retry_in_ms: float = None):
+        """
+        :param retry_in_ms: when the lease is tried again, none to keep the time of the records already parked
+        """
+        if event_id not in self._parked:
+            self._logger.info("Parking records of an event leased by another task", event_id=event_id, retry_in_ms=retry_in_ms)
+        self._parked.setdefault(event_id, []).extend(records)
+        self._parked_sequence_numbers.update(sequence_number for _, sequence_number in records)
+        if retry_in_ms is not None:
+            self._retry_parked_at[event_id] = monotonic() + retry_in_ms / 1000
+
+    def _flush(self, event_id: str):
+        try:
+            # write any book changes held by the exchange back to redis
+            # before the executions go out
+            self._exchange.flush()
+            self._publisher.flush()
+        except Exception:
+            self._exchange.discard_handled()
+            raise
+        finally:
+            self._mark_book(event_id=event_id)
+        # records are only marked handled once their executions are out, so
+        # a record whose publish failed is handled again when it is replayed
+        self._exchange.flush_handled()
+
+    def _mark_book(self, event_id: str):
+        if self._market_data is not None:
+            self._market_data.mark(event_id=event_id)
+
+    def _run(self, steps, statuses: map = None):
+        """
+        Drives a handler against the exchange, sending each call's result back in.
+
+        :param statuses: get_status results by event_id to reuse, dropped when the event is evicted
+        """
+        result = None
+        while True:
+            try:
+                method, kwargs = steps.send(result)
+            except StopIteration:
+                return
+            if statuses is None:
+                result = getattr(self._exchange, method)(**kwargs)
+            elif method == "get_status":
+                if kwargs["event_id"] not in statuses:
+                    statuses[kwargs["event_id"]] = self._exchange.get_status(**kwargs)
+                result = statuses[kwargs["event_id"]]
+            else:
+                result = getattr(self._exchange, method)(**kwargs)
+                if method == "evict_event" or (method == "hold_lease" and result):
+                    statuses.pop(kwargs["event_id"], None)
+
+    def _handle(self, action: str, value: map):
+        if self._event_leases is not None:
+            is_new_lease = yield "hold_lease", dict(event_id=value.get("event_id"))
+            if is_new_lease:
+                # another task may have handled records of the event in between
+                self._replay_checked_events.discard(value.get("event_id"))
+        if self._replay_guard_ttl_seconds is not None:
+            is_replay = yield from self._guard_replay(action=action, value=value)
+            if is_replay:
+                return
         if action == "NEW_LIMIT_BET":
-            limit_bet = LimitBet(**value)
-            self._handle_limit_bet(bet=limit_bet)
+            yield from self._handle_limit_bet(bet=Bet.fromvalue(value=value))
         elif action == "NEW_MARKET_BET":
-            market_bet = MarketBet(**value)
-            self._handle_market_bet(bet=market_bet)
+            yield from self._handle_market_bet(bet=Bet.fromvalue(value=value))
         elif action == "INACTIVE_EVENT":
             inactive_event = InactiveEvent(**value)
-            self._handle_inactive_event(event=inactive_event)
+            yield from self._handle_inactive_event(event=inactive_event)
         elif action == "CANCEL_BET":
-            cancel_bet = CancelBet(**value)
-            self._handle_cancel_bet(bet=cancel_bet)
+            yield from self._handle_cancel_bet(bet=Bet.fromvalue(value=value))
         else:
-            self._logger.error(f"No valid matching action: {action}")
+            self._logger.error("No valid matching action", action=action)
+
+    def _replay_key(self, action: str, value: map) -> str:
+        return f"{self.REPLAY_KEY_PREFIXES.get(action, action)}{value.get('bet_id', '')}"
+
+    def _guard_replay(self, action: str, value: map):
+        """
+        Records of an event arrive in order, so after a restart the replayed
+        records of an event come before any new one and the handled set is
+        only read until the first record that is not in it.
+
+        :return: whether the record was handled before
+        """
+        event_id = value.get("event_id")
+        key = self._replay_key(action=action, value=value)
+        if event_id not in self._replay_checked_events:
+            is_handled = yield "is_handled", dict(event_id=event_id, key=key)
+            if is_handled:
+                self._logger.debug("Skipping replayed record", action=action, event_id=event_id, key=key)
+                return True
+            self._replay_checked_events.add(event_id)
+        if action == "INACTIVE_EVENT":
+            self._replay_checked_events.discard(event_id)
+        yield "mark_handled", dict(event_id=event_id, key=key, ttl_seconds=self._replay_guard_ttl_seconds)
+        return False
 
-    def _handle_limit_bet(self, bet: LimitBet):
-        generic_bet = Bet.fromlimitbet(limit_bet=bet)
-        modified_bet = copy.deepcopy(generic_bet)
-        status_details = self._exchange.get_status(event_id=bet.event_id)
+    def _handle_limit_bet(self, bet: Bet):
+        generic_bet = bet
+        modified_bet = generic_bet.copy()
+        status_details = yield "get_status", dict(event_id=bet.event_id)
 
         if status_details:
-            self._logger.debug(f"Event status details: {status_details.status}, {status_details.home_team_abbrev}, {status_details.away_team_abbrev}")
+            self._logger.debug(
+                "Event status details",
+                status=status_details.status,
+                home_team_abbrev=status_details.home_team_abbrev,
+                away_team_abbrev=status_details.away_team_abbrev
+            )
         else:
-            self._logger.debug(f"Status details do not exist for: {bet.event_id}")
+            self._logger.debug("Status details do not exist", event_id=bet.event_id)
 
         executed_bets = []
 
         if self._is_inactive_event(status_details):
-            self._logger.debug(f"Expired event {status_details}")
+            self._logger.debug("Expired event", status_details=status_details)
             non_executed_bet = ExecutedBets(
                 event_id=generic_bet.event_id,
                 sport=generic_bet.sport,
                 bets=[ExecutedBet.frombet(bet=generic_bet, status="CANCELLED")]
             )
-            self._kinesis_client.put_record(
-                StreamName=self._output_stream_name,
-                Data=str(non_executed_bet),
-                PartitionKey=non_executed_bet.event_id
-            )
+            self._publisher.publish(data=bytes(non_executed_bet), partition_key=non_executed_bet.event_id)
             return
 
         is_home_team = True if bet.on_team_abbrev == status_details.home_team_abbrev else False
         other_team_abbrev = status_details.home_team_abbrev if status_details.home_team_abbrev != bet.on_team_abbrev else status_details.away_team_abbrev
 
-        while True:
-            popped_bet = self._exchange.pop_bet(
+        if self._engine == "lua":
+            yield from self._handle_bet_with_script(bet=generic_bet, other_team_abbrev=other_team_abbrev, is_home_team=is_home_team, is_market=False)
+            return
+
+        put_back_bets = []
+        pending_bets = []
+        pop_count = 1
+        while modified_bet.amount > 0:
+            pending_bets = yield "pop_bets", dict(
                 event_id=bet.event_id,
                 team_abbrev=other_team_abbrev,
-                is_home_team=not is_home_team
+                is_home_team=not is_home_team,
+                count=pop_count
             )
-            self._logger.debug(f"popped event: {str(popped_bet)}")
-            if (popped_bet and modified_bet.better_than_or_equal(other=popped_bet, other_is_on_home=not is_home_team)
-               and modified_bet.amount > 0):
-                to_subtract_modified_bet, to_subtract_popped_bet = modified_bet.determine_amounts(other=popped_bet, other_is_on_home=not is_home_team)
-
+            pop_count = min(pop_count * 2, self.MAX_POP_COUNT)
+            if not pending_bets:
+                break
+            fills = plan_sweep(bet=modified_bet, resting_bets=pending_bets, other_is_on_home=not is_home_team, is_market=False)
+            for popped_bet, (to_subtract_modified_bet, to_subtract_popped_bet) in zip(pending_bets, fills):
+                self._logger.debug("popped bet", bet=popped_bet)
                 modified_bet.amount -= to_subtract_modified_bet
                 popped_bet.amount -= to_subtract_popped_bet
 
-                tmp_bet_copy = copy.deepcopy(modified_bet)
-                tmp_bet_copy.amount = to_subtract_modified_bet
-
-                tmp_popped_bet_copy = copy.deepcopy(popped_bet)
-                tmp_popped_bet_copy.amount = to_subtract_popped_bet
+                tmp_bet_copy = modified_bet.with_amount(amount=to_subtract_modified_bet)
+                tmp_popped_bet_copy = popped_bet.with_amount(amount=to_subtract_popped_bet)
 
                 bet_status = "EXECUTED" if modified_bet.amount == 0 else "PARTIALLY_EXECUTED"
                 popped_bet_status = "EXECUTED" if popped_bet.amount == 0 else "PARTIALLY_EXECUTED"
@@ -95,76 +365,88 @@ class BetExecutor:
                 executed_bets.append(executed_bet)
 
                 # push the popped bet back on the exchange
-                if popped_bet and popped_bet.amount > 0:
-                    self._exchange.submit_bet(bet=popped_bet)
-            else:
-                # push the popped bet back on the exchange
-                if popped_bet and popped_bet.amount > 0:
-                    self._exchange.submit_bet(bet=popped_bet)
+                if popped_bet.amount > 0:
+                    put_back_bets.append(popped_bet)
+            pending_bets = pending_bets[len(fills):]
+            # the bet is filled or not better than or equal to the next popped bet
+            if pending_bets:
                 break
 
+        # popped but never reached
+        put_back_bets.extend(pending_bets)
+
         # push the modified bet to the exchange if out of viable bets on the queue
         if modified_bet.amount > 0:
-            self._exchange.submit_bet(bet=modified_bet)
+            put_back_bets.append(modified_bet)
+
+        yield "submit_bets", dict(bets=put_back_bets)
 
         for executed_bet in executed_bets:
-            self._kinesis_client.put_record(
-                StreamName=self._output_stream_name,
-                Data=str(executed_bet),
-                PartitionKey=executed_bet.event_id
-            )
+            self._publisher.publish(data=bytes(executed_bet), partition_key=executed_bet.event_id)
+        self._record_fills(executed_bets=executed_bets)
 
-    def _handle_market_bet(self, bet: MarketBet):
-        generic_bet = Bet.frommarketbet(market_bet=bet)
-        modified_bet = copy.deepcopy(generic_bet)
-        status_details = self._exchange.get_status(event_id=bet.event_id)
+    def _handle_market_bet(self, bet: Bet):
+        generic_bet = bet
+        modified_bet = generic_bet.copy()
+        status_details = yield "get_status", dict(event_id=bet.event_id)
 
         if status_details:
-            self._logger.debug(f"Event status details: {status_details.status}, {status_details.home_team_abbrev}, {status_details.away_team_abbrev}")
+            self._logger.debug(
+                "Event status details",
+                status=status_details.status,
+                home_team_abbrev=status_details.home_team_abbrev,
+                away_team_abbrev=status_details.away_team_abbrev
+            )
         else:
-            self._logger.debug(f"Status details do not exist for: {bet.event_id}")
+            self._logger.debug("Status details do not exist", event_id=bet.event_id)
 
         executed_bets = []
         popped_bets = []
 
         if self._is_inactive_event(status_details):
-            self._logger.debug(f"Expired event {status_details}")
+            self._logger.debug("Expired event", status_details=status_details)
             non_executed_bet = ExecutedBets(
                 event_id=generic_bet.event_id,
                 sport=generic_bet.sport,
                 bets=[ExecutedBet.frombet(bet=generic_bet, status="CANCELLED")]
             )
-            self._kinesis_client.put_record(
-                StreamName=self._output_stream_name,
-                Data=str(non_executed_bet),
-                PartitionKey=non_executed_bet.event_id
-            )
+            self._publisher.publish(data=bytes(non_executed_bet), partition_key=non_executed_bet.event_id)
             return
 
         is_home_team = True if bet.on_team_abbrev == status_details.home_team_abbrev else False
         other_team_abbrev = status_details.home_team_abbrev if status_details.home_team_abbrev != bet.on_team_abbrev else status_details.away_team_abbrev
 
-        while True:
-            popped_bet = self._exchange.pop_bet(
+        if self._engine == "lua":
+            yield from self._handle_bet_with_script(bet=generic_bet, other_team_abbrev=other_team_abbrev, is_home_team=is_home_team, is_market=True)
+            return
+
+        fill_count = yield from self._market_fill_count(bet=generic_bet, other_team_abbrev=other_team_abbrev, is_home_team=is_home_team)
+        if fill_count is None:
+            self._publish_insufficient_volume(bet=generic_bet)
+            return
+
+        put_back_bets = []
+        pending_bets = []
+        pop_count = fill_count
+        while modified_bet.amount > 0:
+            pending_bets = yield "pop_bets", dict(
                 event_id=bet.event_id,
                 team_abbrev=other_team_abbrev,
-                is_home_team=not is_home_team
+                is_home_team=not is_home_team,
+                count=pop_count
             )
-            if popped_bet:
-                popped_bets.append(copy.deepcopy(popped_bet))
-
-            self._logger.debug(f"popped event: {str(popped_bet)}")
-            if popped_bet and modified_bet.amount > 0:
-                to_subtract_modified_bet, to_subtract_popped_bet = modified_bet.determine_amounts(other=popped_bet, other_is_on_home=not is_home_team)
-
+            pop_count = min(pop_count * 2, self.MAX_POP_COUNT)
+            if not pending_bets:
+                break
+            fills = plan_sweep(bet=modified_bet, resting_bets=pending_bets, other_is_on_home=not is_home_team, is_market=True)
+            popped_bets.extend(popped_bet.copy() for popped_bet in pending_bets[:len(fills)])
+            for popped_bet, (to_subtract_modified_bet, to_subtract_popped_bet) in zip(pending_bets, fills):
+                self._logger.debug("popped bet", bet=popped_bet)
                 modified_bet.amount -= to_subtract_modified_bet
                 popped_bet.amount -= to_subtract_popped_bet
 
-                tmp_bet_copy = copy.deepcopy(modified_bet)
-                tmp_bet_copy.amount = to_subtract_modified_bet
-
-                tmp_popped_bet_copy = copy.deepcopy(popped_bet)
-                tmp_popped_bet_copy.amount = to_subtract_popped_bet
+                tmp_bet_copy = modified_bet.with_amount(amount=to_subtract_modified_bet)
+                tmp_popped_bet_copy = popped_bet.with_amount(amount=to_subtract_popped_bet)
 
                 bet_status = "EXECUTED" if modified_bet.amount == 0 else "PARTIALLY_EXECUTED"
                 popped_bet_status = "EXECUTED" if popped_bet.amount == 0 else "PARTIALLY_EXECUTED"
@@ -182,63 +464,106 @@ class BetExecutor:
                 # if the entire bet executed but some left on the last popped bet
                 # throw what's left on popped bet back on exchange
                 if modified_bet.amount == 0 and popped_bet.amount > 0:
-                    self._exchange.submit_bet(bet=popped_bet)
-                    break
-            else:
-                break
+                    put_back_bets.append(popped_bet)
+            pending_bets = pending_bets[len(fills):]
 
         # if entire bet executed send executed bets to kinesis out
         if modified_bet.amount == 0:
+            yield "submit_bets", dict(bets=put_back_bets + pending_bets)
             for executed_bet in executed_bets:
-                self._kinesis_client.put_record(
-                    StreamName=self._output_stream_name,
-                    Data=str(executed_bet),
-                    PartitionKey=executed_bet.event_id
-                )
-        # if not enough volume on the other side to execute the market bet
+                self._publisher.publish(data=bytes(executed_bet), partition_key=executed_bet.event_id)
+            self._record_fills(executed_bets=executed_bets)
+        # if the book changed since it was checked and can no longer fill the bet
         # pop all popped bets back on the exchange, and send bet status to kinesis
         else:
-            for bet in popped_bets:
-                self._exchange.submit_bet(bet=bet)
-            non_executed_bet = ExecutedBets(
-                event_id=generic_bet.event_id,
-                sport=generic_bet.sport,
-                bets=[ExecutedBet.frombet(bet=generic_bet, status="INSUFFICIENT_VOLUME")]
+            yield "submit_bets", dict(bets=popped_bets + pending_bets)
+            self._publish_insufficient_volume(bet=generic_bet)
+
+    def _market_fill_count(self, bet: Bet, other_team_abbrev: str, is_home_team: bool):
+        """
+        Walks the other team's queue without popping it, doing the same amount
+        math as the sweep.
+
+        :return: how many resting bets fill the market bet, None if the queue can not fill it
+        """
+        remaining_bet = bet.copy()
+        start = 0
+        count = 0
+        peek_count = self.PEEK_COUNT
+        while True:
+            resting_bets = yield "peek_bets", dict(
+                event_id=bet.event_id,
+                team_abbrev=other_team_abbrev,
+                is_home_team=not is_home_team,
+                start=start,
+                count=peek_count
             )
-            self._kinesis_client.put_record(
-                StreamName=self._output_stream_name,
-                Data=str(non_executed_bet),
-                PartitionKey=non_executed_bet.event_id
+            for to_subtract_bet, _ in plan_sweep(bet=remaining_bet, resting_bets=resting_bets, other_is_on_home=not is_home_team, is_market=True):
+                remaining_bet.amount -= to_subtract_bet
+                count += 1
+                if remaining_bet.amount <= 0:
+                    return count if remaining_bet.amount == 0 else None
+            if len(resting_bets) < peek_count:
+                return None
+            start += peek_count
+            peek_count = min(peek_count * 2, self.MAX_PEEK_COUNT)
+
+    def _publish_insufficient_volume(self, bet: Bet):
+        non_executed_bet = ExecutedBets(
+            event_id=bet.event_id,
+            sport=bet.sport,
+            bets=[ExecutedBet.frombet(bet=bet, status="INSUFFICIENT_VOLUME")]
+        )
+        self._publisher.publish(data=bytes(non_executed_bet), partition_key=non_executed_bet.event_id)
+
+    def _handle_bet_with_script(self, bet: Bet, other_team_abbrev: str, is_home_team: bool, is_market: bool):
+        is_filled, fills = yield "match_bet", dict(
+            bet=bet,
+            other_team_abbrev=other_team_abbrev,
+            other_is_home=not is_home_team,
+            is_market=is_market
+        )
+
+        if not is_filled:
+            self._publish_insufficient_volume(bet=bet)
+            return
+
+        executed_bets = []
+        for popped_bet, bet_amount, popped_bet_amount, bet_remaining, popped_bet_remaining in fills:
+            tmp_bet_copy = bet.with_amount(amount=bet_amount)
+            popped_bet.amount = popped_bet_amount
+
+            executed_bet = ExecutedBets.frombets(
+                bet=tmp_bet_copy,
+                bet_status="EXECUTED" if bet_remaining == 0 else "PARTIALLY_EXECUTED",
+                popped_bet=popped_bet,
+                popped_bet_status="EXECUTED" if popped_bet_remaining == 0 else "PARTIALLY_EXECUTED",
+                popped_bet_is_on_home=not is_home_team
             )
+            self._publisher.publish(data=bytes(executed_bet), partition_key=executed_bet.event_id)
+            executed_bets.append(executed_bet)
+        self._record_fills(executed_bets=executed_bets)
 
     def _handle_inactive_event(self, event: InactiveEvent):
-        status_details = self._exchange.get_status(event_id=event.event_id)
+        status_details = yield "get_status", dict(event_id=event.event_id)
         if not status_details:
-            self._logger.error(f"No event details for handling inactive event {event.event_id}")
+            self._logger.error("No event details for handling inactive event", event_id=event.event_id)
         else:
-            self._logger.info(f"Handling inactive event for: {event.event_id}")
+            self._logger.info("Handling inactive event", event_id=event.event_id)
 
         # purge exchange on both sides
-        for team_abbrev, is_home_team in [(event.home_team_abbrev, True), (event.away_team_abbrev, False)]:
-            while True:
-                popped_bet = self._exchange.pop_bet(
-                    event_id=event.event_id,
-                    team_abbrev=team_abbrev,
-                    is_home_team=is_home_team
-                )
-                if popped_bet:
-                    non_executed_bet = ExecutedBets(
-                        event_id=event.event_id,
-                        sport=event.sport,
-                        bets=[ExecutedBet.frombet(bet=popped_bet, status="CANCELLED")]
-                    )
-                    self._kinesis_client.put_record(
-                        StreamName=self._output_stream_name,
-                        Data=str(non_executed_bet),
-                        PartitionKey=non_executed_bet.event_id
-                    )
-                else:
-                    break
+        purged_bets = yield "purge_bets", dict(
+            event_id=event.event_id,
+            home_team_abbrev=event.home_team_abbrev,
+            away_team_abbrev=event.away_team_abbrev
+        )
+        for purged_bet in purged_bets:
+            non_executed_bet = ExecutedBets(
+                event_id=event.event_id,
+                sport=event.sport,
+                bets=[ExecutedBet.frombet(bet=purged_bet, status="CANCELLED")]
+            )
+            self._publisher.publish(data=bytes(non_executed_bet), partition_key=non_executed_bet.event_id)
 
         # poison pill for connector to close out all bets on the event
         # needs same schema as other bets for the purpose of kinesis analytics
@@ -254,26 +579,26 @@ class BetExecutor:
                 status="EXPIRED_EVENT"
             )]
         )
-        self._kinesis_client.put_record(
-            StreamName=self._output_stream_name,
-            Data=str(close_out_bets),
-            PartitionKey=event.event_id
-        )
+        self._publisher.publish(data=bytes(close_out_bets), partition_key=close_out_bets.event_id)
+
+        yield "evict_event", dict(event_id=event.event_id)
 
-    def _handle_cancel_bet(self, bet: CancelBet):
-        generic_bet = Bet.fromcancelbet(cancel_bet=bet)
-        removed_bet = self._exchange.remove_bet(bet=generic_bet)
+    def _handle_cancel_bet(self, bet: Bet):
+        removed_bet = yield "remove_bet", dict(bet=bet)
         if removed_bet is not None:
             non_executed_bet = ExecutedBets(
                 event_id=bet.event_id,
                 sport=bet.sport,
                 bets=[ExecutedBet.frombet(bet=removed_bet, status="CANCELLED")]
             )
-            self._kinesis_client.put_record(
-                StreamName=self._output_stream_name,
-                Data=str(non_executed_bet),
-                PartitionKey=non_executed_bet.event_id
-            )
+            self._publisher.publish(data=bytes(non_executed_bet), partition_key=non_executed_bet.event_id)
+
+    def _record_fills(self, executed_bets: [ExecutedBets]):
+        """
+        Extension point for fill accounting, called with the executions a
+        bet's sweep published, one per resting bet it filled. Does nothing
+        here, InstrumentedBetExecutor counts fills and levels swept with it.
+        """
 
     @staticmethod
     def _is_inactive_event(status_details):
@@ -0,0 +1,15 @@
+class BetIndex:
+    """
+    Hash per queue from bet_id to the exact member the bet is stored under.
+    """
+    def __init__(self, redis_client):
+        self._r = redis_client
+
+    def set_members(self, index_name: str, mapping: map):
+        self._r.hset(name=index_name, mapping=mapping)
+
+    def get_member(self, index_name: str, bet_id: str):
+        return self._r.hget(name=index_name, key=bet_id)
+
+    def remove(self, index_name: str, *bet_ids: str):
+        self._r.hdel(index_name, *bet_ids)
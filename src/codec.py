@@ -0,0 +1,79 @@
+"""
+Single json layer for record decode and output encode.
+
+Decoding uses orjson when it is installed. Encoding always produces exactly
+what json.dumps would, since resting bets written as json are matched by
+their bytes, so the hot output types are encoded with fixed templates
+instead of building a dict for json.dumps on every call.
+"""
+import json
+from json.encoder import encode_basestring_ascii
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None
+
+
+def loads(data):
+    """
+    :param data: bytes or str
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj) -> str:
+    return json.dumps(obj)
+
+
+def dumps_bytes(obj) -> bytes:
+    return dumps(obj).encode("utf-8")
+
+
+def encode_value(value) -> str:
+    value_type = type(value)
+    if value is None:
+        return "null"
+    if value_type is str:
+        return encode_basestring_ascii(value)
+    if value_type is int:
+        return int.__repr__(value)
+    if value_type is float and value == value and value not in (float("inf"), float("-inf")):
+        return float.__repr__(value)
+    return json.dumps(value)
+
+
+def encode_bet(bet) -> str:
+    return '{"event_id": %s, "sport": %s, "bet_id": %s, "brokerage_id": %s, "user_id": %s, "amount": %s, "odds": %s, "on_team_abbrev": %s}' % (
+        encode_value(bet.event_id),
+        encode_value(bet.sport),
+        encode_value(bet.bet_id),
+        encode_value(bet.brokerage_id),
+        encode_value(bet.user_id),
+        encode_value(bet.amount),
+        encode_value(bet.odds),
+        encode_value(bet.on_team_abbrev)
+    )
+
+
+def encode_executed_bet(executed_bet) -> str:
+    return '{"bet_id": %s, "brokerage_id": %s, "user_id": %s, "amount": %s, "status": %s}' % (
+        encode_value(executed_bet.bet_id),
+        encode_value(executed_bet.brokerage_id),
+        encode_value(executed_bet.user_id),
+        encode_value(executed_bet.amount),
+        encode_value(executed_bet.status)
+    )
+
+
+def encode_executed_bets(executed_bets) -> str:
+    return '{"event_id": %s, "sport": %s, "odds": %s, "execution_time": %s, "bets": [%s], "winning_team_abbrev": %s}' % (
+        encode_value(executed_bets.event_id),
+        encode_value(executed_bets.sport),
+        encode_value(executed_bets.odds),
+        encode_value(executed_bets.execution_time),
+        ", ".join(map(encode_executed_bet, executed_bets.bets)),
+        encode_value(executed_bets.winning_team_abbrev)
+    )
@@ -1,12 +1,28 @@
+import asyncio
 import os
+import signal
+import socket
+import sys
+from queue import Empty, Queue
+from threading import Thread
 
 from kinesis.consumer import KinesisConsumer
 from kinesis.state import DynamoDB
-from redis import StrictRedis
+from redis import BlockingConnectionPool, StrictRedis
 import boto3
 
+from src.async_bet_executer import AsyncBetExecutor
 from src.bet_executer import BetExecutor
+from src.event_leases import EventLeases
+from src import keys
+from src.instrumentation import InstrumentedBetExecutor, InstrumentedKinesis, InstrumentedRedis
 from src.logger import LoggerFactory
+from src.market_data import MarketDataPublisher
+from src.metrics import Metrics
+from src.micro_batcher import MicroBatcher
+from src.profiling import Profiler
+from src.status_cache import StatusCache
+from src.worker_pool import BatchedCheckpointState, DeferredCheckpointState, EventWorkerPool, PARKED_RETRY_SECONDS, ParkedTickets, RecordTicket
 
 
 class Core:
@@ -16,22 +32,362 @@ class Core:
         self._stream_name = os.environ.get("INCOMING_KINESIS_STREAM_NAME")
         self._kcl_state_manager_table_name = os.environ.get("KCL_STATE_MANAGER_TABLE_NAME")
         self._endpoint_url = os.environ.get("ENDPOINT_URL")
-        host = os.environ.get("REDIS_HOST")
-        port = os.environ.get("REDIS_PORT")
-        redis_client = StrictRedis(host=host, port=port, db=0)
-        output_stream_name = os.environ.get("OUTGOING_KINESIS_STREAM_NAME")
-        kinesis_client = boto3.client("kinesis", endpoint_url=self._endpoint_url)
-        self._bet_executor = BetExecutor(logger=self._logger, redis_client=redis_client, kinesis_client=kinesis_client, output_stream_name=output_stream_name)
+        self._redis_host = os.environ.get("REDIS_HOST")
+        self._redis_port = os.environ.get("REDIS_PORT")
+        self._output_stream_name = os.environ.get("OUTGOING_KINESIS_STREAM_NAME")
+        self._kinesis_client = boto3.client("kinesis", endpoint_url=self._endpoint_url)
+        self._engine = os.environ.get("MATCHING_ENGINE", "redis")
+        # MEMBER_ENCODING=compact is opt in, see src/member_codec.py
+        self._member_encoding = os.environ.get("MEMBER_ENCODING", "json")
+        # only needed until scripts/migrate_keys.py has indexed the books written before the bet index
+        self._legacy_cancel_scan = os.environ.get("LEGACY_CANCEL_SCAN", "false").lower() == "true"
+        self._worker_count = int(os.environ.get("WORKER_COUNT", 1))
+        self._execution_mode = os.environ.get("EXECUTION_MODE", "sync")
+        self._max_in_flight = int(os.environ.get("MAX_IN_FLIGHT", 100))
+        self._setup_redis()
+        self._max_batch_size = int(os.environ.get("MAX_BATCH_SIZE", 500))
+        self._max_batch_wait_ms = float(os.environ.get("MAX_BATCH_WAIT_MS", 50))
+        self._checkpoint_every_records = int(os.environ.get("CHECKPOINT_EVERY_RECORDS", 1))
+        self._checkpoint_every_seconds = float(os.environ.get("CHECKPOINT_EVERY_SECONDS", 0))
+        replay_guard_ttl_seconds = os.environ.get("REPLAY_GUARD_TTL_SECONDS")
+        self._replay_guard_ttl_seconds = float(replay_guard_ttl_seconds) if replay_guard_ttl_seconds else None
+        if self._replay_guard_ttl_seconds is None and (self._checkpoint_every_records > 1 or self._checkpoint_every_seconds):
+            self._logger.warning("Checkpoints are batched without a replay guard, a restart re-executes records since the last checkpoint")
+        self._status_cache = StatusCache(
+            max_size=int(os.environ.get("STATUS_CACHE_SIZE", 1024)),
+            ttl_seconds=float(os.environ.get("STATUS_CACHE_TTL_SECONDS", 5))
+        )
+        if os.environ.get("STATUS_CACHE_KEYSPACE_EVENTS", "false").lower() == "true":
+            self._status_cache.listen(redis_client=self._redis_client)
+        self._setup_metrics()
+        self._setup_event_leases()
+        self._setup_market_data()
+        self._setup_profiling()
+        self._bet_executor = self._create_bet_executor()
+
+    def _setup_redis(self):
+        """
+        REDIS_KEY_LAYOUT = Literal["legacy", "hash-tagged"], see scripts/migrate_keys.py
+
+        The hash tagged layout readies the keys for a redis cluster, which
+        this runtime can not use yet: the exchange's transactions need
+        redis-py 6.2+ there, a release that needs python 3.9+. Sync clients block for up to REDIS_SOCKET_TIMEOUT_SECONDS when all
+        REDIS_MAX_CONNECTIONS are in use, which defaults to a connection per
+        worker plus a few for the status cache and market data.
+        """
+        keys.set_layout(os.environ.get("REDIS_KEY_LAYOUT", keys.LEGACY))
+        self._redis_max_connections = int(os.environ.get("REDIS_MAX_CONNECTIONS", self._worker_count + 4))
+        self._redis_client_kwargs = dict(
+            socket_timeout=float(os.environ.get("REDIS_SOCKET_TIMEOUT_SECONDS", 5)),
+            socket_keepalive=True,
+            socket_keepalive_options=self._keepalive_options(),
+            health_check_interval=float(os.environ.get("REDIS_HEALTH_CHECK_INTERVAL_SECONDS", 30))
+        )
+        self._redis_client = StrictRedis(connection_pool=BlockingConnectionPool(
+            host=self._redis_host,
+            port=self._redis_port,
+            db=0,
+            max_connections=self._redis_max_connections,
+            timeout=self._redis_client_kwargs["socket_timeout"],
+            **self._redis_client_kwargs
+        ))
+
+    def _create_async_redis_client(self):
+        # redis.asyncio needs redis 4.3+, imported only where it is used
+        from redis.asyncio import BlockingConnectionPool as AsyncBlockingConnectionPool, StrictRedis as AsyncStrictRedis
+        return AsyncStrictRedis(connection_pool=AsyncBlockingConnectionPool(
+            host=self._redis_host,
+            port=self._redis_port,
+            db=0,
+            max_connections=self._max_in_flight,
+            timeout=self._redis_client_kwargs["socket_timeout"],
+            **self._redis_client_kwargs
+        ))
+
+    @staticmethod
+    def _keepalive_options() -> map:
+        # dead connections are noticed within a minute instead of the os default of hours
+        options = {}
+        for name, value in (("TCP_KEEPIDLE", 30), ("TCP_KEEPINTVL", 10), ("TCP_KEEPCNT", 3)):
+            if hasattr(socket, name):
+                options[getattr(socket, name)] = value
+        return options
+
+    def _setup_metrics(self):
+        """
+        METRICS = Literal["off", "prometheus", "emf"]
+        """
+        exporter = os.environ.get("METRICS", "off")
+        self._metrics = None
+        if exporter == "off":
+            return
+        self._metrics = Metrics()
+        self._redis_client = InstrumentedRedis(client=self._redis_client, metrics=self._metrics)
+        self._kinesis_client = InstrumentedKinesis(client=self._kinesis_client, metrics=self._metrics)
+        if exporter == "prometheus":
+            self._metrics.serve_prometheus(port=int(os.environ.get("METRICS_PORT", 9100)))
+        elif exporter == "emf":
+            self._metrics.write_emf_every(interval_seconds=float(os.environ.get("METRICS_INTERVAL_SECONDS", 60)), stream=sys.stdout)
+
+    def _setup_event_leases(self):
+        """
+        Tasks sharing a redis must all set EVENT_LEASE_TTL_MS, each event is
+        then handled by one task at a time. EVENT_LEASE_OWNER defaults to
+        host and pid. Only lua sweeps are fenced by the lease, so leases need
+        MATCHING_ENGINE=lua.
+        """
+        ttl_ms = os.environ.get("EVENT_LEASE_TTL_MS")
+        self._event_leases = None
+        if not ttl_ms:
+            return
+        if self._engine != "lua":
+            raise ValueError(f"EVENT_LEASE_TTL_MS needs MATCHING_ENGINE=lua, the {self._engine} engine does not fence sweeps")
+        self._event_leases = EventLeases(
+            logger=self._logger,
+            redis_client=self._redis_client,
+            owner_id=os.environ.get("EVENT_LEASE_OWNER", f"{socket.gethostname()}:{os.getpid()}"),
+            ttl_ms=float(ttl_ms)
+        )
+
+    def _setup_market_data(self):
+        """
+        Publishes depth snapshots to MARKET_DATA_STREAM_NAME when it is set.
+        """
+        stream_name = os.environ.get("MARKET_DATA_STREAM_NAME")
+        self._market_data = None
+        if not stream_name:
+            return
+        self._market_data = MarketDataPublisher(
+            logger=self._logger,
+            redis_client=self._redis_client,
+            kinesis_client=self._kinesis_client,
+            stream_name=stream_name,
+            interval_ms=float(os.environ.get("MARKET_DATA_INTERVAL_MS", 100)),
+            depth=int(os.environ.get("MARKET_DATA_DEPTH", 5)),
+            max_events=int(os.environ.get("MARKET_DATA_MAX_EVENTS", 10000)),
+            status_cache=self._status_cache
+        )
+        self._market_data.start()
+
+    def _setup_profiling(self):
+        """
+        PROFILE = Literal["off", "cprofile", "sampling"]
+
+        SIGUSR1 profiles the next PROFILE_RECORDS records, PROFILE_ON_START
+        also profiles the first ones. SIGUSR2 snapshots allocations when
+        TRACEMALLOC is true, the first signal only starts tracing unless
+        TRACEMALLOC_INTERVAL_SECONDS already did.
+        """
+        mode = os.environ.get("PROFILE", "off")
+        trace_memory = os.environ.get("TRACEMALLOC", "false").lower() == "true"
+        self._profiler = None
+        if mode == "off" and not trace_memory:
+            return
+        self._profiler = Profiler(
+            logger=self._logger,
+            mode=mode,
+            records=int(os.environ.get("PROFILE_RECORDS", 10000)),
+            output_dir=os.environ.get("PROFILE_OUTPUT_DIR"),
+            sample_interval_ms=float(os.environ.get("PROFILE_SAMPLE_INTERVAL_MS", 5)),
+            tracemalloc_frames=int(os.environ.get("TRACEMALLOC_FRAMES", 25))
+        )
+        if mode != "off" and self._execution_mode == "async":
+            self._logger.warning("Profiling records is not supported in async mode", mode=mode)
+            mode = "off"
+        self._profiler.install_signals(
+            profile_signal=signal.SIGUSR1 if mode != "off" else None,
+            memory_signal=signal.SIGUSR2 if trace_memory else None
+        )
+        if mode != "off" and os.environ.get("PROFILE_ON_START", "false").lower() == "true":
+            self._profiler.start()
+        tracemalloc_interval_seconds = float(os.environ.get("TRACEMALLOC_INTERVAL_SECONDS", 0))
+        if trace_memory and tracemalloc_interval_seconds:
+            self._profiler.snapshot_memory_every(interval_seconds=tracemalloc_interval_seconds)
+
+    def _create_bet_executor(self) -> BetExecutor:
+        if self._metrics is not None:
+            bet_executor = InstrumentedBetExecutor(metrics=self._metrics, **self._bet_executor_kwargs())
+        else:
+            bet_executor = BetExecutor(**self._bet_executor_kwargs())
+        if self._profiler is not None:
+            self._profiler.attach(bet_executor)
+        return bet_executor
+
+    def _bet_executor_kwargs(self) -> map:
+        return dict(
+            logger=self._logger,
+            redis_client=self._redis_client,
+            kinesis_client=self._kinesis_client,
+            output_stream_name=self._output_stream_name,
+            engine=self._engine,
+            member_encoding=self._member_encoding,
+            status_cache=self._status_cache,
+            market_data=self._market_data,
+            replay_guard_ttl_seconds=self._replay_guard_ttl_seconds,
+            event_leases=self._event_leases,
+            legacy_cancel_scan=self._legacy_cancel_scan
+        )
 
     def run(self):
         try:
             self._setup()
 
-            state = DynamoDB(table_name=self._kcl_state_manager_table_name)
-            consumer = KinesisConsumer(stream_name=self._stream_name, state=state)
-            for message in consumer:
-                self._logger.debug(message)
-                self._bet_executor.handle_record(message)
+            state = BatchedCheckpointState(
+                state=DynamoDB(table_name=self._kcl_state_manager_table_name),
+                every_records=self._checkpoint_every_records,
+                every_seconds=self._checkpoint_every_seconds
+            )
+            try:
+                self._consume(state=state)
+            finally:
+                state.flush()
 
         except Exception as e:
-            self._logger.error(f"Core error: {str(e)}")
+            self._logger.error("Core error: %s", e)
+        finally:
+            # setup may have failed before the publisher existed
+            if getattr(self, "_market_data", None) is not None:
+                self._market_data.close()
+            # hand the events over without waiting for the leases to expire
+            if getattr(self, "_event_leases", None) is not None:
+                self._event_leases.release_all()
+
+    def _consume(self, state):
+        if self._execution_mode == "async":
+            asyncio.run(self._run_async(state=state))
+            return
+        if self._execution_mode == "batch":
+            self._run_batched(state=state)
+            return
+        if self._worker_count > 1:
+            self._run_pool(state=state)
+            return
+        if self._event_leases is not None:
+            self._run_leased(state=state)
+            return
+        consumer = KinesisConsumer(stream_name=self._stream_name, state=state)
+        for message in consumer:
+            self._logger.debug("Received record %s", message)
+            self._bet_executor.handle_record(message)
+
+    def _run_leased(self, state):
+        """
+        Records of an event leased by another task are parked by the executor,
+        so their checkpoints are held back until they are handled. The records
+        are read on their own thread, so parked ones are retried while the
+        stream is idle.
+        """
+        deferred_state = DeferredCheckpointState(state=state)
+        consumer = KinesisConsumer(stream_name=self._stream_name, state=deferred_state)
+        items = Queue(maxsize=1)
+
+        def read():
+            # the consumer checkpoints from this thread, held back until the ticket is done
+            try:
+                for message in consumer:
+                    ticket = RecordTicket(sequence_number=message.get("SequenceNumber"))
+                    deferred_state.track(ticket)
+                    items.put((message, ticket))
+            finally:
+                items.put(None)
+
+        Thread(target=read, name="kinesis-reader", daemon=True).start()
+        parked_tickets = ParkedTickets(bet_executor=self._bet_executor)
+        while True:
+            try:
+                # parked records are retried while no record comes in
+                item = items.get(timeout=PARKED_RETRY_SECONDS if parked_tickets else None)
+            except Empty:
+                self._bet_executor.retry_parked()
+                parked_tickets.handled()
+                continue
+            if item is None:
+                break
+            message, ticket = item
+            self._logger.debug("Received record %s", message)
+            self._bet_executor.handle_record(message)
+            parked_tickets.handled(ticket=ticket)
+        deferred_state.advance()
+
+    def _run_pool(self, state):
+        deferred_state = DeferredCheckpointState(state=state)
+        consumer = KinesisConsumer(stream_name=self._stream_name, state=deferred_state)
+        pool = EventWorkerPool(
+            logger=self._logger,
+            executor_factory=self._create_bet_executor,
+            worker_count=self._worker_count,
+            state=deferred_state
+        )
+        try:
+            for message in consumer:
+                self._logger.debug("Received record %s", message)
+                pool.submit(message)
+        finally:
+            pool.close()
+
+    def _run_batched(self, state):
+        deferred_state = DeferredCheckpointState(state=state)
+        consumer = KinesisConsumer(stream_name=self._stream_name, state=deferred_state)
+        items = Queue(maxsize=self._max_batch_size * 2)
+
+        def read():
+            # the consumer checkpoints from this thread, held back until the ticket is done
+            try:
+                for message in consumer:
+                    ticket = RecordTicket(sequence_number=message.get("SequenceNumber"))
+                    deferred_state.track(ticket)
+                    items.put((message, ticket))
+            finally:
+                items.put(None)
+
+        Thread(target=read, name="kinesis-reader", daemon=True).start()
+        batcher = MicroBatcher(items=items, max_batch_size=self._max_batch_size, max_wait_ms=self._max_batch_wait_ms)
+        parked_tickets = ParkedTickets(bet_executor=self._bet_executor)
+        while not batcher.closed:
+            # parked records are retried while no record comes in
+            batch = batcher.next_batch(timeout=PARKED_RETRY_SECONDS if parked_tickets else None)
+            if not batch:
+                if parked_tickets:
+                    self._bet_executor.retry_parked()
+                    parked_tickets.handled()
+                continue
+            self._logger.debug("Handling batch", records=len(batch), next_batch_size=batcher.batch_size)
+            self._bet_executor.handle_records([message for message, _ in batch])
+            for _, ticket in batch:
+                parked_tickets.handled(ticket=ticket)
+        deferred_state.advance()
+
+    async def _run_async(self, state):
+        deferred_state = DeferredCheckpointState(state=state)
+        consumer = KinesisConsumer(stream_name=self._stream_name, state=deferred_state)
+        bet_executor = AsyncBetExecutor(
+            logger=self._logger,
+            redis_client=self._create_async_redis_client(),
+            kinesis_client=self._kinesis_client,
+            output_stream_name=self._output_stream_name,
+            engine=self._engine,
+            member_encoding=self._member_encoding,
+            status_cache=self._status_cache,
+            max_in_flight=self._max_in_flight,
+            market_data=self._market_data,
+            replay_guard_ttl_seconds=self._replay_guard_ttl_seconds,
+            event_leases=self._event_leases,
+            legacy_cancel_scan=self._legacy_cancel_scan
+        )
+        loop = asyncio.get_running_loop()
+        messages = iter(consumer)
+        try:
+            while True:
+                # the consumer blocks on its record queue so it is read off the loop
+                message = await loop.run_in_executor(None, next, messages, None)
+                if message is None:
+                    return
+                self._logger.debug("Received record %s", message)
+                # stop taking records once one has failed, as the sync loops do
+                bet_executor.raise_failure()
+                ticket = RecordTicket(sequence_number=message.get("SequenceNumber"))
+                deferred_state.track(ticket)
+                await bet_executor.submit(record=message, ticket=ticket)
+        finally:
+            await bet_executor.drain()
+            deferred_state.advance()
@@ -1,28 +1,22 @@
-from json import dumps
+from src import codec
 from src.utils import get_current_utc_iso
 
 
-class CancelBet:
-    def __init__(
-        self,
-        event_id: str,
-        sport: str,
-        bet_id: int,
-        brokerage_id: int,
-        user_id: int,
-        odds: int,
-        on_team_abbrev: str
-    ):
-        self.event_id = event_id
-        self.sport = sport
-        self.bet_id = bet_id
-        self.brokerage_id = brokerage_id
-        self.user_id = user_id
-        self.odds = odds
-        self.on_team_abbrev = on_team_abbrev
-
-
 class InactiveEvent:
+    __slots__ = (
+        "event_id",
+        "sport",
+        "home_team_abbrev",
+        "away_team_abbrev",
+        "home_team_name",
+        "away_team_name",
+        "home_team_score",
+        "away_team_score",
+        "winning_team_abbrev",
+        "losing_team_abbrev",
+        "date"
+    )
+
     def __init__(
         self,
         event_id: str,
@@ -50,53 +44,18 @@ class InactiveEvent:
         self.date = date
 
 
-class LimitBet:
-    def __init__(
-        self,
-        event_id: str,
-        sport: str,
-        bet_id: int,
-        brokerage_id: int,
-        user_id: int,
-        amount: float,
-        odds: int,
-        order_type: str,
-        on_team_abbrev: str
-    ):
-        self.event_id = event_id
-        self.sport = sport
-        self.bet_id = bet_id
-        self.brokerage_id = brokerage_id
-        self.user_id = user_id
-        self.amount = amount
-        self.odds = odds
-        self.order_type = order_type
-        self.on_team_abbrev = on_team_abbrev
-
-
-class MarketBet:
-    def __init__(
-        self,
-        event_id: str,
-        sport: str,
-        bet_id: int,
-        brokerage_id: int,
-        user_id: int,
-        amount: float,
-        order_type: str,
-        on_team_abbrev: str
-    ):
-        self.event_id = event_id
-        self.sport = sport
-        self.bet_id = bet_id
-        self.brokerage_id = brokerage_id
-        self.user_id = user_id
-        self.amount = amount
-        self.order_type = order_type
-        self.on_team_abbrev = on_team_abbrev
-
-
 class Bet:
+    __slots__ = (
+        "event_id",
+        "sport",
+        "bet_id",
+        "brokerage_id",
+        "user_id",
+        "on_team_abbrev",
+        "amount",
+        "odds"
+    )
+
     def __init__(
         self,
         event_id: str,
@@ -132,39 +91,34 @@ class Bet:
         return False
 
     @classmethod
-    def fromlimitbet(cls, limit_bet: LimitBet):
-        return cls(
-            event_id=limit_bet.event_id,
-            sport=limit_bet.sport,
-            bet_id=limit_bet.bet_id,
-            brokerage_id=limit_bet.brokerage_id,
-            user_id=limit_bet.user_id,
-            amount=limit_bet.amount,
-            odds=limit_bet.odds,
-            on_team_abbrev=limit_bet.on_team_abbrev
-        )
-
-    @classmethod
-    def frommarketbet(cls, market_bet: MarketBet):
+    def fromvalue(cls, value: map):
+        """
+        Builds a bet straight from the value of a NEW_LIMIT_BET, NEW_MARKET_BET or CANCEL_BET record.
+        """
         return cls(
-            event_id=market_bet.event_id,
-            sport=market_bet.sport,
-            bet_id=market_bet.bet_id,
-            brokerage_id=market_bet.brokerage_id,
-            user_id=market_bet.user_id,
-            amount=market_bet.amount,
-            on_team_abbrev=market_bet.on_team_abbrev
+            event_id=value["event_id"],
+            sport=value["sport"],
+            bet_id=value["bet_id"],
+            brokerage_id=value["brokerage_id"],
+            user_id=value["user_id"],
+            on_team_abbrev=value["on_team_abbrev"],
+            amount=value.get("amount"),
+            odds=value.get("odds")
         )
 
-    @classmethod
-    def fromcancelbet(cls, cancel_bet: CancelBet):
-        return cls(
-            event_id=cancel_bet.event_id,
-            sport=cancel_bet.sport,
-            bet_id=cancel_bet.bet_id,
-            brokerage_id=cancel_bet.brokerage_id,
-            user_id=cancel_bet.user_id,
-            on_team_abbrev=cancel_bet.on_team_abbrev
+    def copy(self):
+        return self.with_amount(amount=self.amount)
+
+    def with_amount(self, amount: float):
+        return Bet(
+            self.event_id,
+            self.sport,
+            self.bet_id,
+            self.brokerage_id,
+            self.user_id,
+            self.on_team_abbrev,
+            amount,
+            self.odds
         )
 
     def better_than_or_equal(self, other, other_is_on_home: bool) -> bool:
@@ -182,34 +136,18 @@ class Bet:
             bet_amount = round(other.amount * (abs(bet_odds) / 100), 2) if bet_odds < 0 else round(other.amount / (bet_odds / 100), 2)
             return bet_amount, other.amount
 
-    def __repr__(self):
-        bet_dict = {
-            "event_id": self.event_id,
-            "sport": self.sport,
-            "bet_id": self.bet_id,
-            "brokerage_id": self.brokerage_id,
-            "user_id": self.user_id,
-            "amount": self.amount,
-            "odds": self.odds,
-            "on_team_abbrev": self.on_team_abbrev
-        }
-        return dumps(bet_dict)
-
     def __str__(self):
-        bet_dict = {
-            "event_id": self.event_id,
-            "sport": self.sport,
-            "bet_id": self.bet_id,
-            "brokerage_id": self.brokerage_id,
-            "user_id": self.user_id,
-            "amount": self.amount,
-            "odds": self.odds,
-            "on_team_abbrev": self.on_team_abbrev
-        }
-        return dumps(bet_dict)
+        return codec.encode_bet(self)
+
+    def __bytes__(self):
+        return codec.encode_bet(self).encode("utf-8")
+
+    __repr__ = __str__
 
 
 class StatusDetails:
+    __slots__ = ("status", "home_team_abbrev", "away_team_abbrev")
+
     def __init__(self, status: str = None, home_team_abbrev: str = None, away_team_abbrev: str = None):
         """
         :param status: Status = Literal["ACTIVE", "INACTIVE"]
@@ -226,18 +164,41 @@ class StatusDetails:
             "home_team_abbrev": self.home_team_abbrev,
             "away_team_abbrev": self.away_team_abbrev
         }
-        return dumps(dict_form)
+        return codec.dumps(dict_form)
+
+    __repr__ = __str__
+
+
+class PriceLevel:
+    __slots__ = ("odds", "amount", "count")
+
+    def __init__(self, odds: int, amount: float, count: int):
+        """
+        :param odds:
+        :param amount: total amount resting at the odds
+        :param count: number of bets resting at the odds
+        """
+        self.odds = odds
+        self.amount = amount
+        self.count = count
+
+    def __eq__(self, other):
+        return isinstance(other, PriceLevel) and (self.odds, self.amount, self.count) == (other.odds, other.amount, other.count)
 
-    def __repr__(self):
+    def __str__(self):
         dict_form = {
-            "status": self.status,
-            "home_team_abbrev": self.home_team_abbrev,
-            "away_team_abbrev": self.away_team_abbrev
+            "odds": self.odds,
+            "amount": self.amount,
+            "count": self.count
         }
-        return dumps(dict_form)
+        return codec.dumps(dict_form)
+
+    __repr__ = __str__
 
 
 class ExecutedBet:
+    __slots__ = ("bet_id", "brokerage_id", "user_id", "amount", "status")
+
     def __init__(self, bet_id: int, brokerage_id: int, user_id: int, amount: float, status: str):
         """
         :param bet_id:
@@ -279,6 +240,8 @@ class ExecutedBet:
 
 
 class ExecutedBets:
+    __slots__ = ("event_id", "sport", "odds", "execution_time", "bets", "winning_team_abbrev")
+
     def __init__(
         self,
         event_id: str,
@@ -295,15 +258,10 @@ class ExecutedBets:
         self.winning_team_abbrev = winning_team_abbrev
 
     def __str__(self):
-        exec_bets_map = {
-            "event_id": self.event_id,
-            "sport": self.sport,
-            "odds": self.odds,
-            "execution_time": self.execution_time,
-            "bets": list(map(lambda bet: bet.as_map(), self.bets)),
-            "winning_team_abbrev": self.winning_team_abbrev
-        }
-        return dumps(exec_bets_map)
+        return codec.encode_executed_bets(self)
+
+    def __bytes__(self):
+        return codec.encode_executed_bets(self).encode("utf-8")
 
     @classmethod
     def frombets(
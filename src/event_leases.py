@@ -0,0 +1,132 @@
+import time
+from threading import Lock
+
+from src import keys
+from src.logger import Logger
+
+
+class LeaseLostError(Exception):
+    pass
+
+
+class LeaseHeldError(Exception):
+    def __init__(self, event_id: str, retry_in_ms: float):
+        super().__init__(f"Lease on event {event_id} is held by another task")
+        self.event_id = event_id
+        self.retry_in_ms = retry_in_ms
+
+
+# KEYS[1] = lease of the event, KEYS[2] = fencing token counter of the event
+# ARGV[1] = owner id, ARGV[2] = ttl in ms, ARGV[3] = ttl of the counter in seconds
+#
+# Returns {1, lease value, 1 if the lease is new else 0} when the owner holds
+# the lease afterwards, else {0, ms until the lease expires}.
+ACQUIRE_SCRIPT = """
+local held = redis.call("GET", KEYS[1])
+if held then
+    local token = string.match(held, "^(%d+):")
+    if string.sub(held, #token + 2) == ARGV[1] then
+        redis.call("PEXPIRE", KEYS[1], ARGV[2])
+        return {1, held, 0}
+    end
+    return {0, redis.call("PTTL", KEYS[1])}
+end
+local token = redis.call("INCR", KEYS[2])
+redis.call("EXPIRE", KEYS[2], ARGV[3])
+local value = token .. ":" .. ARGV[1]
+redis.call("SET", KEYS[1], value, "PX", ARGV[2])
+return {1, value, 1}
+"""
+
+# KEYS[1] = lease of the event, ARGV[1] = lease value
+RELEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+class EventLeases:
+    """
+    Ownership leases on events, so several tasks can share one redis as
+    long as each event is handled by whichever task holds its lease.
+
+    A lease is "{token}:{owner_id}" at lease:{event_id} with a ttl, where the
+    token is the next fencing token of the event. Records renew the lease of
+    their event once half the ttl has passed, so an event without records is
+    handed over by letting its lease expire and a task that stops releases
+    its leases right away. A task that gets a lease it did not hold
+    continuously is told so, and the lua engine refuses sweeps, cancels and
+    purges whose lease value is no longer the one in redis.
+    """
+    # the fencing token counter outlives every lease of the event by far
+    FENCE_TTL_SECONDS = 86400
+
+    def __init__(self, logger: Logger, redis_client, owner_id: str, ttl_ms: float = 10000, clock=time.monotonic):
+        """
+        :param redis_client: sync redis client, also used by async executors
+        :param owner_id: unique per task
+        """
+        self._logger = logger
+        self._r = redis_client
+        self._owner_id = owner_id
+        self._ttl_ms = ttl_ms
+        self._clock = clock
+        self._acquire_script = redis_client.register_script(ACQUIRE_SCRIPT)
+        self._release_script = redis_client.register_script(RELEASE_SCRIPT)
+        self._lock = Lock()
+        # event_id -> (lease value, clock time after which it is renewed)
+        self._held = {}
+
+    @staticmethod
+    def lease_name(event_id: str) -> str:
+        return keys.event_key("lease", event_id)
+
+    @staticmethod
+    def fence_name(event_id: str) -> str:
+        return keys.event_key("fence", event_id)
+
+    def value(self, event_id: str) -> str:
+        """
+        :return: the lease value last held for the event, "" if none
+        """
+        held = self._held.get(event_id)
+        return held[0] if held is not None else ""
+
+    def hold(self, event_id: str) -> bool:
+        """
+        Renews or acquires the lease of the event. Never waits, so a record of
+        an event another task holds does not stall the records behind it.
+
+        :return: whether the lease is new, so anything cached about the event may be stale
+        :raises LeaseHeldError: while another task holds the lease
+        """
+        held = self._held.get(event_id)
+        if held is not None and self._clock() < held[1]:
+            return False
+        renew_at = self._clock() + self._ttl_ms / 2000
+        res = self._acquire_script(
+            keys=[self.lease_name(event_id), self.fence_name(event_id)],
+            args=[self._owner_id, int(self._ttl_ms), self.FENCE_TTL_SECONDS]
+        )
+        if res[0] != 1:
+            raise LeaseHeldError(event_id=event_id, retry_in_ms=max(min(res[1], self._ttl_ms / 4), 1))
+        value = res[1].decode() if isinstance(res[1], bytes) else res[1]
+        with self._lock:
+            self._held[event_id] = (value, renew_at)
+            if res[2] == 1 and len(self._held) > 1:
+                self._forget_expired()
+        return res[2] == 1 or held is None
+
+    def _forget_expired(self):
+        # leases not renewed for a whole ttl have expired in redis
+        expired_before = self._clock() - self._ttl_ms / 2000
+        for event_id in [event_id for event_id, (_, renew_at) in self._held.items() if renew_at < expired_before]:
+            del self._held[event_id]
+
+    def release_all(self):
+        with self._lock:
+            held, self._held = self._held, {}
+        for event_id, (value, _) in held.items():
+            self._release_script(keys=[self.lease_name(event_id)], args=[value])
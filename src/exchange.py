@@ -1,48 +1,515 @@
+from redis.exceptions import WatchError
+
 from src.priority_queue import PriorityQueue
-from src.domain_model import Bet, StatusDetails
-from json import loads
+from src.bet_index import BetIndex
+from src.handled_records import HandledRecords
+from src.event_leases import EventLeases, LeaseLostError
+from src.domain_model import Bet, PriceLevel, StatusDetails
+from src.price_levels import PriceLevels
+from src.match_script import MATCH_SCRIPT
+from src.member_codec import JSON, decode_member, encode_member
+from src.status_cache import StatusCache
+from src import codec, keys
 
 
 class Exchange:
-    def __init__(self, redis_client):
+    def __init__(
+        self,
+        redis_client,
+        member_encoding: str = JSON,
+        status_cache: StatusCache = None,
+        event_leases: EventLeases = None,
+        legacy_cancel_scan: bool = False
+    ):
+        """
+        :param member_encoding: MemberEncoding = Literal["compact", "json"], only used for writes
+        :param status_cache: caches get_status lookups when given
+        :param event_leases: fences lua sweeps, cancels and purges with the lease of their event when given
+        :param legacy_cancel_scan: looks up cancels missing from the index by their odds, for books not yet migrated
+        """
+        self._member_encoding = member_encoding
+        self._legacy_cancel_scan = legacy_cancel_scan
+        self._status_cache = status_cache
+        self._event_leases = event_leases
         self._pq = PriorityQueue(redis_client=redis_client)
+        self._index = BetIndex(redis_client=redis_client)
         self._r = redis_client
+        self._match_script = None
+        # index entries of popped bets, removed with the next write
+        self._popped_bet_ids = {}
+        # price level changes by levels name and odds, written with the next write
+        self._level_deltas = {}
+        # keys of handled records and their ttl by handled name, written by flush_handled
+        self._handled_keys = {}
+
+    @staticmethod
+    def queue_name(event_id: str, team_abbrev: str) -> str:
+        return keys.event_key("pq", event_id, team_abbrev)
+
+    @staticmethod
+    def index_name(event_id: str, team_abbrev: str) -> str:
+        return keys.event_key("idx", event_id, team_abbrev)
+
+    @staticmethod
+    def levels_name(event_id: str, team_abbrev: str) -> str:
+        return keys.event_key("lvl", event_id, team_abbrev)
+
+    @staticmethod
+    def handled_name(event_id: str) -> str:
+        return keys.event_key("handled", event_id)
+
+    @staticmethod
+    def status_name(event_id: str) -> str:
+        return keys.event_key("event", event_id)
+
+    @staticmethod
+    def index_field(bet: Bet) -> str:
+        return codec.dumps(bet.bet_id)
 
     def submit_bet(self, bet: Bet):
-        queue_name = f"pq:{bet.event_id}:{bet.on_team_abbrev}"
-        self._pq.push(
-            queue_name=queue_name,
-            score=bet.odds,
-            data=str(bet)
-        )
+        self.submit_bets(bets=[bet])
 
-    def pop_bet(self, event_id: str, team_abbrev: str, is_home_team: bool) -> Bet:
-        queue_name = f"pq:{event_id}:{team_abbrev}"
+    def submit_bets(self, bets: [Bet]):
+        """
+        Submits all bets in one round trip with a single ZADD and HSET per queue.
+        """
+        pipe = self._submit_pipeline(bets=bets)
+        if pipe is not None:
+            pipe.execute()
+
+    def _submit_pipeline(self, bets: [Bet]):
+        mappings = {}
+        index_mappings = {}
+        for bet in bets:
+            member = encode_member(bet=bet, encoding=self._member_encoding)
+            mappings.setdefault(self.queue_name(bet.event_id, bet.on_team_abbrev), {})[member] = bet.odds
+            index_name = self.index_name(bet.event_id, bet.on_team_abbrev)
+            index_mappings.setdefault(index_name, {})[self.index_field(bet)] = member
+            self._popped_bet_ids.get(index_name, set()).discard(self.index_field(bet))
+            self._add_level_delta(bet=bet, sign=1)
+        if not mappings and not self._has_deferred_writes():
+            return None
+        pipe = self._r.pipeline(transaction=True)
+        self._write_deferred(pipe=pipe)
+        pq = PriorityQueue(redis_client=pipe)
+        index = BetIndex(redis_client=pipe)
+        for queue_name, mapping in mappings.items():
+            pq.push_many(queue_name=queue_name, mapping=mapping)
+        for index_name, mapping in index_mappings.items():
+            index.set_members(index_name=index_name, mapping=mapping)
+        return pipe
+
+    def pop_bets(self, event_id: str, team_abbrev: str, is_home_team: bool, count: int) -> [Bet]:
+        """
+        Pops up to count bets from the top of the queue in one round trip.
+        """
+        queue_name = self.queue_name(event_id, team_abbrev)
         if is_home_team:
-            values = self._pq.pop_min(queue_name=queue_name)
+            values = self._pq.pop_min(queue_name=queue_name, count=count)
         else:
-            values = self._pq.pop_max(queue_name=queue_name)
+            values = self._pq.pop_max(queue_name=queue_name, count=count)
+        return self._decode_popped(values=values, event_id=event_id, team_abbrev=team_abbrev)
 
-        value = next(iter(values), None)
-        if not value:
-            return None
+    def _decode_popped(self, values: list, event_id: str, team_abbrev: str) -> [Bet]:
+        bets = self._decode_peeked(values=values, event_id=event_id, team_abbrev=team_abbrev)
+        self._popped_bet_ids.setdefault(self.index_name(event_id, team_abbrev), set()).update(map(self.index_field, bets))
+        for bet in bets:
+            self._add_level_delta(bet=bet, sign=-1)
+        return bets
+
+    def peek_bets(self, event_id: str, team_abbrev: str, is_home_team: bool, start: int, count: int) -> [Bet]:
+        """
+        Reads up to count bets from position start in pop order without removing them.
+        """
+        queue_name = self.queue_name(event_id, team_abbrev)
+        if is_home_team:
+            values = self._pq.peek_min(queue_name=queue_name, start=start, count=count)
+        else:
+            values = self._pq.peek_max(queue_name=queue_name, start=start, count=count)
+        return self._decode_peeked(values=values, event_id=event_id, team_abbrev=team_abbrev)
+
+    @staticmethod
+    def _decode_peeked(values: list, event_id: str, team_abbrev: str) -> [Bet]:
+        return [decode_member(data=data, event_id=event_id, team_abbrev=team_abbrev, score=score) for data, score in values]
+
+    def pop_bet(self, event_id: str, team_abbrev: str, is_home_team: bool) -> Bet:
+        return next(iter(self.pop_bets(event_id=event_id, team_abbrev=team_abbrev, is_home_team=is_home_team, count=1)), None)
 
-        data, score = value
-        bet = Bet(**loads(data.decode("utf-8")))
-        return bet
+    def purge_bets(self, event_id: str, home_team_abbrev: str, away_team_abbrev: str) -> [Bet]:
+        """
+        Reads and deletes both queues of an event in a single transaction.
+
+        :return: all bets that were on the queues, home bets in pop_min order followed by away bets in pop_max order
+        """
+        pipe = self._purge_pipeline(
+            event_id=event_id,
+            home_team_abbrev=home_team_abbrev,
+            away_team_abbrev=away_team_abbrev,
+            pipe=self._fenced_pipeline(event_id=event_id)
+        )
+        results = self._execute_fenced(pipe=pipe, event_id=event_id)
+        return self._decode_purged(results=results, event_id=event_id, home_team_abbrev=home_team_abbrev, away_team_abbrev=away_team_abbrev)
+
+    def _purge_pipeline(self, event_id: str, home_team_abbrev: str, away_team_abbrev: str, pipe=None):
+        home_queue_name = self.queue_name(event_id, home_team_abbrev)
+        away_queue_name = self.queue_name(event_id, away_team_abbrev)
+        home_index_name = self.index_name(event_id, home_team_abbrev)
+        away_index_name = self.index_name(event_id, away_team_abbrev)
+        home_levels_name = self.levels_name(event_id, home_team_abbrev)
+        away_levels_name = self.levels_name(event_id, away_team_abbrev)
+        self._popped_bet_ids.pop(home_index_name, None)
+        self._popped_bet_ids.pop(away_index_name, None)
+        self._level_deltas.pop(home_levels_name, None)
+        self._level_deltas.pop(away_levels_name, None)
+        if pipe is None:
+            pipe = self._r.pipeline(transaction=True)
+        pq = PriorityQueue(redis_client=pipe)
+        pq.get_all_items(queue_name=home_queue_name)
+        pq.get_all_items(queue_name=away_queue_name)
+        pipe.delete(home_queue_name, away_queue_name, home_index_name, away_index_name, home_levels_name, away_levels_name)
+        return pipe
+
+    @staticmethod
+    def _decode_purged(results: list, event_id: str, home_team_abbrev: str, away_team_abbrev: str) -> [Bet]:
+        home_values, away_values, _ = results
+        return (
+            [decode_member(data=data, event_id=event_id, team_abbrev=home_team_abbrev, score=score) for data, score in home_values] +
+            [decode_member(data=data, event_id=event_id, team_abbrev=away_team_abbrev, score=score) for data, score in away_values[::-1]]
+        )
 
     def get_status(self, event_id: str) -> StatusDetails:
-        res = self._r.get(name=f"event:{event_id}")
-        status_details = StatusDetails(**loads(res.decode("utf-8"))) if res else None
+        status_details = self._cached_status(event_id=event_id)
+        if status_details is not None:
+            return status_details
+        return self._decode_status(event_id=event_id, res=self._r.get(name=self.status_name(event_id)))
+
+    def _cached_status(self, event_id: str) -> StatusDetails:
+        if self._status_cache is None:
+            return None
+        return self._status_cache.get(event_id=event_id)
+
+    def _decode_status(self, event_id: str, res: bytes) -> StatusDetails:
+        status_details = StatusDetails(**codec.loads(res)) if res else None
+        if status_details is not None and self._status_cache is not None:
+            self._status_cache.put(event_id=event_id, status_details=status_details)
         return status_details
 
     def remove_bet(self, bet: Bet) -> Bet:
-        queue_name = f"pq:{bet.event_id}:{bet.on_team_abbrev}"
+        queue_name = self.queue_name(bet.event_id, bet.on_team_abbrev)
+        index_name = self.index_name(bet.event_id, bet.on_team_abbrev)
+        data = self._index.get_member(index_name=index_name, bet_id=self.index_field(bet))
+        if data is None and self._legacy_cancel_scan:
+            # bets submitted before the index existed are only found by score
+            data = self._find_member_by_score(queue_name=queue_name, bet=bet)
+        if data is None:
+            return None
+        pipe = self._remove_pipeline(bet=bet, data=data, pipe=self._fenced_pipeline(event_id=bet.event_id))
+        return self._decode_removed(bet=bet, data=data, results=self._execute_fenced(pipe=pipe, event_id=bet.event_id))
+
+    def _remove_pipeline(self, bet: Bet, data: bytes, pipe=None):
+        queue_name = self.queue_name(bet.event_id, bet.on_team_abbrev)
+        index_name = self.index_name(bet.event_id, bet.on_team_abbrev)
+        if pipe is None:
+            pipe = self._r.pipeline(transaction=True)
+        pq = PriorityQueue(redis_client=pipe)
+        pq.get_score(queue_name, data)
+        pq.remove_items(queue_name, data)
+        BetIndex(redis_client=pipe).remove(index_name, self.index_field(bet))
+        return pipe
+
+    def _decode_removed(self, bet: Bet, data: bytes, results: list) -> Bet:
+        score, removed_count, _ = results
+        if not removed_count:
+            return None
+        removed_bet = decode_member(data=data, event_id=bet.event_id, team_abbrev=bet.on_team_abbrev, score=score)
+        self._add_level_delta(bet=removed_bet, sign=-1)
+        return removed_bet
+
+    def _fenced_pipeline(self, event_id: str):
+        """
+        Cancels and purges write through plain transactions, so instead of the
+        match script's check they watch the event's lease. The transaction
+        only runs while the lease is the one this task last held.
+        """
+        pipe = self._r.pipeline(transaction=True)
+        if self._event_leases is None:
+            return pipe
+        lease_name = EventLeases.lease_name(event_id)
+        pipe.watch(lease_name)
+        # a watching pipeline runs commands right away until multi
+        if not self._holds_lease(event_id=event_id, held=pipe.get(lease_name)):
+            pipe.reset()
+            raise self._lease_lost(event_id=event_id)
+        pipe.multi()
+        return pipe
+
+    def _holds_lease(self, event_id: str, held) -> bool:
+        held = held.decode() if isinstance(held, bytes) else held
+        return held == self._event_leases.value(event_id)
+
+    def _execute_fenced(self, pipe, event_id: str) -> list:
+        try:
+            return pipe.execute()
+        except WatchError:
+            raise self._lease_lost(event_id=event_id)
+
+    @staticmethod
+    def _lease_lost(event_id: str) -> LeaseLostError:
+        return LeaseLostError(f"Lease on event {event_id} is no longer held")
+
+    def _find_member_by_score(self, queue_name: str, bet: Bet):
         values = self._pq.get_items_in_range(queue_name=queue_name, min_score=bet.odds, max_score=bet.odds)
+        return self._member_with_bet_id(values=values, bet=bet)
+
+    @staticmethod
+    def _member_with_bet_id(values: list, bet: Bet):
         for value in values:
             data, score = value
-            potential_match_bet = Bet(**loads(data.decode("utf-8")))
-            if potential_match_bet.bet_id == bet.bet_id:
-                self._pq.remove_items(queue_name, str(potential_match_bet))
-                return potential_match_bet
+            if decode_member(data=data, event_id=bet.event_id, team_abbrev=bet.on_team_abbrev, score=score).bet_id == bet.bet_id:
+                return data
         return None
+
+    def match_bet(self, bet: Bet, other_team_abbrev: str, other_is_home: bool, is_market: bool) -> (bool, list):
+        """
+        Sweeps the other team's queue for the bet atomically in a single EVALSHA.
+
+        :return: whether the bet could be matched and a list of fills in the form
+            (popped_bet, bet_amount, popped_bet_amount, bet_remaining, popped_bet_remaining)
+            where popped_bet is the resting bet as it was before the fill
+        """
+        if self._match_script is None:
+            self._match_script = self._r.register_script(MATCH_SCRIPT)
+        return self._decode_fills(
+            res=self._match_script(**self._match_script_call(bet=bet, other_team_abbrev=other_team_abbrev, other_is_home=other_is_home, is_market=is_market)),
+            bet=bet,
+            other_team_abbrev=other_team_abbrev
+        )
+
+    def _match_script_call(self, bet: Bet, other_team_abbrev: str, other_is_home: bool, is_market: bool) -> map:
+        return dict(
+            keys=[
+                self.queue_name(bet.event_id, other_team_abbrev),
+                self.queue_name(bet.event_id, bet.on_team_abbrev),
+                self.index_name(bet.event_id, other_team_abbrev),
+                self.index_name(bet.event_id, bet.on_team_abbrev),
+                self.levels_name(bet.event_id, other_team_abbrev),
+                self.levels_name(bet.event_id, bet.on_team_abbrev),
+                EventLeases.lease_name(bet.event_id)
+            ],
+            args=[
+                "1" if other_is_home else "0",
+                "1" if is_market else "0",
+                encode_member(bet=bet, encoding=self._member_encoding),
+                bet.amount,
+                "" if bet.odds is None else bet.odds,
+                self.index_field(bet),
+                "" if self._event_leases is None else self._event_leases.value(bet.event_id)
+            ]
+        )
+
+    @staticmethod
+    def _decode_fills(res: list, bet: Bet, other_team_abbrev: str) -> (bool, list):
+        if res[0] == -1:
+            raise Exchange._lease_lost(event_id=bet.event_id)
+        is_filled, fills = res[0] == 1, res[1:]
+        return is_filled, [
+            (decode_member(data=member, event_id=bet.event_id, team_abbrev=other_team_abbrev, score=float(score)), *map(codec.loads, amounts))
+            for member, score, *amounts in fills
+        ]
+
+    def book_depths(self, books: [(str, str)]) -> map:
+        """
+        :param books: (event_id, team_abbrev) of each book
+        :return: number of resting bets by (event_id, team_abbrev)
+        """
+        pipe = self._r.pipeline(transaction=False)
+        pq = PriorityQueue(redis_client=pipe)
+        for event_id, team_abbrev in books:
+            pq.count(queue_name=self.queue_name(event_id, team_abbrev))
+        return dict(zip(books, pipe.execute()))
+
+    def book_levels(self, event_id: str, team_abbrev: str, is_home_team: bool, depth: int = None) -> [PriceLevel]:
+        """
+        Reads the price levels of a queue from its aggregates, without scanning the queue.
+
+        :param depth: number of levels to return, all when None
+        :return: levels best first, in the order pop_bets takes them
+        """
+        values = PriceLevels(redis_client=self._r).get_all(levels_name=self.levels_name(event_id, team_abbrev))
+        return self._sorted_levels(values=values, is_home_team=is_home_team, depth=depth)
+
+    def top_of_book(self, event_id: str, team_abbrev: str, is_home_team: bool) -> PriceLevel:
+        return next(iter(self.book_levels(event_id=event_id, team_abbrev=team_abbrev, is_home_team=is_home_team, depth=1)), None)
+
+    def books_levels(self, books: [(str, str, bool)], depth: int = None) -> map:
+        """
+        Reads the price levels of several queues in one round trip.
+
+        :param books: (event_id, team_abbrev, is_home_team) of each queue
+        :return: levels best first by (event_id, team_abbrev)
+        """
+        pipe = self._r.pipeline(transaction=False)
+        levels = PriceLevels(redis_client=pipe)
+        for event_id, team_abbrev, _ in books:
+            levels.get_all(levels_name=self.levels_name(event_id, team_abbrev))
+        return {
+            (event_id, team_abbrev): self._sorted_levels(values=values, is_home_team=is_home_team, depth=depth)
+            for (event_id, team_abbrev, is_home_team), values in zip(books, pipe.execute())
+        }
+
+    @staticmethod
+    def _sorted_levels(values: map, is_home_team: bool, depth: int) -> [PriceLevel]:
+        levels = sorted(PriceLevels.decode(values=values), key=lambda level: level.odds, reverse=not is_home_team)
+        return levels if depth is None else levels[:depth]
+
+    def rebuild_levels(self, event_id: str, team_abbrev: str):
+        """
+        Recomputes the price levels of a queue from its members, for books
+        written before the levels were kept, see scripts/migrate_keys.py.
+
+        The queue is watched while it is read, so the levels are only
+        replaced if nothing changed the queue in between and it is read
+        again otherwise.
+        """
+        def rebuild(pipe):
+            # a watching pipeline runs commands right away until multi
+            items = PriorityQueue(redis_client=pipe).get_all_items(queue_name=self.queue_name(event_id, team_abbrev))
+            self._write_rebuilt_levels(pipe=pipe, event_id=event_id, team_abbrev=team_abbrev, items=items)
+
+        self._r.transaction(rebuild, self.queue_name(event_id, team_abbrev))
+
+    def _write_rebuilt_levels(self, pipe, event_id: str, team_abbrev: str, items: list):
+        levels_name = self.levels_name(event_id, team_abbrev)
+        deltas = {}
+        for data, score in items:
+            bet = decode_member(data=data, event_id=event_id, team_abbrev=team_abbrev, score=score)
+            cents, count = deltas.get(int(bet.odds), (0, 0))
+            deltas[int(bet.odds)] = (cents + round(bet.amount * 100), count + 1)
+        self._level_deltas.pop(levels_name, None)
+        pipe.multi()
+        pipe.delete(levels_name)
+        PriceLevels(redis_client=pipe).add(levels_name=levels_name, deltas=deltas)
+
+    def rebuild_index(self, event_id: str, team_abbrev: str):
+        """
+        Indexes the members of a queue by bet_id, for books written before the
+        index was kept, see scripts/migrate_keys.py. Watched like rebuild_levels.
+        """
+        def rebuild(pipe):
+            items = PriorityQueue(redis_client=pipe).get_all_items(queue_name=self.queue_name(event_id, team_abbrev))
+            self._write_rebuilt_index(pipe=pipe, event_id=event_id, team_abbrev=team_abbrev, items=items)
+
+        self._r.transaction(rebuild, self.queue_name(event_id, team_abbrev))
+
+    def _write_rebuilt_index(self, pipe, event_id: str, team_abbrev: str, items: list):
+        index_name = self.index_name(event_id, team_abbrev)
+        mapping = {
+            self.index_field(decode_member(data=data, event_id=event_id, team_abbrev=team_abbrev, score=score)): data
+            for data, score in items
+        }
+        self._popped_bet_ids.pop(index_name, None)
+        pipe.multi()
+        pipe.delete(index_name)
+        if mapping:
+            BetIndex(redis_client=pipe).set_members(index_name=index_name, mapping=mapping)
+
+    def flush(self):
+        pipe = self._flush_pipeline()
+        if pipe is not None:
+            pipe.execute()
+
+    def _flush_pipeline(self):
+        if not self._has_deferred_writes():
+            return None
+        pipe = self._r.pipeline(transaction=True)
+        self._write_deferred(pipe=pipe)
+        return pipe
+
+    def _has_deferred_writes(self) -> bool:
+        return any(self._popped_bet_ids.values()) or bool(self._level_deltas)
+
+    def _write_deferred(self, pipe):
+        self._remove_popped_bet_ids(pipe=pipe)
+        self._write_level_deltas(pipe=pipe)
+
+    def _remove_popped_bet_ids(self, pipe):
+        index = BetIndex(redis_client=pipe)
+        for index_name, bet_ids in self._popped_bet_ids.items():
+            if bet_ids:
+                index.remove(index_name, *bet_ids)
+        self._popped_bet_ids = {}
+
+    def _add_level_delta(self, bet: Bet, sign: int):
+        deltas = self._level_deltas.setdefault(self.levels_name(bet.event_id, bet.on_team_abbrev), {})
+        cents, count = deltas.get(int(bet.odds), (0, 0))
+        deltas[int(bet.odds)] = (cents + sign * round(bet.amount * 100), count + sign)
+
+    def _write_level_deltas(self, pipe):
+        levels = PriceLevels(redis_client=pipe)
+        for levels_name, deltas in self._level_deltas.items():
+            levels.add(levels_name=levels_name, deltas=deltas)
+        self._level_deltas = {}
+
+    def is_handled(self, event_id: str, key: str) -> bool:
+        return bool(HandledRecords(redis_client=self._r).contains(handled_name=self.handled_name(event_id), key=key))
+
+    def mark_handled(self, event_id: str, key: str, ttl_seconds: float):
+        """
+        Holds the key until flush_handled, which the executor calls once the
+        record's executions are published. The mark is a write of its own
+        after the book changes on every engine, including the lua sweep, so
+        a record that fails in between is handled again when replayed.
+        """
+        handled_name = self.handled_name(event_id)
+        record_keys, _ = self._handled_keys.get(handled_name, (set(), None))
+        record_keys.add(key)
+        self._handled_keys[handled_name] = (record_keys, ttl_seconds)
+
+    def flush_handled(self):
+        pipe = self._flush_handled_pipeline()
+        if pipe is not None:
+            pipe.execute()
+
+    def _flush_handled_pipeline(self):
+        if not self._handled_keys:
+            return None
+        pipe = self._r.pipeline(transaction=True)
+        self._write_handled_keys(pipe=pipe)
+        return pipe
+
+    def discard_handled(self):
+        """
+        Drops the keys held since the last flush_handled, so their records are handled again when replayed.
+        """
+        self._handled_keys = {}
+
+    def unmark_handled(self, event_id: str, key: str):
+        """
+        Drops one held key, of a record that failed before the others held with it.
+        """
+        handled_name = self.handled_name(event_id)
+        record_keys, _ = self._handled_keys.get(handled_name, (set(), None))
+        record_keys.discard(key)
+        if not record_keys:
+            self._handled_keys.pop(handled_name, None)
+
+    def _write_handled_keys(self, pipe):
+        handled_records = HandledRecords(redis_client=pipe)
+        for handled_name, (record_keys, ttl_seconds) in self._handled_keys.items():
+            handled_records.add(handled_name=handled_name, keys=list(record_keys), ttl_seconds=ttl_seconds)
+        self._handled_keys = {}
+
+    def hold_lease(self, event_id: str) -> bool:
+        """
+        Holds the event's lease, evicting the event when the lease is new.
+
+        :return: whether the lease is new
+        """
+        if not self._event_leases.hold(event_id=event_id):
+            return False
+        self.evict_event(event_id=event_id)
+        return True
+
+    def evict_event(self, event_id: str):
+        if self._status_cache is not None:
+            self._status_cache.invalidate(event_id=event_id)
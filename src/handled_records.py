@@ -0,0 +1,18 @@
+import math
+
+
+class HandledRecords:
+    """
+    Set per event of the keys of records that have been handled, expiring
+    ttl_seconds after the last record was added.
+    """
+    def __init__(self, redis_client):
+        self._r = redis_client
+
+    def contains(self, handled_name: str, key: str):
+        return self._r.sismember(handled_name, key)
+
+    def add(self, handled_name: str, keys: [str], ttl_seconds: float):
+        self._r.sadd(handled_name, *keys)
+        # in ms so a ttl under a second does not expire the set right away
+        self._r.pexpire(handled_name, max(math.ceil(ttl_seconds * 1000), 1))
@@ -0,0 +1,226 @@
+"""
+Wrappers that report to a Metrics registry without changing what they wrap.
+
+BetExecutor only gets these when metrics are enabled, so with metrics off the
+executor, exchange and clients run exactly as before.
+"""
+from time import perf_counter
+
+from src import codec
+from src.bet_executer import BetExecutor
+from src.domain_model import ExecutedBets
+from src.event_leases import LeaseHeldError
+from src.metrics import Metrics
+
+# exchange methods reported under a shared stage, the rest under their own name
+EXCHANGE_STAGES = {
+    "submit_bet": "redis_writes",
+    "submit_bets": "redis_writes",
+    "flush": "redis_writes",
+    "flush_handled": "redis_writes"
+}
+
+
+class InstrumentedPipeline:
+    def __init__(self, metrics: Metrics, pipe):
+        self._metrics = metrics
+        self._pipe = pipe
+
+    def __getattr__(self, name: str):
+        queue_command = getattr(self._pipe, name)
+
+        def command(*args, **kwargs):
+            self._metrics.tally("redis_commands")
+            queue_command(*args, **kwargs)
+            return self
+        return command
+
+    def execute(self):
+        self._metrics.tally("redis_round_trips")
+        return self._pipe.execute()
+
+
+class InstrumentedRedis:
+    """
+    Counts round trips and commands: a pipeline is one round trip for all of
+    its commands and a script call is one round trip and one command.
+    """
+    def __init__(self, client, metrics: Metrics):
+        self._client = client
+        self._metrics = metrics
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._client, name)
+        if name == "pipeline":
+            return lambda transaction=True: InstrumentedPipeline(metrics=self._metrics, pipe=attr(transaction=transaction))
+        if name == "register_script":
+            return lambda script: self._command(attr(script))
+        if name in ("pubsub", "connection_pool"):
+            return attr
+        return self._command(attr)
+
+    def _command(self, call):
+        def command(*args, **kwargs):
+            self._metrics.tally("redis_round_trips")
+            self._metrics.tally("redis_commands")
+            return call(*args, **kwargs)
+        return command
+
+
+class InstrumentedKinesis:
+    def __init__(self, client, metrics: Metrics):
+        self._client = client
+        self._metrics = metrics
+
+    def __getattr__(self, name: str):
+        call = getattr(self._client, name)
+
+        def command(*args, **kwargs):
+            self._metrics.tally("kinesis_calls")
+            return call(*args, **kwargs)
+        return command
+
+
+class InstrumentedStage:
+    """
+    Times every method call of the wrapped object as a stage of the record.
+    """
+    def __init__(self, target, metrics: Metrics, stages: map = None, default_stage: str = None):
+        self._target = target
+        self._metrics = metrics
+        self._stages = stages or {}
+        self._default_stage = default_stage
+
+    def __getattr__(self, name: str):
+        call = getattr(self._target, name)
+        if not callable(call):
+            return call
+        stage = self._stages.get(name, self._default_stage or name)
+
+        def timed(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return call(*args, **kwargs)
+            finally:
+                self._metrics.tally_stage(stage=stage, seconds=perf_counter() - started)
+        return timed
+
+
+class InstrumentedBetExecutor(BetExecutor):
+    """
+    BetExecutor that records per action latency, per stage time, redis and
+    kinesis calls, fills and levels swept per record, and the resting bets on
+    the books of the events it handles. Records handled in a batch are
+    observed one by one too.
+    """
+    def __init__(self, metrics: Metrics, **kwargs):
+        super().__init__(**kwargs)
+        self._metrics = metrics
+        self._unwrapped_exchange = self._exchange
+        self._exchange = InstrumentedStage(target=self._exchange, metrics=metrics, stages=EXCHANGE_STAGES)
+        self._publisher = InstrumentedStage(target=self._publisher, metrics=metrics, default_stage="publish")
+        # event_id -> (home_team_abbrev, away_team_abbrev) of the books to report depth for
+        self._books = {}
+        # (action, seconds, tallies) of the records of the group being handled, observed once the group is flushed
+        self._group_records = None
+        metrics.add_collector(self._collect_book_depth)
+
+    def handle_record(self, record: map):
+        self._handle_observed(record=record)
+
+    def handle_data(self, data: map, sequence_number: str = None):
+        self._handle_observed(data=data, sequence_number=sequence_number)
+
+    def _handle_observed(self, record: map = None, data: map = None, sequence_number: str = None):
+        """
+        :param record: decoded as part of the record when data is not given
+        """
+        # parked records are observed on their own, before this record's tallies start
+        self.retry_parked()
+        self._metrics.start_record()
+        started = perf_counter()
+        action = None
+        try:
+            if data is None:
+                data = codec.loads(record['Data'])
+                sequence_number = record.get("SequenceNumber")
+                self._metrics.tally_stage(stage="decode", seconds=perf_counter() - started)
+            action = data["action"]
+            self._handle_data(data=data, sequence_number=sequence_number)
+        except Exception:
+            self._metrics.increment("record_errors", action=action)
+            raise
+        finally:
+            self._metrics.end_record(action=action, seconds=perf_counter() - started)
+            self._metrics.increment("records", action=action)
+
+    def _handle_group(self, event_id: str, group: [(map, str)]):
+        self._group_records = []
+        try:
+            super()._handle_group(event_id=event_id, group=group)
+        finally:
+            self._group_records = None
+
+    def _handle_in_group(self, data: map, statuses: map):
+        self._metrics.start_record()
+        started = perf_counter()
+        action = data["action"]
+        parked = False
+        try:
+            super()._handle_in_group(data=data, statuses=statuses)
+        except LeaseHeldError:
+            # observed once it is handled
+            parked = True
+            raise
+        except Exception:
+            self._metrics.increment("record_errors", action=action)
+            raise
+        finally:
+            tallies = self._metrics.take_tallies()
+            if not parked:
+                self._group_records.append((action, perf_counter() - started, tallies))
+
+    def _flush(self, event_id: str):
+        if self._group_records is None:
+            super()._flush(event_id=event_id)
+            return
+        # the records of a group share one flush, each is observed with an even share of it
+        self._metrics.start_record()
+        started = perf_counter()
+        try:
+            super()._flush(event_id=event_id)
+        finally:
+            seconds, tallies = perf_counter() - started, self._metrics.take_tallies()
+            records, self._group_records = self._group_records, []
+            for action, record_seconds, record_tallies in records:
+                for key, value in tallies.items():
+                    record_tallies[key] = record_tallies.get(key, 0) + value / len(records)
+                self._metrics.end_record(action=action, seconds=record_seconds + seconds / len(records), tallies=record_tallies)
+                self._metrics.increment("records", action=action)
+
+    def _run(self, steps, statuses: map = None):
+        def watched_steps():
+            # remembers the books of every event seen until it is evicted
+            result = None
+            while True:
+                try:
+                    method, kwargs = steps.send(result)
+                except StopIteration:
+                    return
+                result = yield method, kwargs
+                if method == "get_status" and result is not None:
+                    self._books[kwargs["event_id"]] = (result.home_team_abbrev, result.away_team_abbrev)
+                elif method == "evict_event":
+                    self._books.pop(kwargs["event_id"], None)
+
+        super()._run(steps=watched_steps(), statuses=statuses)
+
+    def _record_fills(self, executed_bets: [ExecutedBets]):
+        self._metrics.tally("fills", len(executed_bets))
+        self._metrics.tally("levels_swept", len({executed_bet.odds for executed_bet in executed_bets}))
+
+    def _collect_book_depth(self) -> map:
+        # summed over every event, a gauge per event would be a series per game ever played
+        books = [(event_id, team_abbrev) for event_id, team_abbrevs in list(self._books.items()) for team_abbrev in team_abbrevs]
+        depths = self._unwrapped_exchange.book_depths(books=books) if books else {}
+        return {"book_depth": sum(depths.values()), "books": len(depths)}
@@ -0,0 +1,51 @@
+# Every redis key of an event is "{prefix}:{event_id}" with an optional
+# ":{team_abbrev}". The hash tagged layout wraps the event_id in braces so
+# redis cluster hashes only the event_id and all keys of an event share a
+# slot, which the per event transactions and scripts need there.
+LEGACY = "legacy"
+HASH_TAGGED = "hash-tagged"
+
+# prefixes of the keys that belong to an event, see scripts/migrate_keys.py
+EVENT_KEY_PREFIXES = ("pq", "idx", "lvl", "handled", "event", "lease", "fence")
+
+_layout = LEGACY
+
+
+def set_layout(layout: str = LEGACY):
+    """
+    Process wide, set once at startup before any key is used.
+
+    :param layout: KeyLayout = Literal["legacy", "hash-tagged"]
+    """
+    global _layout
+    if layout not in (LEGACY, HASH_TAGGED):
+        raise ValueError(f"Unknown key layout {layout}")
+    _layout = layout
+
+
+def get_layout() -> str:
+    return _layout
+
+
+def event_key(prefix: str, event_id: str, team_abbrev: str = None, layout: str = None) -> str:
+    if (layout or _layout) == HASH_TAGGED:
+        event_id = f"{{{event_id}}}"
+    if team_abbrev is None:
+        return f"{prefix}:{event_id}"
+    return f"{prefix}:{event_id}:{team_abbrev}"
+
+
+def parse_event_key(key: str) -> (str, str, str):
+    """
+    Reads a key of either layout.
+
+    :return: prefix, event_id and team_abbrev (None for keys without one)
+    """
+    prefix, rest = key.split(":", 1)
+    if rest.startswith("{"):
+        event_id, rest = rest[1:].split("}", 1)
+        team_abbrev = rest[1:] or None
+    else:
+        event_id, _, team_abbrev = rest.partition(":")
+        team_abbrev = team_abbrev or None
+    return prefix, event_id, team_abbrev
@@ -1,10 +1,17 @@
+import atexit
 import logging
 import sys
 import uuid
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from threading import Lock
 # from typing import Literal
 #
 # LogLevel = Literal["INFO", "WARNING", "DEBUG"]
 
+_handler_lock = Lock()
+_queue_handler = None
+
 
 class LoggerFactory:
     @staticmethod
@@ -13,13 +20,22 @@ class LoggerFactory:
 
 
 class Logger:
+    """
+    Log calls take %-style args and key=value fields, both only formatted when
+    the level is enabled. Records are handed to a background thread that
+    writes them to stdout, so a slow stdout never holds up the caller.
+
+        logger.debug("popped bet %s", bet_id, event_id=event_id)
+    """
     def __init__(self, name: str, log_level: str = "INFO"):
         self._logger = logging.getLogger(name=name)
         logging_level = self._get_log_level(log_level)
         self._logger.setLevel(logging_level)
-        handler = self._get_logging_handler(logging_level)
-        self._logger.addHandler(handler)
-        self._extras = {"RUN_ID": uuid.uuid4()}
+        handler = self._get_logging_handler()
+        if handler not in self._logger.handlers:
+            self._logger.addHandler(handler)
+        self._run_id = uuid.uuid4()
+        self._extras = {"RUN_ID": self._run_id, "fields": None}
 
     @staticmethod
     def _get_log_level(log_level: str):
@@ -31,26 +47,69 @@ class Logger:
         return log_level_lookup.get(log_level, logging.INFO)
 
     @staticmethod
-    def _get_logging_handler(logging_level):
-        handler = logging.StreamHandler(sys.stdout)
-        handler.setLevel(logging_level)
-        formatter = logging.Formatter('[%(levelname)s] created=%(asctime)sZ module=%(name)s run_id=%(RUN_ID)s message=%(message)s')
-        formatter.default_time_format = "%Y-%m-%dT%H:%M:%S"
-        formatter.default_msec_format = "%s.%03d"
-        handler.setFormatter(formatter)
-        return handler
+    def _get_logging_handler():
+        global _queue_handler
+        with _handler_lock:
+            if _queue_handler is None:
+                handler = logging.StreamHandler(sys.stdout)
+                formatter = logging.Formatter('[%(levelname)s] created=%(asctime)sZ module=%(name)s run_id=%(RUN_ID)s message=%(message)s%(fields)s')
+                formatter.default_time_format = "%Y-%m-%dT%H:%M:%S"
+                formatter.default_msec_format = "%s.%03d"
+                handler.setFormatter(formatter)
+                queue = SimpleQueue()
+                listener = QueueListener(queue, handler)
+                listener.start()
+                atexit.register(listener.stop)
+                _queue_handler = FieldsQueueHandler(queue)
+            return _queue_handler
+
+    def is_enabled_for(self, log_level: str) -> bool:
+        """
+        Guard for log calls whose arguments are costly to build.
+        """
+        return self._logger.isEnabledFor(logging.getLevelName(log_level))
+
+    def _extra(self, fields: map) -> map:
+        return {"RUN_ID": self._run_id, "fields": fields} if fields else self._extras
+
+    def debug(self, msg: str, *args, **fields):
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(msg, *args, extra=self._extra(fields))
+
+    def info(self, msg: str, *args, **fields):
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info(msg, *args, extra=self._extra(fields))
+
+    def warning(self, msg: str, *args, **fields):
+        self._logger.warning(msg, *args, extra=self._extra(fields))
+
+    def error(self, msg: str, *args, **fields):
+        self._logger.error(msg, *args, exc_info=True, extra=self._extra(fields))
+
+    def critical(self, msg: str, *args, **fields):
+        self._logger.critical(msg, *args, exc_info=True, extra=self._extra(fields))
+
 
-    def debug(self, msg: str, **kwargs):
-        self._logger.debug(msg=msg, extra=self._extras)
+class FieldsQueueHandler(QueueHandler):
+    """
+    Formats the message and fields on the calling thread, as the objects they
+    refer to may change once the call returns, and leaves the rest of the
+    line and the write to the listener thread.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = super().prepare(record)
+        record.fields = format_fields(getattr(record, "fields", None))
+        return record
 
-    def info(self, msg: str, **kwargs):
-        self._logger.info(msg=msg, extra=self._extras)
 
-    def warning(self, msg: str, **kwargs):
-        self._logger.warning(msg=msg, extra=self._extras)
+def format_fields(fields: map) -> str:
+    if not fields:
+        return ""
+    return "".join(f" {key}={_field_value(value)}" for key, value in fields.items())
 
-    def error(self, msg: str, **kwargs):
-        self._logger.error(msg=msg, exc_info=True, extra=self._extras)
 
-    def critical(self, msg: str, **kwargs):
-        self._logger.critical(msg=msg, exc_info=True, extra=self._extras)
+def _field_value(value) -> str:
+    value = str(value)
+    if not value or any(c.isspace() or c in '"=' for c in value):
+        return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+    return value
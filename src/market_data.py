@@ -0,0 +1,140 @@
+from collections import OrderedDict
+from threading import Event, Lock, Thread
+
+from src import codec
+from src.domain_model import PriceLevel
+from src.exchange import Exchange
+from src.logger import Logger
+from src.publisher import KinesisPublisher
+from src.status_cache import StatusCache
+from src.utils import get_current_utc_iso
+
+
+class MarketDataPublisher:
+    """
+    Publishes depth snapshots of the books of events whose records were handled.
+
+    Executors only mark an event once its record is written back to redis.
+    A background thread wakes every interval_ms, reads the price levels of
+    the marked events in one pipeline and publishes a snapshot for each
+    event whose levels changed, so a burst on one event costs at most one
+    snapshot per interval. Marked events and the last snapshot per event are
+    both capped at max_events.
+    """
+    def __init__(
+        self,
+        logger: Logger,
+        redis_client,
+        kinesis_client,
+        stream_name: str,
+        interval_ms: float = 100,
+        depth: int = 5,
+        max_events: int = 10000,
+        status_cache: StatusCache = None
+    ):
+        """
+        :param depth: number of price levels per side in a snapshot
+        :param max_events: marks past this many pending events are dropped until the next snapshot
+        """
+        self._logger = logger
+        self._exchange = Exchange(redis_client=redis_client, status_cache=status_cache)
+        self._publisher = KinesisPublisher(logger=logger, kinesis_client=kinesis_client, stream_name=stream_name)
+        self._interval_ms = interval_ms
+        self._depth = depth
+        self._max_events = max_events
+        self._lock = Lock()
+        self._dirty = {}
+        self._dropped = 0
+        # event_id -> (home_team_abbrev, away_team_abbrev, last published levels), least recently published first
+        self._books = OrderedDict()
+        self._wake = Event()
+        self._closed = Event()
+        self._thread = None
+
+    def mark(self, event_id: str):
+        with self._lock:
+            if event_id in self._dirty:
+                return
+            if len(self._dirty) >= self._max_events:
+                self._dropped += 1
+                self._wake.set()
+                return
+            self._dirty[event_id] = None
+
+    def start(self) -> Thread:
+        self._thread = Thread(target=self._publish_every_interval, name="market-data", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def close(self):
+        self._closed.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.publish_changed()
+
+    def _publish_every_interval(self):
+        while not self._closed.is_set():
+            self._wake.wait(timeout=self._interval_ms / 1000)
+            self._wake.clear()
+            try:
+                self.publish_changed()
+            except Exception as e:
+                self._logger.error("Market data error: %s", e)
+
+    def publish_changed(self):
+        with self._lock:
+            event_ids, self._dirty = list(self._dirty), {}
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            self._logger.warning("Dropped market data marks", marks=dropped, max_events=self._max_events)
+        teams = {}
+        for event_id in event_ids:
+            event_teams = self._teams(event_id=event_id)
+            if event_teams is not None:
+                teams[event_id] = event_teams
+        if not teams:
+            return
+        books = [
+            (event_id, team_abbrev, is_home_team)
+            for event_id, (home_team_abbrev, away_team_abbrev) in teams.items()
+            for team_abbrev, is_home_team in ((home_team_abbrev, True), (away_team_abbrev, False))
+        ]
+        levels = self._exchange.books_levels(books=books, depth=self._depth)
+        for event_id, (home_team_abbrev, away_team_abbrev) in teams.items():
+            book_levels = (levels[(event_id, home_team_abbrev)], levels[(event_id, away_team_abbrev)])
+            last = self._books.get(event_id)
+            if last is not None and last[2] == book_levels:
+                continue
+            self._remember(event_id=event_id, book=(home_team_abbrev, away_team_abbrev, book_levels))
+            self._publisher.publish(
+                data=self._snapshot(event_id, home_team_abbrev, away_team_abbrev, *book_levels),
+                partition_key=event_id
+            )
+        self._publisher.flush()
+
+    def _teams(self, event_id: str) -> (str, str):
+        book = self._books.get(event_id)
+        if book is not None:
+            return book[:2]
+        status_details = self._exchange.get_status(event_id=event_id)
+        if status_details is None:
+            return None
+        return status_details.home_team_abbrev, status_details.away_team_abbrev
+
+    def _remember(self, event_id: str, book: tuple):
+        self._books[event_id] = book
+        self._books.move_to_end(event_id)
+        if len(self._books) > self._max_events:
+            self._books.popitem(last=False)
+
+    @staticmethod
+    def _snapshot(event_id: str, home_team_abbrev: str, away_team_abbrev: str, home_levels: [PriceLevel], away_levels: [PriceLevel]) -> bytes:
+        return codec.dumps_bytes({
+            "event_id": event_id,
+            "timestamp": get_current_utc_iso(),
+            "home_team_abbrev": home_team_abbrev,
+            "away_team_abbrev": away_team_abbrev,
+            "home": [{"odds": level.odds, "amount": level.amount, "count": level.count} for level in home_levels],
+            "away": [{"odds": level.odds, "amount": level.amount, "count": level.count} for level in away_levels]
+        })
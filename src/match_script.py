@@ -0,0 +1,271 @@
+# Runs an entire limit or market sweep server side so it costs one round trip
+# and can not interleave with another executor.
+#
+# KEYS[1] = queue of the other team, KEYS[2] = queue of the bet's own team
+# KEYS[3] = bet index of the other team, KEYS[4] = bet index of the bet's own team
+# KEYS[5] = price levels of the other team, KEYS[6] = price levels of the bet's own team
+# KEYS[7] = lease of the event
+# ARGV[1] = "1" to pop min from the other queue (other team is home), else max
+# ARGV[2] = "1" for a market bet, else limit
+# ARGV[3] = member of the incoming bet as written by member_codec.encode_member
+# ARGV[4] = amount of the incoming bet
+# ARGV[5] = odds of the incoming bet ("" for market bets)
+# ARGV[6] = bet index field of the incoming bet
+# ARGV[7] = lease value of the executor ("" when events are not leased)
+#
+# Returns {-1} without touching anything when ARGV[7] is not the lease in redis, else
+# {filled, {popped_member, score, bet_amount, popped_bet_amount, bet_remaining, popped_bet_remaining}, ...}
+# where all amounts are returned as the json python would write for them, so they survive the
+# lua -> redis reply conversion and amounts that are ints in python stay ints.
+# The amount math mirrors Bet.determine_amounts, including round(x, 2).
+# Members may be json or compact v1 (see member_codec) and remainders keep the encoding of the member they replace.
+MATCH_SCRIPT = """
+local other_queue = KEYS[1]
+local own_queue = KEYS[2]
+local other_index = KEYS[3]
+local own_index = KEYS[4]
+local other_levels = KEYS[5]
+local own_levels = KEYS[6]
+local pop_min = ARGV[1] == "1"
+local is_market = ARGV[2] == "1"
+local bet_member = ARGV[3]
+local remaining = tonumber(ARGV[4])
+local odds = tonumber(ARGV[5])
+local bet_field = ARGV[6]
+local lease_value = ARGV[7]
+
+if lease_value ~= "" and redis.call("GET", KEYS[7]) ~= lease_value then
+    return {-1}
+end
+
+local COMPACT_V1 = 1
+
+local function read_int64(s, offset)
+    local negative = string.byte(s, offset) >= 128
+    local n = 0
+    for i = offset, offset + 7 do
+        local b = string.byte(s, i)
+        if negative then
+            b = 255 - b
+        end
+        n = n * 256 + b
+    end
+    if negative then
+        return -n - 1
+    end
+    return n
+end
+
+local function write_int64(n)
+    local negative = n < 0
+    if negative then
+        n = -n - 1
+    end
+    local bytes = {}
+    for i = 8, 1, -1 do
+        local b = n % 256
+        n = (n - b) / 256
+        if negative then
+            b = 255 - b
+        end
+        bytes[i] = string.char(b)
+    end
+    return table.concat(bytes)
+end
+
+local function round2(x)
+    return tonumber(string.format("%.2f", x))
+end
+
+-- formats a number the same way python's json.dumps formats a float
+local function py_float(x)
+    if x == math.floor(x) and math.abs(x) < 1e16 then
+        return string.format("%.1f", x)
+    end
+    for precision = 15, 17 do
+        local s = string.format("%." .. precision .. "g", x)
+        if tonumber(s) == x then
+            return s
+        end
+    end
+end
+
+-- an amount read from an int stays an int in python until it is rounded or
+-- meets a float, so it is formatted as python would write it back
+local function amount_repr(x, is_int)
+    if is_int then
+        return string.format("%d", x)
+    end
+    return py_float(x)
+end
+
+local function is_int_repr(s)
+    return string.find(s, "[.eE]") == nil
+end
+
+local function is_compact(member)
+    return string.byte(member, 1) == COMPACT_V1
+end
+
+local function with_amount(member, amount)
+    if is_compact(member) then
+        local cents = tonumber(string.format("%.0f", amount * 100))
+        return string.sub(member, 1, 25) .. write_int64(cents) .. string.sub(member, 34)
+    end
+    local replaced = string.gsub(member, '"amount": [^,]+,', '"amount": ' .. py_float(amount) .. ',', 1)
+    return replaced
+end
+
+-- the index field is the bet_id exactly as json encoded
+local function index_field(member)
+    if is_compact(member) then
+        return string.format("%d", read_int64(member, 2))
+    end
+    return string.match(member, '"bet_id": ([^,]+),')
+end
+
+-- returns the amount and odds of a member, and whether the amount is an int
+local function decode(member, score)
+    if is_compact(member) then
+        return read_int64(member, 26) / 100, tonumber(score), false
+    end
+    local bet = cjson.decode(member)
+    return bet.amount, bet.odds, is_int_repr(string.match(member, '"amount": ([^,}]+)'))
+end
+
+-- mirrors PriceLevels.add
+local function add_level(levels, level_odds, amount, count)
+    local field = string.format("%d", level_odds)
+    redis.call("HINCRBY", levels, field .. ":cents", tonumber(string.format("%.0f", amount * 100)))
+    redis.call("HINCRBY", levels, field .. ":count", count)
+end
+
+local function pop(queue)
+    if pop_min then
+        return redis.call("ZPOPMIN", queue)
+    end
+    return redis.call("ZPOPMAX", queue)
+end
+
+-- the third value is whether the bet fills entirely, so its amount is passed through unrounded
+local function determine_amounts(bet_amount, other_amount, other_odds)
+    local bet_odds = pop_min and -other_odds or other_odds
+    local other_fill
+    if bet_odds > 0 then
+        other_fill = round2(bet_amount * (bet_odds / 100))
+    else
+        other_fill = round2(bet_amount / (math.abs(bet_odds) / 100))
+    end
+    if other_fill < other_amount then
+        return bet_amount, other_fill, true
+    end
+    local bet_fill
+    if bet_odds < 0 then
+        bet_fill = round2(other_amount * (math.abs(bet_odds) / 100))
+    else
+        bet_fill = round2(other_amount / (bet_odds / 100))
+    end
+    return bet_fill, other_amount, false
+end
+
+-- a market bet the queue can not fill is rejected before anything is popped
+local function can_fill(amount)
+    local start = 0
+    while true do
+        local entries
+        if pop_min then
+            entries = redis.call("ZRANGE", other_queue, start, start + 63, "WITHSCORES")
+        else
+            entries = redis.call("ZREVRANGE", other_queue, start, start + 63, "WITHSCORES")
+        end
+        for i = 1, #entries, 2 do
+            local other_amount, other_odds = decode(entries[i], entries[i + 1])
+            local bet_fill = determine_amounts(amount, other_amount, other_odds)
+            amount = amount - bet_fill
+            if amount <= 0 then
+                return amount == 0
+            end
+        end
+        if #entries < 128 then
+            return false
+        end
+        start = start + 64
+    end
+end
+
+local remaining_is_int = is_int_repr(ARGV[4])
+
+if is_market and not can_fill(remaining) then
+    return {0}
+end
+
+local fills = {}
+local popped = {}
+local readded = {}
+
+while remaining > 0 do
+    local entry = pop(other_queue)
+    if #entry == 0 then
+        break
+    end
+    local member, score = entry[1], entry[2]
+    local other_amount, other_odds, other_is_int = decode(member, score)
+    if not is_market and odds > other_odds then
+        redis.call("ZADD", other_queue, score, member)
+        break
+    end
+    table.insert(popped, {score, member, other_amount, other_odds})
+    redis.call("HDEL", other_index, index_field(member))
+    add_level(other_levels, other_odds, -other_amount, -1)
+
+    local bet_fill, other_fill, is_bet_filled = determine_amounts(remaining, other_amount, other_odds)
+    local bet_fill_is_int = is_bet_filled and remaining_is_int
+    local other_fill_is_int = not is_bet_filled and other_is_int
+    remaining = remaining - bet_fill
+    remaining_is_int = remaining_is_int and bet_fill_is_int
+    local other_remaining = other_amount - other_fill
+    table.insert(fills, {
+        member, score,
+        amount_repr(bet_fill, bet_fill_is_int), amount_repr(other_fill, other_fill_is_int),
+        amount_repr(remaining, remaining_is_int), amount_repr(other_remaining, other_is_int and other_fill_is_int)
+    })
+
+    if other_remaining > 0 then
+        local remaining_member = with_amount(member, other_remaining)
+        redis.call("ZADD", other_queue, score, remaining_member)
+        redis.call("HSET", other_index, index_field(member), remaining_member)
+        add_level(other_levels, other_odds, other_remaining, 1)
+        table.insert(readded, {remaining_member, other_remaining, other_odds})
+    end
+end
+
+if is_market then
+    if remaining ~= 0 then
+        -- only reached if can_fill and the sweep disagree, put the book back exactly as it was
+        for _, entry in ipairs(readded) do
+            redis.call("ZREM", other_queue, entry[1])
+            add_level(other_levels, entry[3], -entry[2], -1)
+        end
+        for _, entry in ipairs(popped) do
+            redis.call("ZADD", other_queue, entry[1], entry[2])
+            redis.call("HSET", other_index, index_field(entry[2]), entry[2])
+            add_level(other_levels, entry[4], entry[3], 1)
+        end
+        return {0}
+    end
+elseif remaining > 0 then
+    local member = bet_member
+    if #fills > 0 then
+        member = with_amount(bet_member, remaining)
+    end
+    redis.call("ZADD", own_queue, odds, member)
+    redis.call("HSET", own_index, bet_field, member)
+    add_level(own_levels, odds, remaining, 1)
+end
+
+local reply = {1}
+for _, fill in ipairs(fills) do
+    table.insert(reply, fill)
+end
+return reply
+"""
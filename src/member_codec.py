@@ -0,0 +1,59 @@
+from struct import Struct
+
+from src import codec
+from src.domain_model import Bet
+
+# Encodings a resting bet can be written with. Reading always accepts both so
+# books written as json keep working after switching to compact.
+#
+# json is the default and compact is opt in: tasks of a version before compact
+# can not read its members, so it is only switched on once every task reads
+# it, and rolling back to such a version needs the books written as json
+# again. Compact also rounds amounts to cents, and since redis orders members
+# with the same score by their bytes, which of several bets at the same odds
+# is popped first differs from json.
+JSON = "json"
+COMPACT = "compact"
+
+COMPACT_V1 = 1
+
+# version, bet_id, brokerage_id, user_id, amount in cents followed by the sport.
+# event_id and on_team_abbrev live in the queue name and the odds in the score.
+_COMPACT_V1_HEADER = Struct(">Bqqqq")
+
+
+def encode_member(bet: Bet, encoding: str = JSON) -> bytes:
+    if encoding == COMPACT and _is_compact_encodable(bet):
+        header = _COMPACT_V1_HEADER.pack(
+            COMPACT_V1,
+            bet.bet_id,
+            bet.brokerage_id,
+            bet.user_id,
+            int(round(bet.amount * 100))
+        )
+        return header + bet.sport.encode("utf-8")
+    return bytes(bet)
+
+
+def decode_member(data: bytes, event_id: str, team_abbrev: str, score: float) -> Bet:
+    if data[0] == COMPACT_V1:
+        _, bet_id, brokerage_id, user_id, amount_cents = _COMPACT_V1_HEADER.unpack_from(data)
+        return Bet(
+            event_id=event_id,
+            sport=data[_COMPACT_V1_HEADER.size:].decode("utf-8"),
+            bet_id=bet_id,
+            brokerage_id=brokerage_id,
+            user_id=user_id,
+            amount=amount_cents / 100,
+            odds=int(score) if float(score).is_integer() else score,
+            on_team_abbrev=team_abbrev
+        )
+    return Bet(**codec.loads(data))
+
+
+def _is_compact_encodable(bet: Bet) -> bool:
+    return (
+        all(type(value) is int and -2 ** 63 <= value < 2 ** 63 for value in (bet.bet_id, bet.brokerage_id, bet.user_id)) and
+        isinstance(bet.amount, (int, float)) and
+        isinstance(bet.sport, str)
+    )
@@ -0,0 +1,231 @@
+import time
+from bisect import bisect_left
+from json import dumps
+from threading import Lock, Thread, local
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SECONDS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    In process registry of counters, gauges and histograms keyed by name and labels.
+
+    Per record tallies (round trips, commands, stage time) are kept per thread
+    between start_record and end_record and observed as histograms when the
+    record ends, so worker threads do not mix their records.
+    """
+    enabled = True
+
+    def __init__(self, namespace: str = "bexh_exchange"):
+        self._namespace = namespace
+        self._lock = Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._collectors = []
+        self._local = local()
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges[_key(name, labels)] = value
+
+    def observe(self, name: str, value: float, buckets: tuple = SECONDS_BUCKETS, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets=buckets)
+            histogram.observe(value)
+
+    def add_collector(self, collector):
+        """
+        :param collector: called before every export, returns gauges that are too costly to keep current by name
+        """
+        self._collectors.append(collector)
+
+    def start_record(self):
+        self._local.tallies = {}
+
+    def tally(self, name: str, value: float = 1):
+        """
+        Adds to the total counter and to the current record's tally of name.
+        """
+        self.increment(name, value)
+        self._add_tally(key=name, value=value)
+
+    def tally_stage(self, stage: str, seconds: float):
+        self._add_tally(key=("stage", stage), value=seconds)
+
+    def _add_tally(self, key, value: float):
+        tallies = getattr(self._local, "tallies", None)
+        if tallies is not None:
+            tallies[key] = tallies.get(key, 0) + value
+
+    def take_tallies(self) -> map:
+        """
+        Stops tallying the current record without observing it.
+
+        :return: the record's tallies, for a later end_record
+        """
+        tallies = getattr(self._local, "tallies", None) or {}
+        self._local.tallies = None
+        return tallies
+
+    def end_record(self, action: str, seconds: float, tallies: map = None):
+        """
+        :param tallies: from take_tallies, the current record's when not given
+        """
+        if tallies is None:
+            tallies = self.take_tallies()
+        self.observe("record_seconds", seconds, action=action)
+        stage_seconds = 0.0
+        for key, value in tallies.items():
+            if isinstance(key, tuple):
+                stage_seconds += value
+                self.observe("stage_seconds", value, stage=key[1])
+        self.observe("stage_seconds", max(seconds - stage_seconds, 0.0), stage="match")
+        for name in ("redis_round_trips", "redis_commands", "kinesis_calls", "fills", "levels_swept"):
+            self.observe(f"{name}_per_record", tallies.get(name, 0), buckets=COUNT_BUCKETS, action=action)
+
+    def collect(self):
+        # the executors of a worker pool each hold their own events, so their gauges add up
+        gauges = {}
+        for collector in self._collectors:
+            for name, value in collector().items():
+                gauges[name] = gauges.get(name, 0) + value
+        for name, value in gauges.items():
+            self.set_gauge(name, value)
+
+    def snapshot(self, reset: bool = False) -> (map, map, map):
+        """
+        :param reset: start counters and histograms over, for exports that report deltas
+        """
+        with self._lock:
+            counters, gauges, histograms = dict(self._counters), dict(self._gauges), {}
+            for key, histogram in self._histograms.items():
+                copy = Histogram(buckets=histogram.buckets)
+                copy.counts, copy.sum, copy.count = list(histogram.counts), histogram.sum, histogram.count
+                histograms[key] = copy
+            if reset:
+                self._counters = {}
+                self._histograms = {}
+            return counters, gauges, histograms
+
+    def render_prometheus(self) -> str:
+        self.collect()
+        counters, gauges, histograms = self.snapshot()
+        lines = []
+        for kind, values in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({name for name, _ in values}):
+                metric = f"{self._namespace}_{name}" + ("_total" if kind == "counter" else "")
+                lines.append(f"# TYPE {metric} {kind}")
+                for (key_name, labels), value in sorted(values.items()):
+                    if key_name == name:
+                        lines.append(f"{metric}{_labels(labels)} {value}")
+        for name in sorted({name for name, _ in histograms}):
+            metric = f"{self._namespace}_{name}"
+            lines.append(f"# TYPE {metric} histogram")
+            for (key_name, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+                if key_name != name:
+                    continue
+                cumulative = 0
+                for bucket, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{metric}_bucket{_labels(labels + (('le', bucket),))} {cumulative}")
+                lines.append(f"{metric}_sum{_labels(labels)} {histogram.sum}")
+                lines.append(f"{metric}_count{_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def render_emf(self) -> [str]:
+        """
+        One CloudWatch embedded metric format line per name and label set with
+        the values since the previous call. Histograms are reported as their
+        sum and count.
+        """
+        self.collect()
+        counters, gauges, histograms = self.snapshot(reset=True)
+        timestamp = int(time.time() * 1000)
+        values = [(name, labels, value, "Count") for (name, labels), value in counters.items()]
+        values += [(name, labels, value, "None") for (name, labels), value in gauges.items()]
+        for (name, labels), histogram in histograms.items():
+            unit = "Seconds" if name.endswith("seconds") else "Count"
+            values.append((f"{name}_sum", labels, histogram.sum, unit))
+            values.append((f"{name}_count", labels, histogram.count, "Count"))
+        lines = []
+        for name, labels, value, unit in sorted(values, key=lambda item: (item[0], item[1])):
+            lines.append(dumps({
+                "_aws": {
+                    "Timestamp": timestamp,
+                    "CloudWatchMetrics": [{
+                        "Namespace": self._namespace,
+                        "Dimensions": [[label for label, _ in labels]],
+                        "Metrics": [{"Name": name, "Unit": unit}]
+                    }]
+                },
+                **{label: str(label_value) for label, label_value in labels},
+                name: value
+            }))
+        return lines
+
+    def serve_prometheus(self, port: int) -> ThreadingHTTPServer:
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("", port), Handler)
+        Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        return server
+
+    def write_emf_every(self, interval_seconds: float, stream) -> Thread:
+        def write():
+            while True:
+                time.sleep(interval_seconds)
+                for line in self.render_emf():
+                    stream.write(line + "\n")
+                stream.flush()
+
+        thread = Thread(target=write, name="metrics", daemon=True)
+        thread.start()
+        return thread
+
+
+def _key(name: str, labels: map) -> tuple:
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
@@ -0,0 +1,72 @@
+from queue import Empty, Queue
+from time import monotonic, time
+
+
+class MicroBatcher:
+    """
+    Collects (record, ticket) items from a queue into batches of up to
+    batch_size items or max_wait_ms, whichever comes first.
+
+    batch_size follows the consumer's backlog, measured as the age of the
+    newest record in a batch. It doubles while the backlog is above
+    high_lag_ms and halves once it drops below low_lag_ms, so an idle stream
+    is handled one record at a time and a surge in large batches.
+    """
+    def __init__(
+        self,
+        items: Queue,
+        max_batch_size: int = 500,
+        max_wait_ms: float = 50,
+        high_lag_ms: float = 1000,
+        low_lag_ms: float = 200,
+        clock=time
+    ):
+        self._items = items
+        self._max_batch_size = max_batch_size
+        self._max_wait_ms = max_wait_ms
+        self._high_lag_ms = high_lag_ms
+        self._low_lag_ms = low_lag_ms
+        self._clock = clock
+        self.batch_size = 1
+        self.closed = False
+
+    def next_batch(self, timeout: float = None) -> list:
+        """
+        Blocks for the first item. A None item closes the batcher.
+
+        :param timeout: seconds to wait for the first item before returning an empty batch, none to wait for it
+        """
+        batch = []
+        deadline = None
+        while not self.closed and len(batch) < self.batch_size:
+            if deadline is None:
+                try:
+                    item = self._items.get(timeout=timeout)
+                except Empty:
+                    break
+            else:
+                try:
+                    item = self._items.get(timeout=max(deadline - monotonic(), 0))
+                except Empty:
+                    break
+            if item is None:
+                self.closed = True
+                break
+            batch.append(item)
+            if deadline is None:
+                deadline = monotonic() + self._max_wait_ms / 1000
+        if batch:
+            self._adapt(lag_ms=self.lag_ms(record=batch[-1][0]))
+        return batch
+
+    def lag_ms(self, record: map) -> float:
+        arrival = record.get("ApproximateArrivalTimestamp")
+        if arrival is None:
+            return 0
+        return (self._clock() - arrival.timestamp()) * 1000
+
+    def _adapt(self, lag_ms: float):
+        if lag_ms > self._high_lag_ms:
+            self.batch_size = min(self.batch_size * 2, self._max_batch_size)
+        elif lag_ms < self._low_lag_ms:
+            self.batch_size = max(self.batch_size // 2, 1)
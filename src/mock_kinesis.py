@@ -0,0 +1,29 @@
+class MockKinesis:
+    """
+    In memory stand in for kinesis put_record(s), for the tests and the
+    offline scripts. Records put on a stream are kept in streams by name.
+    """
+    def __init__(self, failures: int = 0):
+        self.streams = {}
+        self._failures = failures
+
+    def put_record(self, StreamName: str, Data: any, PartitionKey: str):
+        if StreamName in self.streams:
+            self.streams[StreamName].append(Data)
+        else:
+            self.streams[StreamName] = [Data]
+
+    def put_records(self, StreamName: str, Records: list):
+        # fail every other record while there are injected failures left
+        results = []
+        for i, record in enumerate(Records):
+            if self._failures > 0 and i % 2 == 0:
+                self._failures -= 1
+                results.append({"ErrorCode": "ProvisionedThroughputExceededException", "ErrorMessage": "Rate exceeded"})
+            else:
+                self.put_record(StreamName=StreamName, Data=record["Data"], PartitionKey=record["PartitionKey"])
+                results.append({"SequenceNumber": str(i), "ShardId": "shardId-000000000000"})
+        return {
+            "FailedRecordCount": len(list(filter(lambda x: "ErrorCode" in x, results))),
+            "Records": results
+        }
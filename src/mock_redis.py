@@ -0,0 +1,206 @@
+from fnmatch import fnmatchcase
+
+from sortedcontainers import SortedSet
+
+
+class MockPipeline:
+    def __init__(self, client):
+        self._client = client
+        self._commands = []
+        self._watching = False
+
+    def __getattr__(self, name: str):
+        if self._watching:
+            return getattr(self._client, name)
+
+        def queue_command(*args, **kwargs):
+            self._commands.append((name, args, kwargs))
+            return self
+        return queue_command
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._commands = []
+
+    def watch(self, *names):
+        # commands run right away until multi, as in redis-py
+        self._watching = True
+
+    def multi(self):
+        self._watching = False
+
+    def execute(self):
+        results = [getattr(self._client, name)(*args, **kwargs) for name, args, kwargs in self._commands]
+        self._commands = []
+        return results
+
+
+class MockRedis:
+    """
+    In memory stand in for the redis commands the exchange uses, for the
+    tests and the offline scripts.
+    """
+    def __init__(self):
+        self.kv_store = {}
+
+    def zadd(self, name: str, mapping: map):
+        for data, score in mapping.items():
+            data = data if isinstance(data, bytes) else data.encode("utf-8")
+            if name in self.kv_store:
+                self.kv_store[name].add((data, score))
+            else:
+                self.kv_store[name] = SortedSet([(data, score)], key=lambda value: (value[1], value[0]))
+
+    def zpopmin(self, name: str, count: int = None):
+        if name in self.kv_store:
+            values = self.kv_store[name]
+            return [values.pop(index=0) for _ in range(min(count or 1, len(values)))]
+        else:
+            return []
+
+    def zpopmax(self, name: str, count: int = None):
+        if name in self.kv_store:
+            values = self.kv_store[name]
+            return [values.pop(index=-1) for _ in range(min(count or 1, len(values)))]
+        else:
+            return []
+
+    def zrange(self, name: str, start: int, end: int, withscores: bool = False):
+        if name in self.kv_store:
+            values = list(self.kv_store[name])
+            values = values[start:] if end == -1 else values[start:end + 1]
+            if withscores:
+                return values
+            return list(map(lambda x: x[0], values))
+        return []
+
+    def zrevrange(self, name: str, start: int, end: int, withscores: bool = False):
+        if name in self.kv_store:
+            values = list(reversed(self.kv_store[name]))
+            values = values[start:] if end == -1 else values[start:end + 1]
+            if withscores:
+                return values
+            return list(map(lambda x: x[0], values))
+        return []
+
+    def pipeline(self, transaction: bool = True):
+        return MockPipeline(client=self)
+
+    def transaction(self, func, *watches: str):
+        # nothing runs in between the commands of a mock, so a watch never fails
+        pipe = self.pipeline()
+        pipe.watch(*watches)
+        func(pipe)
+        return pipe.execute()
+
+    def scan_iter(self, match: str = "*", count: int = None):
+        return iter([name for name in self.kv_store if fnmatchcase(name, match)])
+
+    def get(self, name: str):
+        return self.kv_store.get(name)
+
+    def delete(self, *names):
+        for name in names:
+            if name in self.kv_store:
+                del self.kv_store[name]
+
+    def set(self, name: str, value: str):
+        self.kv_store[name] = value.encode("utf-8")
+
+    def zrangebyscore(self, name: str, min: any, max: any, withscores: bool = False):
+        if name in self.kv_store:
+            values = [value for value in self.kv_store[name] if min <= value[1] <= max]
+            if withscores:
+                return values
+            return list(map(lambda x: x[0], values))
+        return []
+
+    def zcard(self, name: str):
+        return len(self.kv_store.get(name, []))
+
+    def zscore(self, name: str, value: any):
+        value = value if isinstance(value, bytes) else value.encode("utf-8")
+        for data, score in self.kv_store.get(name, []):
+            if data == value:
+                return score
+        return None
+
+    def zrem(self, name: str, *values: any):
+        removed_count = 0
+        if name in self.kv_store:
+            for value in values:
+                value = value if isinstance(value, bytes) else value.encode("utf-8")
+                matching_value = None
+                for sorted_set_val in self.kv_store[name]:
+                    if value == sorted_set_val[0]:
+                        matching_value = sorted_set_val
+                        break
+                if matching_value:
+                    self.kv_store[name].remove(matching_value)
+                    removed_count += 1
+        return removed_count
+
+    def hset(self, name: str, key: str = None, value: str = None, mapping: map = None):
+        values = self.kv_store.setdefault(name, {})
+        for field, data in ({key: value} if mapping is None else mapping).items():
+            values[field.encode("utf-8")] = data.encode("utf-8") if isinstance(data, str) else data
+
+    def hget(self, name: str, key: str):
+        return self.kv_store.get(name, {}).get(key.encode("utf-8"))
+
+    def hgetall(self, name: str):
+        return dict(self.kv_store.get(name, {}))
+
+    def hincrby(self, name: str, key: str, amount: int = 1):
+        values = self.kv_store.setdefault(name, {})
+        value = int(values.get(key.encode("utf-8"), b"0")) + amount
+        values[key.encode("utf-8")] = str(value).encode("utf-8")
+        return value
+
+    def sadd(self, name: str, *values: str):
+        members = self.kv_store.setdefault(name, set())
+        added = {value.encode("utf-8") for value in values} - members
+        members.update(added)
+        return len(added)
+
+    def sismember(self, name: str, value: str):
+        return value.encode("utf-8") in self.kv_store.get(name, set())
+
+    def smembers(self, name: str):
+        return set(self.kv_store.get(name, set()))
+
+    def expire(self, name: str, time: int):
+        return name in self.kv_store
+
+    def pexpire(self, name: str, time: int):
+        return name in self.kv_store
+
+    def hdel(self, name: str, *keys: str):
+        values = self.kv_store.get(name, {})
+        return len([values.pop(key.encode("utf-8")) for key in keys if key.encode("utf-8") in values])
+
+
+class AsyncMockPipeline(MockPipeline):
+    async def execute(self):
+        return super().execute()
+
+
+class AsyncMockRedis:
+    """
+    redis.asyncio style view of a MockRedis: commands are awaited and
+    pipelines buffer commands until execute is awaited.
+    """
+    def __init__(self, client: MockRedis):
+        self._client = client
+
+    def __getattr__(self, name: str):
+        command = getattr(self._client, name)
+
+        async def run_command(*args, **kwargs):
+            return command(*args, **kwargs)
+        return run_command
+
+    def pipeline(self, transaction: bool = True):
+        return AsyncMockPipeline(client=self._client)
@@ -0,0 +1,202 @@
+from bisect import bisect_left, insort
+from src.bet_index import BetIndex
+from src.domain_model import Bet, PriceLevel
+from src.event_leases import EventLeases
+from src.exchange import Exchange
+from src.member_codec import JSON, decode_member, encode_member
+from src.priority_queue import PriorityQueue
+from src.status_cache import StatusCache
+
+
+class OrderBook:
+    """
+    In process copy of a single pq:{event_id}:{team} sorted set.
+
+    Entries are kept sorted by (score, member) which mirrors redis ordering
+    of sorted set members that share a score.
+    """
+    def __init__(self, items: list = None):
+        self._entries = []
+        self._scores = {}
+        for member, score in items or []:
+            self.add(member=member, score=score)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, member: bytes, score: float) -> bool:
+        if member in self._scores:
+            return False
+        self._scores[member] = score
+        insort(self._entries, (score, member))
+        return True
+
+    def remove(self, member: bytes) -> bool:
+        score = self._scores.pop(member, None)
+        if score is None:
+            return False
+        index = bisect_left(self._entries, (score, member))
+        del self._entries[index]
+        return True
+
+    def score(self, member: bytes) -> float:
+        return self._scores.get(member)
+
+    def peek_min(self, start: int, count: int) -> list:
+        return [(member, score) for score, member in self._entries[start:start + count]]
+
+    def peek_max(self, start: int, count: int) -> list:
+        end = max(len(self._entries) - start, 0)
+        return [(member, score) for score, member in reversed(self._entries[max(end - count, 0):end])]
+
+    def pop_min(self):
+        if not self._entries:
+            return None
+        score, member = self._entries.pop(0)
+        del self._scores[member]
+        return member, score
+
+    def pop_max(self):
+        if not self._entries:
+            return None
+        score, member = self._entries.pop()
+        del self._scores[member]
+        return member, score
+
+
+class InMemoryExchange(Exchange):
+    """
+    Exchange that matches against in process order books and writes the net
+    book changes back to redis in a single pipeline on flush.
+
+    Books, bet_id lookups and pending writes are keyed by (event_id, team_abbrev).
+    """
+    def __init__(self, redis_client, member_encoding: str = JSON, status_cache: StatusCache = None, event_leases: EventLeases = None):
+        super().__init__(redis_client=redis_client, member_encoding=member_encoding, status_cache=status_cache, event_leases=event_leases)
+        self._books = {}
+        self._members = {}
+        self._pending = {}
+
+    def submit_bet(self, bet: Bet):
+        book_key = (bet.event_id, bet.on_team_abbrev)
+        member = encode_member(bet=bet, encoding=self._member_encoding)
+        if self._get_book(book_key).add(member=member, score=bet.odds):
+            field = self.index_field(bet)
+            self._members[book_key][field] = member
+            added, removed = self._get_pending(book_key)
+            if member in removed:
+                del removed[member]
+            else:
+                added[member] = (bet.odds, field)
+            self._add_level_delta(bet=bet, sign=1)
+
+    def pop_bet(self, event_id: str, team_abbrev: str, is_home_team: bool) -> Bet:
+        book_key = (event_id, team_abbrev)
+        book = self._get_book(book_key)
+        value = book.pop_min() if is_home_team else book.pop_max()
+        if not value:
+            return None
+
+        member, score = value
+        bet = decode_member(data=member, event_id=event_id, team_abbrev=team_abbrev, score=score)
+        self._record_removal(book_key, member, self.index_field(bet))
+        self._add_level_delta(bet=bet, sign=-1)
+        return bet
+
+    def peek_bets(self, event_id: str, team_abbrev: str, is_home_team: bool, start: int, count: int) -> [Bet]:
+        book = self._get_book((event_id, team_abbrev))
+        values = book.peek_min(start=start, count=count) if is_home_team else book.peek_max(start=start, count=count)
+        return self._decode_peeked(values=values, event_id=event_id, team_abbrev=team_abbrev)
+
+    def submit_bets(self, bets: [Bet]):
+        for bet in bets:
+            self.submit_bet(bet=bet)
+
+    def pop_bets(self, event_id: str, team_abbrev: str, is_home_team: bool, count: int) -> [Bet]:
+        bets = []
+        while len(bets) < count:
+            bet = self.pop_bet(event_id=event_id, team_abbrev=team_abbrev, is_home_team=is_home_team)
+            if bet is None:
+                break
+            bets.append(bet)
+        return bets
+
+    def remove_bet(self, bet: Bet) -> Bet:
+        book_key = (bet.event_id, bet.on_team_abbrev)
+        book = self._get_book(book_key)
+        field = self.index_field(bet)
+        member = self._members[book_key].get(field)
+        if member is None:
+            return None
+        removed_bet = decode_member(data=member, event_id=bet.event_id, team_abbrev=bet.on_team_abbrev, score=book.score(member))
+        book.remove(member)
+        self._record_removal(book_key, member, field)
+        self._add_level_delta(bet=removed_bet, sign=-1)
+        return removed_bet
+
+    def purge_bets(self, event_id: str, home_team_abbrev: str, away_team_abbrev: str) -> [Bet]:
+        self.flush()
+        for team_abbrev in (home_team_abbrev, away_team_abbrev):
+            self._books.pop((event_id, team_abbrev), None)
+            self._members.pop((event_id, team_abbrev), None)
+        return super().purge_bets(event_id=event_id, home_team_abbrev=home_team_abbrev, away_team_abbrev=away_team_abbrev)
+
+    def flush(self):
+        if not self._pending and not self._level_deltas:
+            return
+        pipe = self._r.pipeline(transaction=True)
+        pq = PriorityQueue(redis_client=pipe)
+        index = BetIndex(redis_client=pipe)
+        for (event_id, team_abbrev), (added, removed) in self._pending.items():
+            queue_name = self.queue_name(event_id, team_abbrev)
+            index_name = self.index_name(event_id, team_abbrev)
+            added_fields = {field: member for member, (score, field) in added.items()}
+            removed_fields = [field for field in removed.values() if field not in added_fields]
+            if removed:
+                pq.remove_items(queue_name, *removed)
+            if removed_fields:
+                index.remove(index_name, *removed_fields)
+            if added:
+                pq.push_many(queue_name=queue_name, mapping={member: score for member, (score, field) in added.items()})
+                index.set_members(index_name=index_name, mapping=added_fields)
+        self._write_level_deltas(pipe=pipe)
+        pipe.execute()
+        self._pending = {}
+
+    def book_levels(self, event_id: str, team_abbrev: str, is_home_team: bool, depth: int = None) -> [PriceLevel]:
+        self.flush()
+        return super().book_levels(event_id=event_id, team_abbrev=team_abbrev, is_home_team=is_home_team, depth=depth)
+
+    def evict_event(self, event_id: str):
+        super().evict_event(event_id=event_id)
+        self.flush()
+        for book_key in [key for key in self._books if key[0] == event_id]:
+            del self._books[book_key]
+            del self._members[book_key]
+
+    def _get_book(self, book_key: tuple) -> OrderBook:
+        book = self._books.get(book_key)
+        if book is None:
+            event_id, team_abbrev = book_key
+            items = self._pq.get_all_items(queue_name=self.queue_name(event_id, team_abbrev))
+            book = OrderBook(items=items)
+            self._books[book_key] = book
+            self._members[book_key] = {
+                self.index_field(decode_member(data=member, event_id=event_id, team_abbrev=team_abbrev, score=score)): member
+                for member, score in items
+            }
+        return book
+
+    def _get_pending(self, book_key: tuple):
+        if book_key not in self._pending:
+            self._pending[book_key] = ({}, {})
+        return self._pending[book_key]
+
+    def _record_removal(self, book_key: tuple, member: bytes, field: str):
+        if self._members[book_key].get(field) == member:
+            del self._members[book_key][field]
+        added, removed = self._get_pending(book_key)
+        if member in added:
+            del added[member]
+        else:
+            removed[member] = field
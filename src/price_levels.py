@@ -0,0 +1,41 @@
+from src.domain_model import PriceLevel
+
+
+class PriceLevels:
+    """
+    Hash per queue of the amount in cents and the number of bets resting at
+    each odds, kept as "{odds}:cents" and "{odds}:count" fields.
+
+    Levels that emptied keep their fields at zero until the book is purged.
+    """
+    def __init__(self, redis_client):
+        self._r = redis_client
+
+    def add(self, levels_name: str, deltas: map):
+        """
+        :param deltas: change in (cents, count) by odds
+        """
+        for odds, (cents, count) in deltas.items():
+            if cents:
+                self._r.hincrby(levels_name, f"{odds}:cents", cents)
+            if count:
+                self._r.hincrby(levels_name, f"{odds}:count", count)
+
+    def get_all(self, levels_name: str):
+        return self._r.hgetall(name=levels_name)
+
+    @staticmethod
+    def decode(values: map) -> [PriceLevel]:
+        """
+        :return: the levels that have bets resting, in no particular order
+        """
+        cents = {}
+        counts = {}
+        for field, value in values.items():
+            odds, _, kind = (field.decode("utf-8") if isinstance(field, bytes) else field).partition(":")
+            (cents if kind == "cents" else counts)[int(odds)] = int(value)
+        return [
+            PriceLevel(odds=odds, amount=cents.get(odds, 0) / 100, count=count)
+            for odds, count in counts.items()
+            if count > 0
+        ]
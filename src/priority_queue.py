@@ -8,14 +8,35 @@ class PriorityQueue:
             mapping={data: score}
         )
 
-    def pop_min(self, queue_name: str):
-        return self._r.zpopmin(name=queue_name)
+    def push_many(self, queue_name: str, mapping: map):
+        self._r.zadd(
+            name=queue_name,
+            mapping=mapping
+        )
+
+    def pop_min(self, queue_name: str, count: int = None):
+        return self._r.zpopmin(name=queue_name, count=count)
+
+    def pop_max(self, queue_name: str, count: int = None):
+        return self._r.zpopmax(name=queue_name, count=count)
 
-    def pop_max(self, queue_name: str):
-        return self._r.zpopmax(name=queue_name)
+    def peek_min(self, queue_name: str, start: int, count: int):
+        return self._r.zrange(name=queue_name, start=start, end=start + count - 1, withscores=True)
+
+    def peek_max(self, queue_name: str, start: int, count: int):
+        return self._r.zrevrange(name=queue_name, start=start, end=start + count - 1, withscores=True)
+
+    def get_all_items(self, queue_name: str):
+        return self._r.zrange(name=queue_name, start=0, end=-1, withscores=True)
 
     def get_items_in_range(self, queue_name: str, min_score: int, max_score: int):
         return self._r.zrangebyscore(name=queue_name, min=min_score, max=max_score, withscores=True)
 
+    def get_score(self, queue_name: str, data: str):
+        return self._r.zscore(name=queue_name, value=data)
+
     def remove_items(self, queue_name, *values):
         self._r.zrem(queue_name, *values)
+
+    def count(self, queue_name: str):
+        return self._r.zcard(name=queue_name)
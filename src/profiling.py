@@ -0,0 +1,237 @@
+import cProfile
+import io
+import os
+import pstats
+import signal
+import sys
+import time
+import tracemalloc
+from queue import SimpleQueue
+from threading import Event, Lock, Thread, get_ident
+
+from src.logger import Logger
+
+
+class Profiler:
+    """
+    Profiles a window of records handled by the attached executors, and
+    takes tracemalloc snapshots, on demand.
+
+    Attached executors run unwrapped until a window starts. start() sets a
+    profiling handle_record, handle_data and handle_records on each executor
+    instance and the window's last record removes them again, so between
+    windows the profiler costs nothing.
+
+    Results are logged and, when output_dir is given, also written there.
+    """
+    def __init__(
+        self,
+        logger: Logger,
+        mode: str = "cprofile",
+        records: int = 10000,
+        output_dir: str = None,
+        sample_interval_ms: float = 5,
+        tracemalloc_frames: int = 25,
+        top: int = 25
+    ):
+        """
+        :param mode: ProfileMode = Literal["cprofile", "sampling"]
+        :param records: number of records a window profiles
+        :param sample_interval_ms: time between stack samples in sampling mode
+        :param top: number of lines of each result that are logged
+        """
+        self._logger = logger
+        self._mode = mode
+        self._records = records
+        self._output_dir = output_dir
+        self._sample_interval_ms = sample_interval_ms
+        self._tracemalloc_frames = tracemalloc_frames
+        self._top = top
+        self._lock = Lock()
+        self._bet_executors = []
+        self._window = None
+        self._memory_snapshot = None
+
+    def attach(self, bet_executor):
+        with self._lock:
+            self._bet_executors.append(bet_executor)
+            if self._window is not None:
+                self._wrap(bet_executor=bet_executor, window=self._window)
+
+    def start(self):
+        with self._lock:
+            if self._window is not None:
+                return
+            self._window = ProfileWindow(mode=self._mode, records=self._records, sample_interval_ms=self._sample_interval_ms)
+            for bet_executor in self._bet_executors:
+                self._wrap(bet_executor=bet_executor, window=self._window)
+        self._logger.info("Profiling records", mode=self._mode, records=self._records)
+
+    def _wrap(self, bet_executor, window):
+        handle_record = type(bet_executor).handle_record.__get__(bet_executor)
+        handle_data = type(bet_executor).handle_data.__get__(bet_executor)
+        handle_records = type(bet_executor).handle_records.__get__(bet_executor)
+        bet_executor.handle_record = lambda record: self._profile(window, bet_executor, handle_record, (record,), 1)
+        bet_executor.handle_data = lambda data, sequence_number=None: self._profile(window, bet_executor, handle_data, (data, sequence_number), 1)
+        bet_executor.handle_records = lambda records: self._profile(window, bet_executor, handle_records, (records,), len(records))
+
+    def _profile(self, window, bet_executor, call, args: tuple, count: int):
+        window.enter(bet_executor=bet_executor)
+        try:
+            return call(*args)
+        finally:
+            if window.exit(bet_executor=bet_executor, count=count):
+                self._finish(window=window)
+
+    def _finish(self, window):
+        with self._lock:
+            if self._window is not window:
+                return
+            self._window = None
+            for bet_executor in self._bet_executors:
+                bet_executor.__dict__.pop("handle_record", None)
+                bet_executor.__dict__.pop("handle_data", None)
+                bet_executor.__dict__.pop("handle_records", None)
+        self._report(name=f"{self._mode}", text=window.report(top=self._top), dump=window.dump)
+
+    def snapshot_memory(self):
+        """
+        The first call starts tracing, every later one reports the growth
+        since the previous call by line.
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self._tracemalloc_frames)
+            self._memory_snapshot = tracemalloc.take_snapshot()
+            self._logger.info("Tracing allocations", frames=self._tracemalloc_frames)
+            return
+        snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+        stats = snapshot.compare_to(self._memory_snapshot, "lineno")
+        self._memory_snapshot = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"traced {current} bytes, peak {peak} bytes"] + [str(stat) for stat in stats[:self._top]]
+        self._report(name="tracemalloc", text="\n".join(lines), dump=snapshot.dump)
+
+    def snapshot_memory_every(self, interval_seconds: float) -> Thread:
+        def snapshot():
+            while True:
+                time.sleep(interval_seconds)
+                self.snapshot_memory()
+
+        thread = Thread(target=snapshot, name="tracemalloc", daemon=True)
+        thread.start()
+        self.snapshot_memory()
+        return thread
+
+    def install_signals(self, profile_signal=signal.SIGUSR1, memory_signal=signal.SIGUSR2):
+        """
+        Must be called from the main thread, a signal of None is left alone.
+
+        Handlers run on the main thread between any two bytecodes, possibly
+        while it holds self._lock in a record's _finish, so they only queue
+        the request and a thread of their own acts on it.
+        """
+        requests = SimpleQueue()
+
+        def handle_requests():
+            while True:
+                requests.get()()
+
+        Thread(target=handle_requests, name="profiler-signals", daemon=True).start()
+        if profile_signal is not None:
+            # SimpleQueue.put is safe to call from a signal handler
+            signal.signal(profile_signal, lambda signum, frame: requests.put(self.start))
+        if memory_signal is not None:
+            signal.signal(memory_signal, lambda signum, frame: requests.put(self.snapshot_memory))
+
+    def _report(self, name: str, text: str, dump):
+        self._logger.info("Profile result", kind=name, result="\n" + text)
+        if self._output_dir:
+            path = os.path.join(self._output_dir, f"{name}-{os.getpid()}-{int(time.time())}")
+            dump(path)
+            self._logger.info("Wrote profile", kind=name, path=path)
+
+
+class ProfileWindow:
+    """
+    One profiling run over a number of records, across every executor thread.
+    """
+    def __init__(self, mode: str, records: int, sample_interval_ms: float):
+        self._mode = mode
+        self._remaining = records
+        self._lock = Lock()
+        # cProfile only sees the thread that enables it, so each executor gets its own
+        self._profiles = {}
+        self._active_threads = set()
+        self._samples = {}
+        self._stopped = Event()
+        if mode == "sampling":
+            Thread(target=self._sample, args=(sample_interval_ms / 1000,), name="sampling-profiler", daemon=True).start()
+
+    def enter(self, bet_executor):
+        if self._mode == "sampling":
+            self._active_threads.add(get_ident())
+            return
+        profile = self._profiles.get(id(bet_executor))
+        if profile is None:
+            profile = self._profiles[id(bet_executor)] = cProfile.Profile()
+        profile.enable()
+
+    def exit(self, bet_executor, count: int) -> bool:
+        """
+        :return: whether the window is over
+        """
+        if self._mode == "sampling":
+            self._active_threads.discard(get_ident())
+        else:
+            self._profiles[id(bet_executor)].disable()
+        with self._lock:
+            self._remaining -= count
+            if self._remaining > 0 or self._stopped.is_set():
+                return False
+            self._stopped.set()
+            return True
+
+    def _sample(self, interval_seconds: float):
+        while not self._stopped.wait(interval_seconds):
+            frames = sys._current_frames()
+            for ident in list(self._active_threads):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                if stack:
+                    key = ";".join(reversed(stack))
+                    self._samples[key] = self._samples.get(key, 0) + 1
+
+    def report(self, top: int) -> str:
+        if self._mode == "sampling":
+            total = sum(self._samples.values()) or 1
+            leaves = {}
+            for stack, count in self._samples.items():
+                leaf = stack.rsplit(";", 1)[-1]
+                leaves[leaf] = leaves.get(leaf, 0) + count
+            lines = [f"{total} samples, by innermost function"]
+            lines += [f"{count / total:7.1%} {leaf}" for leaf, count in sorted(leaves.items(), key=lambda item: -item[1])[:top]]
+            return "\n".join(lines)
+        stream = io.StringIO()
+        self._stats(stream=stream).sort_stats("cumulative").print_stats(top)
+        return stream.getvalue()
+
+    def dump(self, path: str):
+        """
+        cProfile stats in pstats format, or samples as collapsed stacks for flame graphs.
+        """
+        if self._mode == "sampling":
+            with open(path + ".folded", "w") as f:
+                for stack, count in sorted(self._samples.items(), key=lambda item: -item[1]):
+                    f.write(f"{stack} {count}\n")
+            return
+        self._stats(stream=io.StringIO()).dump_stats(path + ".prof")
+
+    def _stats(self, stream) -> pstats.Stats:
+        profiles = list(self._profiles.values())
+        stats = pstats.Stats(profiles[0], stream=stream) if profiles else pstats.Stats(stream=stream)
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
@@ -0,0 +1,116 @@
+import asyncio
+import time
+
+from src.logger import Logger
+
+
+class PublishError(Exception):
+    pass
+
+
+class KinesisPublisher:
+    """
+    Buffers output records and sends them with PutRecords.
+
+    Records are sent in the order they were published. When kinesis rejects
+    an entry of a request, that entry and every later entry of the request
+    with the same partition key are retried, before any record published
+    after them. Entries of other partition keys are not sent again, and the
+    last copy of each record of a partition key is in publish order, though
+    readers may see an earlier copy of a record that was sent again.
+    """
+    MAX_RECORDS_PER_REQUEST = 500
+    MAX_BYTES_PER_REQUEST = 5 * 1024 * 1024
+
+    def __init__(self, logger: Logger, kinesis_client, stream_name: str, max_retries: int = 5, backoff_seconds: float = 0.05):
+        self._logger = logger
+        self._kinesis_client = kinesis_client
+        self._stream_name = stream_name
+        self._max_retries = max_retries
+        self._backoff_seconds = backoff_seconds
+        self._buffer = []
+        self._buffer_bytes = 0
+
+    def publish(self, data: bytes, partition_key: str):
+        record = {"Data": data, "PartitionKey": partition_key}
+        record_bytes = self._record_size(record)
+        if self._is_full(record_bytes=record_bytes):
+            self.flush()
+        self._buffer.append(record)
+        self._buffer_bytes += record_bytes
+
+    def _is_full(self, record_bytes: int) -> bool:
+        return (
+            len(self._buffer) >= self.MAX_RECORDS_PER_REQUEST or
+            self._buffer_bytes + record_bytes > self.MAX_BYTES_PER_REQUEST
+        )
+
+    def flush(self):
+        # publish keeps the buffer within a single PutRecords request
+        records = self._buffer
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._put_records(records)
+
+    def _put_records(self, records: list):
+        attempt = 0
+        while records:
+            res = self._kinesis_client.put_records(StreamName=self._stream_name, Records=records)
+            if not res.get("FailedRecordCount"):
+                return
+            records = self._records_to_retry(records=records, results=res["Records"])
+            attempt += 1
+            if attempt > self._max_retries:
+                raise PublishError(f"Failed to put {len(records)} records to {self._stream_name}")
+            self._logger.warning("Retrying failed records", records=len(records), stream_name=self._stream_name, attempt=attempt)
+            time.sleep(self._backoff_seconds * 2 ** (attempt - 1))
+
+    @staticmethod
+    def _records_to_retry(records: list, results: list) -> list:
+        failed_keys = set()
+        retry = []
+        for record, result in zip(records, results):
+            if result.get("ErrorCode"):
+                failed_keys.add(record["PartitionKey"])
+            if record["PartitionKey"] in failed_keys:
+                retry.append(record)
+        return retry
+
+    @staticmethod
+    def _record_size(record: map) -> int:
+        return len(record["Data"]) + len(record["PartitionKey"].encode("utf-8"))
+
+
+class AsyncKinesisPublisher(KinesisPublisher):
+    """
+    KinesisPublisher for the asyncio executor.
+
+    boto3 has no asyncio client so PutRecords runs in the loop's default
+    executor. Full requests are held until flush, and flushes are serialized
+    so retried entries still go out before anything published after them.
+    """
+    def __init__(self, logger: Logger, kinesis_client, stream_name: str, max_retries: int = 5, backoff_seconds: float = 0.05):
+        super().__init__(logger=logger, kinesis_client=kinesis_client, stream_name=stream_name, max_retries=max_retries, backoff_seconds=backoff_seconds)
+        self._requests = []
+        self._flush_lock = asyncio.Lock()
+
+    def publish(self, data: bytes, partition_key: str):
+        record = {"Data": data, "PartitionKey": partition_key}
+        record_bytes = self._record_size(record)
+        if self._is_full(record_bytes=record_bytes):
+            self._requests.append(self._buffer)
+            self._buffer = []
+            self._buffer_bytes = 0
+        self._buffer.append(record)
+        self._buffer_bytes += record_bytes
+
+    async def flush(self):
+        requests = self._requests + [self._buffer]
+        self._requests = []
+        self._buffer = []
+        self._buffer_bytes = 0
+        async with self._flush_lock:
+            loop = asyncio.get_running_loop()
+            for records in requests:
+                if records:
+                    await loop.run_in_executor(None, self._put_records, records)
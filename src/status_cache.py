@@ -0,0 +1,79 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from src.domain_model import StatusDetails
+from src import keys
+
+
+class StatusCache:
+    """
+    Bounded LRU of event:{event_id} lookups with a TTL per entry.
+
+    Only found statuses are cached so an event created after a miss is seen on
+    the next lookup. Entries are dropped when the executor handles the event's
+    INACTIVE_EVENT and, when listening, on any write to the event key.
+    """
+    def __init__(self, max_size: int = 1024, ttl_seconds: float = 5.0, clock=monotonic):
+        self._max_size = max_size
+        self._ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._entries = OrderedDict()
+        # keyspace notifications invalidate from the pubsub thread
+        self._lock = Lock()
+        self._pubsub_thread = None
+
+    def get(self, event_id: str) -> StatusDetails:
+        with self._lock:
+            entry = self._entries.get(event_id)
+            if entry is None:
+                return None
+            status_details, expires_at = entry
+            if self._clock() >= expires_at:
+                del self._entries[event_id]
+                return None
+            self._entries.move_to_end(event_id)
+            return status_details
+
+    def put(self, event_id: str, status_details: StatusDetails):
+        if self._max_size <= 0:
+            return
+        with self._lock:
+            self._entries[event_id] = (status_details, self._clock() + self._ttl_seconds)
+            self._entries.move_to_end(event_id)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, event_id: str):
+        with self._lock:
+            self._entries.pop(event_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def listen(self, redis_client, db: int = 0):
+        """
+        Invalidates entries on writes to event:* keys via keyspace notifications.
+
+        The server needs notify-keyspace-events to include K and the generic
+        and string classes (e.g. "Kg$"); TTL expiry still bounds staleness
+        when it does not.
+        """
+        if self._pubsub_thread is not None:
+            return
+        prefix = f"__keyspace@{db}__:"
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+
+        def handle_message(message: map):
+            channel = message["channel"]
+            channel = channel.decode("utf-8") if isinstance(channel, bytes) else channel
+            self.invalidate(event_id=keys.parse_event_key(channel[len(prefix):])[1])
+
+        pubsub.psubscribe(**{f"{prefix}event:*": handle_message})
+        self._pubsub_thread = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def stop(self):
+        if self._pubsub_thread is not None:
+            self._pubsub_thread.stop()
+            self._pubsub_thread = None
@@ -0,0 +1,95 @@
+"""
+Plans the fills of a bet sweeping a run of resting bets, as the sweep loops
+would make them one Bet.determine_amounts at a time.
+
+A resting bet that is filled entirely takes round(amount * odds factor, 2)
+from the incoming bet whatever is left of it, so with numpy the amounts left
+before every fill are one cumulative sum and the first partial fill is the
+first resting bet the amount left can not cover. The float operations are the
+scalar ones in the same order, and round(x, 2) is numpy's except where x * 100
+is so close to a half that python's correctly rounded round may differ, so the
+fills are identical to the scalar loop.
+"""
+from src.domain_model import Bet
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - depends on the environment
+    np = None
+
+# below this many resting bets numpy's per call overhead costs more than the scalar loop
+MIN_VECTORIZED_BETS = 64
+
+
+def plan_sweep(bet: Bet, resting_bets: [Bet], other_is_on_home: bool, is_market: bool) -> [(float, float)]:
+    """
+    Stops once the bet is filled, or for a limit bet at the first resting bet
+    it is not better than or equal to.
+
+    :param resting_bets: in the order they are popped
+    :return: (bet amount, resting bet amount) of each fill, one per resting bet from the first
+    """
+    if np is None or len(resting_bets) < MIN_VECTORIZED_BETS:
+        return _plan_scalar(bet=bet, resting_bets=resting_bets, other_is_on_home=other_is_on_home, is_market=is_market)
+    return _plan_vectorized(bet=bet, resting_bets=resting_bets, other_is_on_home=other_is_on_home, is_market=is_market)
+
+
+def _plan_scalar(bet: Bet, resting_bets: [Bet], other_is_on_home: bool, is_market: bool) -> [(float, float)]:
+    remaining_bet = bet.copy()
+    fills = []
+    for resting_bet in resting_bets:
+        if remaining_bet.amount <= 0:
+            break
+        if not is_market and not remaining_bet.better_than_or_equal(other=resting_bet, other_is_on_home=other_is_on_home):
+            break
+        bet_amount, resting_bet_amount = remaining_bet.determine_amounts(other=resting_bet, other_is_on_home=other_is_on_home)
+        remaining_bet.amount -= bet_amount
+        fills.append((bet_amount, resting_bet_amount))
+    return fills
+
+
+def _plan_vectorized(bet: Bet, resting_bets: [Bet], other_is_on_home: bool, is_market: bool) -> [(float, float)]:
+    if bet.amount <= 0:
+        return []
+    resting_amounts = [resting_bet.amount for resting_bet in resting_bets]
+    odds = np.array([resting_bet.odds for resting_bet in resting_bets], dtype=np.float64)
+    amounts = np.array(resting_amounts, dtype=np.float64)
+    if not is_market:
+        worse = odds < bet.odds
+        if worse.any():
+            count = int(worse.argmax())
+            odds, amounts = odds[:count], amounts[:count]
+    if len(odds) == 0:
+        return []
+
+    bet_odds = -odds if other_is_on_home else odds
+    abs_factors = np.abs(bet_odds) / 100
+    factors = bet_odds / 100
+    # what filling each resting bet entirely takes from the bet
+    full_bet_amounts = _round2(np.where(bet_odds < 0, amounts * abs_factors, amounts / factors))
+    # amount left of the bet before each resting bet if every earlier one was filled entirely,
+    # accumulated left to right so it equals subtracting one fill at a time
+    remaining = np.cumsum(np.concatenate(([bet.amount], -full_bet_amounts[:-1])))
+    # what the amount left would take from each resting bet
+    resting_fills = _round2(np.where(bet_odds > 0, remaining * factors, remaining / abs_factors))
+    is_partial = resting_fills < amounts
+    ends = is_partial | (remaining - full_bet_amounts <= 0)
+
+    count = int(ends.argmax()) + 1 if ends.any() else len(odds)
+    full_count = count - 1 if is_partial[count - 1] else count
+    fills = list(zip(full_bet_amounts[:full_count].tolist(), resting_amounts[:full_count]))
+    if full_count < count:
+        # the bet is filled entirely, by what is left of it
+        bet_amount = bet.amount if full_count == 0 else remaining[full_count].item()
+        fills.append((bet_amount, resting_fills[full_count].item()))
+    return fills
+
+
+def _round2(values):
+    scaled = values * 100
+    rounded = np.rint(scaled) / 100
+    # python rounds the exact value, which may be on the other side of a half than its product by 100
+    near_half = np.abs(np.abs(scaled - np.trunc(scaled)) - 0.5) <= np.abs(scaled) * 1e-15 + 1e-300
+    for i in np.flatnonzero(near_half).tolist():
+        rounded[i] = round(values[i].item(), 2)
+    return rounded
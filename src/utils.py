@@ -1,8 +1,18 @@
 from datetime import datetime
 
+_now = datetime.utcnow
+
+
+def set_clock(now=datetime.utcnow):
+    """
+    :param now: returns the current utc time, replaced to freeze the clock in offline runs
+    """
+    global _now
+    _now = now
+
 
 def get_current_utc_iso() -> str:
-    dt = datetime.utcnow()
+    dt = _now()
     return dt_to_iso(dt)
 
 
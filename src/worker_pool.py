@@ -0,0 +1,202 @@
+from collections import deque
+from queue import Empty, Queue
+from threading import Thread
+from time import monotonic
+from zlib import crc32
+
+from src import codec
+from src.logger import Logger
+
+# how often consumer loops without new records retry the records parked for a lease
+PARKED_RETRY_SECONDS = 0.05
+
+
+class RecordTicket:
+    __slots__ = ("sequence_number", "done")
+
+    def __init__(self, sequence_number: str):
+        self.sequence_number = sequence_number
+        self.done = False
+
+
+class ParkedTickets:
+    """
+    Marks the tickets of records an executor handled done, holding back
+    those it parked until another task lets go of their event.
+    """
+    def __init__(self, bet_executor):
+        self._bet_executor = bet_executor
+        self._tickets = []
+
+    def __len__(self) -> int:
+        return len(self._tickets)
+
+    def handled(self, ticket: RecordTicket = None):
+        """
+        :param ticket: of the record just handled, none to only recheck the parked ones
+        """
+        if ticket is not None:
+            self._tickets.append(ticket)
+        parked = []
+        for parked_ticket in self._tickets:
+            if self._bet_executor.is_parked(parked_ticket.sequence_number):
+                parked.append(parked_ticket)
+            else:
+                parked_ticket.done = True
+        self._tickets = parked
+
+
+class DeferredCheckpointState:
+    """
+    Wraps the consumer's checkpoint state so a record is only checkpointed
+    once it and every record before it on the same shard has been handled.
+
+    KinesisConsumer calls checkpoint(shard_id, seq) as soon as the record it
+    yielded is dispatched, which is where the record's shard is learned.
+    """
+    def __init__(self, state):
+        self._state = state
+        self._last_ticket = None
+        # shard_id -> tickets in the order the shard yielded them
+        self._pending = {}
+
+    def __getattr__(self, name: str):
+        # lock_shard, get_iterator_args, ... go straight to the real state
+        return getattr(self._state, name)
+
+    def track(self, ticket: RecordTicket):
+        self._last_ticket = ticket
+
+    def checkpoint(self, shard_id: str, seq: str):
+        ticket = self._last_ticket
+        self._last_ticket = None
+        if ticket is None or ticket.sequence_number != seq:
+            self._state.checkpoint(shard_id, seq)
+            return
+        self._pending.setdefault(shard_id, deque()).append(ticket)
+        self.advance()
+
+    def advance(self):
+        for shard_id, tickets in self._pending.items():
+            done_ticket = None
+            records = 0
+            while tickets and tickets[0].done:
+                done_ticket = tickets.popleft()
+                records += 1
+            if done_ticket is None:
+                continue
+            if isinstance(self._state, BatchedCheckpointState):
+                self._state.checkpoint(shard_id, done_ticket.sequence_number, records=records)
+            else:
+                self._state.checkpoint(shard_id, done_ticket.sequence_number)
+
+
+class BatchedCheckpointState:
+    """
+    Wraps the consumer's checkpoint state so each shard is only checkpointed
+    every every_records records or every_seconds, whichever comes first.
+
+    A restart replays whatever was handled since the last checkpoint, so this
+    is meant to run with the executor's replay guard on.
+    """
+    def __init__(self, state, every_records: int = 1, every_seconds: float = 0, clock=monotonic):
+        """
+        :param every_seconds: 0 to only checkpoint by record count
+        """
+        self._state = state
+        self._every_records = every_records
+        self._every_seconds = every_seconds
+        self._clock = clock
+        # shard_id -> (latest seq, records since the last checkpoint, time of the first of them)
+        self._pending = {}
+
+    def __getattr__(self, name: str):
+        return getattr(self._state, name)
+
+    def checkpoint(self, shard_id: str, seq: str, records: int = 1):
+        """
+        :param records: number of records seq advances the shard by
+        """
+        _, count, since = self._pending.get(shard_id, (None, 0, self._clock()))
+        count += records
+        if count >= self._every_records or (self._every_seconds and self._clock() - since >= self._every_seconds):
+            self._pending.pop(shard_id, None)
+            self._state.checkpoint(shard_id, seq)
+        else:
+            self._pending[shard_id] = (seq, count, since)
+
+    def flush(self):
+        pending, self._pending = self._pending, {}
+        for shard_id, (seq, _, _) in pending.items():
+            self._state.checkpoint(shard_id, seq)
+
+
+class EventWorkerPool:
+    """
+    Hands records to a fixed set of worker threads by event_id so records of
+    an event are handled in order by the same executor while independent
+    events are matched in parallel.
+
+    Each worker owns its executor, created by executor_factory, since
+    exchanges and publishers buffer state between calls.
+    """
+    def __init__(self, logger: Logger, executor_factory, worker_count: int, state: DeferredCheckpointState = None, queue_size: int = 1000):
+        self._logger = logger
+        self._state = state
+        self._queues = [Queue(maxsize=queue_size) for _ in range(worker_count)]
+        self._errors = []
+        self._workers = [
+            Thread(target=self._work, args=(executor_factory(), queue), name=f"bet-executor-{i}", daemon=True)
+            for i, queue in enumerate(self._queues)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, record: map):
+        if self._errors:
+            raise self._errors[0]
+        # decoded once here, the worker gets the data
+        data = codec.loads(record["Data"])
+        event_id = str(data.get("value", {}).get("event_id"))
+        ticket = RecordTicket(sequence_number=record.get("SequenceNumber"))
+        if self._state is not None:
+            self._state.track(ticket)
+        self._queues[crc32(event_id.encode("utf-8")) % len(self._queues)].put((data, ticket))
+
+    def close(self):
+        for queue in self._queues:
+            queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        if self._state is not None:
+            self._state.advance()
+        if self._errors:
+            raise self._errors[0]
+
+    def _work(self, bet_executor, queue: Queue):
+        failed = False
+        parked_tickets = ParkedTickets(bet_executor=bet_executor)
+        while True:
+            try:
+                # parked records are retried while no record comes in
+                item = queue.get(timeout=PARKED_RETRY_SECONDS if parked_tickets and not failed else None)
+            except Empty:
+                item = (None, None)
+            if item is None:
+                return
+            data, ticket = item
+            if failed:
+                # keep draining so the dispatcher never blocks on this queue
+                continue
+            try:
+                if data is None:
+                    bet_executor.retry_parked()
+                else:
+                    bet_executor.handle_data(data=data, sequence_number=ticket.sequence_number)
+            except Exception as e:
+                # the ticket stays pending so nothing past this record is checkpointed
+                self._logger.error("Worker error: %s", e)
+                self._errors.append(e)
+                failed = True
+                continue
+            parked_tickets.handled(ticket=ticket)
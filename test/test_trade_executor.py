@@ -1,15 +1,51 @@
+import asyncio
+import logging
 import os
+import signal
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from queue import Queue
 from json import dumps, load, loads
 
 import boto3
 import pytest
 from redis import StrictRedis
+from redis.crc import key_slot
 
-from test.mock_kinesis import MockKinesis
-from test.mock_redis import MockRedis
+from src.mock_kinesis import MockKinesis
+from src.mock_redis import AsyncMockRedis, MockRedis
+from src.async_bet_executer import AsyncBetExecutor
+from src.async_exchange import AsyncExchange
 from src.bet_executer import BetExecutor
+from src.publisher import AsyncKinesisPublisher, KinesisPublisher, PublishError
+from src import logger as logger_module
 from src.logger import LoggerFactory, Logger
-from src.domain_model import StatusDetails, Bet, ExecutedBets, ExecutedBet
+from src.market_data import MarketDataPublisher
+from src.domain_model import StatusDetails, Bet, ExecutedBets, ExecutedBet, PriceLevel
+from src.event_leases import EventLeases, LeaseHeldError, LeaseLostError
+from src.exchange import Exchange
+from src.handled_records import HandledRecords
+from src.member_codec import COMPACT, JSON, decode_member, encode_member
+from src import codec, core as core_module, keys, utils
+from src.status_cache import StatusCache
+from src import sweep_planner
+from src.instrumentation import InstrumentedBetExecutor, InstrumentedKinesis, InstrumentedRedis
+from src.metrics import Metrics
+from src.micro_batcher import MicroBatcher
+from src.profiling import Profiler
+from src.worker_pool import BatchedCheckpointState, DeferredCheckpointState, EventWorkerPool, ParkedTickets, RecordTicket
+from scripts import migrate_keys, replay
+from scripts.order_flow import OrderFlow
+
+
+ENGINES = ["redis", "memory", "lua"]
+
+
+@pytest.fixture
+def engine():
+    return "redis"
 
 
 @pytest.fixture
@@ -19,12 +55,17 @@ def logger():
 
 
 @pytest.fixture
-def redis_client():
+def redis_client(engine):
     # host = os.environ.get("REDIS_HOST")
     # port = os.environ.get("REDIS_PORT")
     # redis_client = StrictRedis(host=host, port=port, db=0)
     # return redis_client
-    client = MockRedis()
+    if engine == "lua":
+        # MockRedis can not evaluate scripts
+        fakeredis = pytest.importorskip("fakeredis")
+        client = fakeredis.FakeStrictRedis()
+    else:
+        client = MockRedis()
     status_details = StatusDetails(
         status="ACTIVE",
         home_team_abbrev="DEN",
@@ -58,13 +99,13 @@ def get_records(path: str):
     return records
 
 
-def get_bet_from_pq(values: list):
+def get_bet_from_pq(values: list, event_id: str, team_abbrev: str):
     value = next(iter(values), None)
     if not value:
         return None
 
     data, score = value
-    bet = Bet(**loads(data.decode("utf-8")))
+    bet = decode_member(data=data, event_id=event_id, team_abbrev=team_abbrev, score=score)
     return bet
 
 
@@ -75,10 +116,10 @@ def compare_bets_on_exchange(expected_output_path: str, redis_client, kinesis_cl
         # Check redis bets
         exp_exchange_bets = list(map(lambda x: Bet(**x), exp_details["redis"][team_abbrev]))
         actual_exchange_bets = []
-        exchange_bet = get_bet_from_pq(redis_client.zpopmax(name=f"pq:{event_id}:{team_abbrev}"))
+        exchange_bet = get_bet_from_pq(redis_client.zpopmax(name=f"pq:{event_id}:{team_abbrev}"), event_id=event_id, team_abbrev=team_abbrev)
         while exchange_bet:
             actual_exchange_bets.append(exchange_bet)
-            exchange_bet = get_bet_from_pq(redis_client.zpopmax(name=f"pq:{event_id}:{team_abbrev}"))
+            exchange_bet = get_bet_from_pq(redis_client.zpopmax(name=f"pq:{event_id}:{team_abbrev}"), event_id=event_id, team_abbrev=team_abbrev)
         assert len(exp_exchange_bets) == len(actual_exchange_bets), "Number expected bets does not match"
 
         for exp_exchange_bet in exp_exchange_bets:
@@ -129,14 +170,18 @@ def execute_and_compare(
         logger: Logger,
         redis_client,
         kinesis_client,
-        output_kinesis_stream_name: str
+        output_kinesis_stream_name: str,
+        engine: str = "redis",
+        member_encoding: str = JSON
 ):
     limit_bet_records = get_records(path=test_input_path)
     bet_executor = BetExecutor(
         logger=logger,
         redis_client=redis_client,
         kinesis_client=kinesis_client,
-        output_stream_name=output_kinesis_stream_name
+        output_stream_name=output_kinesis_stream_name,
+        engine=engine,
+        member_encoding=member_encoding
     )
     for record in limit_bet_records:
         bet_executor.handle_record(record=record)
@@ -160,14 +205,18 @@ def execute_and_compare(
         ("test/resources/limit-bet/new-limit-bet-not-better-than-wont-execute.json", "test/resources/limit-bet/new-limit-bet-not-better-than-wont-execute-output.json")
     ]
 )
-def test_limit_bet(test_input_path, test_output_path, logger, redis_client, kinesis_client, output_kinesis_stream_name):
+@pytest.mark.parametrize("member_encoding", [JSON, COMPACT])
+@pytest.mark.parametrize("engine", ENGINES)
+def test_limit_bet(test_input_path, test_output_path, engine, member_encoding, logger, redis_client, kinesis_client, output_kinesis_stream_name):
     execute_and_compare(
         test_input_path=test_input_path,
         test_output_path=test_output_path,
         logger=logger,
         redis_client=redis_client,
         kinesis_client=kinesis_client,
-        output_kinesis_stream_name=output_kinesis_stream_name
+        output_kinesis_stream_name=output_kinesis_stream_name,
+        engine=engine,
+        member_encoding=member_encoding
     )
 
 
@@ -180,14 +229,18 @@ def test_limit_bet(test_input_path, test_output_path, logger, redis_client, kine
         ("test/resources/market-bet/new-market-bet-multi-wont-execute.json", "test/resources/market-bet/new-market-bet-multi-wont-execute-output.json")
     ]
 )
-def test_market_bet(test_input_path, test_output_path, logger, redis_client, kinesis_client, output_kinesis_stream_name):
+@pytest.mark.parametrize("member_encoding", [JSON, COMPACT])
+@pytest.mark.parametrize("engine", ENGINES)
+def test_market_bet(test_input_path, test_output_path, engine, member_encoding, logger, redis_client, kinesis_client, output_kinesis_stream_name):
     execute_and_compare(
         test_input_path=test_input_path,
         test_output_path=test_output_path,
         logger=logger,
         redis_client=redis_client,
         kinesis_client=kinesis_client,
-        output_kinesis_stream_name=output_kinesis_stream_name
+        output_kinesis_stream_name=output_kinesis_stream_name,
+        engine=engine,
+        member_encoding=member_encoding
     )
 
 
@@ -197,14 +250,16 @@ def test_market_bet(test_input_path, test_output_path, logger, redis_client, kin
         ("test/resources/inactive-event/inactive-event.json", "test/resources/inactive-event/inactive-event-output.json")
     ]
 )
-def test_inactive_event(test_input_path, test_output_path, logger, redis_client, kinesis_client, output_kinesis_stream_name):
+@pytest.mark.parametrize("engine", ENGINES)
+def test_inactive_event(test_input_path, test_output_path, engine, logger, redis_client, kinesis_client, output_kinesis_stream_name):
     execute_and_compare(
         test_input_path=test_input_path,
         test_output_path=test_output_path,
         logger=logger,
         redis_client=redis_client,
         kinesis_client=kinesis_client,
-        output_kinesis_stream_name=output_kinesis_stream_name
+        output_kinesis_stream_name=output_kinesis_stream_name,
+        engine=engine
     )
 
 
@@ -216,12 +271,1385 @@ def test_inactive_event(test_input_path, test_output_path, logger, redis_client,
         ("test/resources/cancel-bet/cancel-bet-not-found.json", "test/resources/cancel-bet/cancel-bet-not-found-ouput.json")
     ]
 )
-def test_cancel_bet(test_input_path, test_output_path, logger, redis_client, kinesis_client, output_kinesis_stream_name):
+@pytest.mark.parametrize("engine", ENGINES)
+def test_cancel_bet(test_input_path, test_output_path, engine, logger, redis_client, kinesis_client, output_kinesis_stream_name):
     execute_and_compare(
         test_input_path=test_input_path,
         test_output_path=test_output_path,
         logger=logger,
         redis_client=redis_client,
         kinesis_client=kinesis_client,
-        output_kinesis_stream_name=output_kinesis_stream_name
+        output_kinesis_stream_name=output_kinesis_stream_name,
+        engine=engine
+    )
+
+
+def test_memory_engine_loads_and_evicts_books(logger, redis_client, kinesis_client, output_kinesis_stream_name):
+    resting_bet = Bet(
+        event_id="202012060kan",
+        sport="football",
+        bet_id=10,
+        brokerage_id=1,
+        user_id=1,
+        amount=20.0,
+        odds=200,
+        on_team_abbrev="KAN"
+    )
+    redis_client.zadd(name="pq:202012060kan:KAN", mapping={str(resting_bet): resting_bet.odds})
+    bet_executor = BetExecutor(
+        logger=logger,
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        output_stream_name=output_kinesis_stream_name,
+        engine="memory"
+    )
+    new_bet = {
+        "event_id": "202012060kan",
+        "sport": "football",
+        "bet_id": 11,
+        "brokerage_id": 1,
+        "user_id": 1,
+        "amount": 5.0,
+        "odds": 200,
+        "order_type": "limit",
+        "on_team_abbrev": "DEN"
+    }
+    bet_executor.handle_record(record={"Data": dumps({"action": "NEW_LIMIT_BET", "value": new_bet}).encode("utf-8")})
+
+    resting_bet.amount = 10.0
+    assert get_bet_from_pq(redis_client.zrange(name="pq:202012060kan:KAN", start=0, end=-1, withscores=True), event_id="202012060kan", team_abbrev="KAN") == resting_bet
+    assert len(kinesis_client.streams[output_kinesis_stream_name]) == 1
+
+    inactive_event_record = get_records(path="test/resources/inactive-event/inactive-event.json")[-1]
+    bet_executor.handle_record(record=inactive_event_record)
+
+    assert not bet_executor._exchange._books, "Books should be evicted on inactive event"
+    assert redis_client.zrange(name="pq:202012060kan:KAN", start=0, end=-1) == []
+    assert len(kinesis_client.streams[output_kinesis_stream_name]) == 3
+
+
+def test_publisher_retries_only_failed_records(logger, output_kinesis_stream_name):
+    kinesis_client = MockKinesis(failures=2)
+    publisher = KinesisPublisher(logger=logger, kinesis_client=kinesis_client, stream_name=output_kinesis_stream_name, backoff_seconds=0)
+    for i in range(4):
+        publisher.publish(data=dumps({"i": i}).encode("utf-8"), partition_key=f"event-{i}")
+    publisher.flush()
+
+    published = list(map(lambda x: loads(x)["i"], kinesis_client.streams[output_kinesis_stream_name]))
+    assert sorted(published) == [0, 1, 2, 3], "Every record should be published exactly once"
+    assert published[:2] == [1, 3], "Only failed records should be retried"
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+@pytest.mark.parametrize("batched", [False, True])
+def test_records_that_raise_are_not_marked_handled(batched, engine, logger, redis_client, kinesis_client, output_kinesis_stream_name):
+    records = get_records(path="test/resources/limit-bet/new-limit-bet-multi-execute.json")[:1]
+    records.append({"Data": dumps({"action": "NEW_LIMIT_BET", "value": {"event_id": "202012060kan", "bet_id": 9}}).encode("utf-8")})
+    bet_executor = BetExecutor(
+        logger=logger,
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        output_stream_name=output_kinesis_stream_name,
+        engine=engine,
+        replay_guard_ttl_seconds=3600
+    )
+    with pytest.raises(KeyError):
+        if batched:
+            bet_executor.handle_records(records=records)
+        else:
+            for record in records:
+                bet_executor.handle_record(record=record)
+    # the record before it was handled and stays marked
+    assert redis_client.smembers("handled:202012060kan") == {b"L1"}
+    assert redis_client.zcard("pq:202012060kan:KAN") == 1
+
+
+def test_publisher_retries_keep_order_within_a_partition_key(logger, output_kinesis_stream_name):
+    kinesis_client = MockKinesis(failures=1)
+    publisher = KinesisPublisher(logger=logger, kinesis_client=kinesis_client, stream_name=output_kinesis_stream_name, backoff_seconds=0)
+    for i in range(3):
+        publisher.publish(data=dumps({"i": i}).encode("utf-8"), partition_key="event")
+    publisher.publish(data=dumps({"i": 3}).encode("utf-8"), partition_key="other-event")
+    publisher.flush()
+
+    published = list(map(lambda x: loads(x)["i"], kinesis_client.streams[output_kinesis_stream_name]))
+    assert published == [1, 2, 3, 0, 1, 2], "Records after a failed one of the same key should be sent again after it"
+
+
+def test_publisher_splits_requests_at_record_limit(logger, output_kinesis_stream_name):
+    kinesis_client = MockKinesis()
+    publisher = KinesisPublisher(logger=logger, kinesis_client=kinesis_client, stream_name=output_kinesis_stream_name)
+    for i in range(KinesisPublisher.MAX_RECORDS_PER_REQUEST + 1):
+        publisher.publish(data=dumps({"i": i}).encode("utf-8"), partition_key="event")
+    assert len(kinesis_client.streams[output_kinesis_stream_name]) == KinesisPublisher.MAX_RECORDS_PER_REQUEST
+    publisher.flush()
+
+    published = list(map(lambda x: loads(x)["i"], kinesis_client.streams[output_kinesis_stream_name]))
+    assert published == list(range(KinesisPublisher.MAX_RECORDS_PER_REQUEST + 1))
+
+
+def test_unfillable_market_bet_leaves_book_untouched(logger, redis_client, kinesis_client, output_kinesis_stream_name, monkeypatch):
+    bet_executor = BetExecutor(
+        logger=logger,
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        output_stream_name=output_kinesis_stream_name
+    )
+    resting_bets = [
+        Bet(event_id="202012060kan", sport="football", bet_id=i, brokerage_id=1, user_id=1, amount=1.0, odds=100, on_team_abbrev="KAN")
+        for i in range(100)
+    ]
+    bet_executor._exchange.submit_bets(bets=resting_bets)
+
+    pipelines = []
+    create_pipeline = redis_client.pipeline
+
+    def counting_pipeline(transaction: bool = True):
+        pipelines.append(create_pipeline(transaction=transaction))
+        return pipelines[-1]
+
+    monkeypatch.setattr(redis_client, "pipeline", counting_pipeline)
+    market_bet = {
+        "event_id": "202012060kan",
+        "sport": "football",
+        "bet_id": 100,
+        "brokerage_id": 1,
+        "user_id": 1,
+        "amount": 1000.0,
+        "order_type": "market",
+        "on_team_abbrev": "DEN"
+    }
+    bet_executor.handle_record(record={"Data": dumps({"action": "NEW_MARKET_BET", "value": market_bet}).encode("utf-8")})
+
+    assert len(pipelines) == 0, "An unfillable market bet should not write to the book"
+    assert len(redis_client.zrange(name="pq:202012060kan:KAN", start=0, end=-1)) == 100
+    assert loads(kinesis_client.streams[output_kinesis_stream_name][0])["bets"][0]["status"] == "INSUFFICIENT_VOLUME"
+
+    popped_counts = []
+    zpopmax = redis_client.zpopmax
+
+    def counting_zpopmax(name: str, count: int = None):
+        popped = zpopmax(name=name, count=count)
+        popped_counts.append(len(popped))
+        return popped
+
+    monkeypatch.setattr(redis_client, "zpopmax", counting_zpopmax)
+    market_bet.update(bet_id=101, amount=30.0)
+    bet_executor.handle_record(record={"Data": dumps({"action": "NEW_MARKET_BET", "value": market_bet}).encode("utf-8")})
+
+    assert popped_counts == [30], "A fillable market bet should pop only the bets it consumes"
+    assert len(redis_client.zrange(name="pq:202012060kan:KAN", start=0, end=-1)) == 70
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_cancel_partially_executed_bet(engine, logger, redis_client, kinesis_client, output_kinesis_stream_name):
+    bet_executor = BetExecutor(
+        logger=logger,
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        output_stream_name=output_kinesis_stream_name,
+        engine=engine
+    )
+    for record in get_records(path="test/resources/limit-bet/new-limit-bet-multi-execute.json"):
+        bet_executor.handle_record(record=record)
+    cancel_bet = {
+        "event_id": "202012060kan",
+        "sport": "football",
+        "bet_id": 3,
+        "brokerage_id": 1,
+        "user_id": 1,
+        "odds": 200,
+        "on_team_abbrev": "DEN"
+    }
+    bet_executor.handle_record(record={"Data": dumps({"action": "CANCEL_BET", "value": cancel_bet}).encode("utf-8")})
+
+    cancelled = loads(kinesis_client.streams[output_kinesis_stream_name][-1])["bets"][0]
+    assert cancelled["bet_id"] == 3 and cancelled["amount"] == 36.67 and cancelled["status"] == "CANCELLED"
+    assert redis_client.zrange(name="pq:202012060kan:DEN", start=0, end=-1) == []
+    assert not redis_client.hgetall(name="idx:202012060kan:DEN")
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_legacy_json_members_are_matched_and_cancelled(engine, logger, redis_client, kinesis_client, output_kinesis_stream_name):
+    legacy_bet = Bet(
+        event_id="202012060kan",
+        sport="football",
+        bet_id=10,
+        brokerage_id=1,
+        user_id=1,
+        amount=20.0,
+        odds=200,
+        on_team_abbrev="KAN"
+    )
+    redis_client.zadd(name="pq:202012060kan:KAN", mapping={str(legacy_bet): legacy_bet.odds})
+    # json books keep working once compact is switched on
+    bet_executor = BetExecutor(
+        logger=logger,
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        output_stream_name=output_kinesis_stream_name,
+        engine=engine,
+        member_encoding=COMPACT
+    )
+    new_bet = {
+        "event_id": "202012060kan",
+        "sport": "football",
+        "bet_id": 11,
+        "brokerage_id": 1,
+        "user_id": 1,
+        "amount": 5.0,
+        "odds": 200,
+        "order_type": "limit",
+        "on_team_abbrev": "DEN"
+    }
+    bet_executor.handle_record(record={"Data": dumps({"action": "NEW_LIMIT_BET", "value": new_bet}).encode("utf-8")})
+    cancel_bet = {
+        "event_id": "202012060kan",
+        "sport": "football",
+        "bet_id": 10,
+        "brokerage_id": 1,
+        "user_id": 1,
+        "odds": 200,
+        "on_team_abbrev": "KAN"
+    }
+    bet_executor.handle_record(record={"Data": dumps({"action": "CANCEL_BET", "value": cancel_bet}).encode("utf-8")})
+
+    executed, cancelled = map(loads, kinesis_client.streams[output_kinesis_stream_name])
+    assert [bet["amount"] for bet in executed["bets"]] == [5.0, 10.0]
+    assert cancelled["bets"][0]["bet_id"] == 10 and cancelled["bets"][0]["amount"] == 10.0
+    assert redis_client.zrange(name="pq:202012060kan:KAN", start=0, end=-1) == []
+
+
+def test_member_encodings_round_trip():
+    bet = Bet(
+        event_id="202012060kan",
+        sport="football",
+        bet_id=3,
+        brokerage_id=1,
+        user_id=1,
+        amount=36.67,
+        odds=-110,
+        on_team_abbrev="DEN"
+    )
+    compact = encode_member(bet=bet, encoding=COMPACT)
+    legacy = encode_member(bet=bet, encoding=JSON)
+    assert len(compact) < len(legacy) / 3
+    assert legacy == str(bet).encode("utf-8")
+    for data in (compact, legacy):
+        assert decode_member(data=data, event_id="202012060kan", team_abbrev="DEN", score=-110.0) == bet
+
+
+@pytest.mark.parametrize("bet", [
+    Bet(event_id="202012060kan", sport="football", bet_id=1, brokerage_id=2, user_id=3, amount=20.0, odds=-200, on_team_abbrev="KAN"),
+    Bet(event_id="é\"\\\n", sport="fútbol", bet_id=2 ** 70, brokerage_id=-1, user_id=0, amount=1e-07, odds=150.5, on_team_abbrev="DEN"),
+    Bet(event_id="202012060kan", sport="football", bet_id="abc", brokerage_id=1, user_id=1, amount=1e22, odds=None, on_team_abbrev="KAN"),
+    Bet(event_id="202012060kan", sport="football", bet_id=1, brokerage_id=1, user_id=1, amount=True, odds=0.1 + 0.2, on_team_abbrev="KAN")
+])
+def test_codec_matches_json_dumps(bet):
+    bet_map = {field: getattr(bet, field) for field in ("event_id", "sport", "bet_id", "brokerage_id", "user_id", "amount", "odds", "on_team_abbrev")}
+    assert str(bet) == dumps(bet_map)
+    assert bytes(bet) == dumps(bet_map).encode("utf-8")
+
+    executed_bets = ExecutedBets(
+        event_id=bet.event_id,
+        sport=bet.sport,
+        bets=[ExecutedBet.frombet(bet=bet, status="EXECUTED"), ExecutedBet.frombet(bet=bet, status="PARTIALLY_EXECUTED")],
+        odds=bet.odds,
+        winning_team_abbrev=bet.on_team_abbrev
+    )
+    expected = dumps({
+        "event_id": executed_bets.event_id,
+        "sport": executed_bets.sport,
+        "odds": executed_bets.odds,
+        "execution_time": executed_bets.execution_time,
+        "bets": [executed_bet.as_map() for executed_bet in executed_bets.bets],
+        "winning_team_abbrev": executed_bets.winning_team_abbrev
+    })
+    assert str(executed_bets) == expected
+    assert bytes(executed_bets) == expected.encode("utf-8")
+    assert codec.loads(bytes(executed_bets)) == loads(expected)
+
+
+def test_status_cache_skips_redis_until_event_goes_inactive(logger, redis_client, kinesis_client, output_kinesis_stream_name, monkeypatch):
+    bet_executor = BetExecutor(
+        logger=logger,
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        output_stream_name=output_kinesis_stream_name,
+        status_cache=StatusCache(max_size=16, ttl_seconds=60)
+    )
+    gets = []
+    redis_get = redis_client.get
+    monkeypatch.setattr(redis_client, "get", lambda name: gets.append(name) or redis_get(name))
+
+    records = get_records(path="test/resources/inactive-event/inactive-event.json")
+    for record in records[:-1]:
+        bet_executor.handle_record(record=record)
+    assert gets == ["event:202012060kan"]
+
+    redis_client.set(name="event:202012060kan", value=str(StatusDetails(status="INACTIVE", home_team_abbrev="DEN", away_team_abbrev="KAN")))
+    bet_executor.handle_record(record=records[-1])
+    bet_executor.handle_record(record=records[0])
+    assert len(gets) == 2
+    assert loads(kinesis_client.streams[output_kinesis_stream_name][-1])["bets"][0]["status"] == "CANCELLED"
+
+
+def test_status_cache_expires_and_evicts_least_recently_used():
+    now = [0.0]
+    cache = StatusCache(max_size=2, ttl_seconds=5, clock=lambda: now[0])
+    status_details = StatusDetails(status="ACTIVE", home_team_abbrev="DEN", away_team_abbrev="KAN")
+    cache.put(event_id="a", status_details=status_details)
+    cache.put(event_id="b", status_details=status_details)
+    assert cache.get(event_id="a") is status_details
+    cache.put(event_id="c", status_details=status_details)
+    assert cache.get(event_id="b") is None
+    assert cache.get(event_id="a") is status_details
+
+    now[0] = 5.0
+    assert cache.get(event_id="a") is None
+    assert cache.get(event_id="c") is None
+
+
+def test_worker_pool_keeps_event_order_and_checkpoints_only_finished_records(logger):
+    class RecordingState:
+        def __init__(self):
+            self.checkpoints = []
+
+        def checkpoint(self, shard_id, seq):
+            self.checkpoints.append((shard_id, seq))
+
+    class RecordingExecutor:
+        def __init__(self):
+            self.handled = []
+
+        def handle_data(self, data, sequence_number=None):
+            if sequence_number == "1":
+                blocked.wait(timeout=5)
+            self.handled.append(sequence_number)
+
+        def is_parked(self, sequence_number):
+            return False
+
+    blocked = threading.Event()
+    executors = []
+
+    def executor_factory():
+        executors.append(RecordingExecutor())
+        return executors[-1]
+
+    state = RecordingState()
+    deferred_state = DeferredCheckpointState(state=state)
+    pool = EventWorkerPool(logger=logger, executor_factory=executor_factory, worker_count=4, state=deferred_state)
+    event_ids = ["202012060kan", "202012060kan", "202012130buf", "202012060kan"]
+    for seq, event_id in enumerate(event_ids, start=1):
+        pool.submit({"SequenceNumber": str(seq), "Data": dumps({"action": "NEW_LIMIT_BET", "value": {"event_id": event_id}}).encode("utf-8")})
+        deferred_state.checkpoint("shard-0", str(seq))
+
+    # record 3 is on another event so it finishes while record 1 is blocked
+    for _ in range(100):
+        if any(executor.handled == ["3"] for executor in executors):
+            break
+        time.sleep(0.01)
+    deferred_state.advance()
+    assert state.checkpoints == []
+
+    blocked.set()
+    pool.close()
+    assert sorted(executor.handled for executor in executors if executor.handled) == [["1", "2", "4"], ["3"]]
+    assert state.checkpoints[-1] == ("shard-0", "4")
+
+
+def test_worker_pool_decodes_each_record_once(logger, redis_client, kinesis_client, output_kinesis_stream_name, monkeypatch):
+    records = get_records(path="test/resources/limit-bet/new-limit-bet-multi-execute.json")
+    decoded = []
+    codec_loads = codec.loads
+    monkeypatch.setattr(codec, "loads", lambda data: decoded.append(data) or codec_loads(data))
+
+    def executor_factory():
+        return BetExecutor(
+            logger=logger,
+            redis_client=redis_client,
+            kinesis_client=kinesis_client,
+            output_stream_name=output_kinesis_stream_name
+        )
+
+    pool = EventWorkerPool(logger=logger, executor_factory=executor_factory, worker_count=2)
+    for record in records:
+        pool.submit(record)
+    pool.close()
+    # statuses and resting bets are decoded too
+    assert [data for data in decoded if any(data is record["Data"] for record in records)] == [record["Data"] for record in records]
+    compare_bets_on_exchange(
+        expected_output_path="test/resources/limit-bet/new-limit-bet-multi-execute-output.json",
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        team_abbrevs=["DEN", "KAN"],
+        event_id="202012060kan",
+        output_stream_name=output_kinesis_stream_name
+    )
+
+
+def async_redis_client(redis_client):
+    if isinstance(redis_client, MockRedis):
+        return AsyncMockRedis(client=redis_client)
+    # fakeredis clients on the same host share their data
+    fakeredis = pytest.importorskip("fakeredis")
+    return fakeredis.FakeAsyncRedis(host=redis_client.connection_pool.connection_kwargs["host"])
+
+
+@pytest.mark.parametrize(
+    "test_input_path,test_output_path",
+    [
+        ("test/resources/limit-bet/new-limit-bet-multi-execute.json", "test/resources/limit-bet/new-limit-bet-multi-execute-output.json"),
+        ("test/resources/market-bet/new-market-bet-multi-will-execute.json", "test/resources/market-bet/new-market-bet-multi-will-execute-output.json"),
+        ("test/resources/market-bet/new-market-bet-multi-wont-execute.json", "test/resources/market-bet/new-market-bet-multi-wont-execute-output.json"),
+        ("test/resources/inactive-event/inactive-event.json", "test/resources/inactive-event/inactive-event-output.json"),
+        ("test/resources/cancel-bet/cancel-bet-multiple-with-same-score.json", "test/resources/cancel-bet/cancel-bet-multiple-with-same-score-output.json")
+    ]
+)
+@pytest.mark.parametrize("engine", ["redis", "lua"])
+def test_async_executor_matches_sync_outputs(test_input_path, test_output_path, engine, logger, redis_client, kinesis_client, output_kinesis_stream_name):
+    async def run():
+        # async clients bind to the running loop before python 3.10
+        bet_executor = AsyncBetExecutor(
+            logger=logger,
+            redis_client=async_redis_client(redis_client),
+            kinesis_client=kinesis_client,
+            output_stream_name=output_kinesis_stream_name,
+            engine=engine,
+            max_in_flight=4
+        )
+        for record in get_records(path=test_input_path):
+            await bet_executor.submit(record=record)
+        await bet_executor.drain()
+
+    asyncio.run(run())
+
+    compare_bets_on_exchange(
+        expected_output_path=test_output_path,
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        team_abbrevs=["DEN", "KAN"],
+        event_id="202012060kan",
+        output_stream_name=output_kinesis_stream_name
+    )
+
+
+@pytest.mark.parametrize("engine", ["redis", "lua"])
+def test_async_records_in_flight_do_not_share_deferred_writes(engine, logger, redis_client, kinesis_client, output_kinesis_stream_name, monkeypatch):
+    redis_client.set(name="event:202012070den", value=str(StatusDetails(status="ACTIVE", home_team_abbrev="DEN", away_team_abbrev="KAN")))
+    records = get_records(path="test/resources/limit-bet/new-limit-bet-multi-execute.json")
+    other_records = [
+        {"Data": record["Data"].replace(b"202012060kan", b"202012070den")}
+        for record in records
+    ]
+    put_records = AsyncKinesisPublisher._put_records
+
+    def fail_other_event(self, records: list):
+        if any(record["PartitionKey"] == "202012070den" for record in records):
+            raise PublishError(f"Failed to put {len(records)} records")
+        put_records(self, records)
+
+    monkeypatch.setattr(AsyncKinesisPublisher, "_put_records", fail_other_event)
+
+    async def run():
+        bet_executor = AsyncBetExecutor(
+            logger=logger,
+            redis_client=async_redis_client(redis_client),
+            kinesis_client=kinesis_client,
+            output_stream_name=output_kinesis_stream_name,
+            engine=engine,
+            replay_guard_ttl_seconds=3600
+        )
+        tasks = []
+        for record, other_record in zip(records, other_records):
+            tasks.append(await bet_executor.submit(record=record))
+            tasks.append(await bet_executor.submit(record=other_record))
+        await asyncio.wait(tasks)
+        return [task.exception() for task in tasks]
+
+    errors = asyncio.run(run())
+
+    assert [type(error) for error in errors] == [type(None)] * 5 + [PublishError]
+    assert redis_client.smembers("handled:202012060kan") == {b"L1", b"L2", b"L3"}
+    assert redis_client.smembers("handled:202012070den") == {b"L1", b"L2"}
+    compare_bets_on_exchange(
+        expected_output_path="test/resources/limit-bet/new-limit-bet-multi-execute-output.json",
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        team_abbrevs=["DEN", "KAN"],
+        event_id="202012060kan",
+        output_stream_name=output_kinesis_stream_name
+    )
+
+
+@pytest.mark.parametrize("engine", ["redis", "lua"])
+def test_async_event_chain_stops_at_a_failed_record(engine, logger, redis_client, kinesis_client, output_kinesis_stream_name, monkeypatch):
+    records = get_records(path="test/resources/limit-bet/new-limit-bet-multi-execute.json")
+
+    get_status = AsyncExchange.get_status
+    calls = []
+
+    async def fail_first_status(self, event_id: str):
+        calls.append(event_id)
+        if len(calls) == 1:
+            raise ConnectionError("redis went away")
+        return await get_status(self, event_id=event_id)
+
+    monkeypatch.setattr(AsyncExchange, "get_status", fail_first_status)
+
+    async def run():
+        bet_executor = AsyncBetExecutor(
+            logger=logger,
+            redis_client=async_redis_client(redis_client),
+            kinesis_client=kinesis_client,
+            output_stream_name=output_kinesis_stream_name,
+            engine=engine,
+            replay_guard_ttl_seconds=3600
+        )
+        tasks = [await bet_executor.submit(record=record) for record in records]
+        await asyncio.wait(tasks)
+        with pytest.raises(ConnectionError):
+            await bet_executor.submit(record=records[0])
+        return [task.exception() for task in tasks]
+
+    errors = asyncio.run(run())
+
+    # the records behind the failed one never ran
+    assert [type(error) for error in errors] == [ConnectionError] * 3
+    assert calls == ["202012060kan"]
+    assert redis_client.zcard("pq:202012060kan:KAN") == 0
+    assert redis_client.zcard("pq:202012060kan:DEN") == 0
+    assert not redis_client.smembers("handled:202012060kan")
+
+
+@pytest.mark.parametrize(
+    "test_input_path,test_output_path",
+    [
+        ("test/resources/limit-bet/new-limit-bet-multi-execute.json", "test/resources/limit-bet/new-limit-bet-multi-execute-output.json"),
+        ("test/resources/market-bet/new-market-bet-multi-wont-execute.json", "test/resources/market-bet/new-market-bet-multi-wont-execute-output.json"),
+        ("test/resources/inactive-event/inactive-event.json", "test/resources/inactive-event/inactive-event-output.json")
+    ]
+)
+@pytest.mark.parametrize("engine", ENGINES)
+def test_batched_records_match_single_record_outputs(test_input_path, test_output_path, engine, logger, redis_client, kinesis_client, output_kinesis_stream_name, monkeypatch):
+    bet_executor = BetExecutor(
+        logger=logger,
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        output_stream_name=output_kinesis_stream_name,
+        engine=engine
+    )
+    gets = []
+    redis_get = redis_client.get
+    monkeypatch.setattr(redis_client, "get", lambda name: gets.append(name) or redis_get(name))
+
+    records = get_records(path=test_input_path)
+    bet_executor.handle_records(records=records)
+
+    assert gets == ["event:202012060kan"], "Event status should be read once per group"
+    compare_bets_on_exchange(
+        expected_output_path=test_output_path,
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        team_abbrevs=["DEN", "KAN"],
+        event_id="202012060kan",
+        output_stream_name=output_kinesis_stream_name
+    )
+
+
+def test_micro_batcher_grows_with_backlog_and_shrinks_when_idle():
+    items = Queue()
+    now = datetime(2020, 12, 6, 18, 0, tzinfo=timezone.utc).timestamp()
+    batcher = MicroBatcher(items=items, max_batch_size=4, max_wait_ms=1, high_lag_ms=1000, low_lag_ms=200, clock=lambda: now)
+
+    def record(lag_seconds: float):
+        return {"ApproximateArrivalTimestamp": datetime.fromtimestamp(now - lag_seconds, tz=timezone.utc)}, None
+
+    for _ in range(11):
+        items.put(record(lag_seconds=5))
+    assert [len(batcher.next_batch()) for _ in range(4)] == [1, 2, 4, 4]
+    assert batcher.batch_size == 4
+
+    items.put(record(lag_seconds=0))
+    assert len(batcher.next_batch()) == 1
+    assert batcher.batch_size == 2
+
+    assert batcher.next_batch(timeout=0.01) == []
+    assert not batcher.closed
+
+    items.put(None)
+    assert batcher.next_batch() == []
+    assert batcher.closed
+
+
+@pytest.mark.parametrize(
+    "test_input_path,test_output_path",
+    [
+        ("test/resources/limit-bet/new-limit-bet-multi-execute.json", "test/resources/limit-bet/new-limit-bet-multi-execute-output.json"),
+        ("test/resources/market-bet/new-market-bet-multi-will-execute.json", "test/resources/market-bet/new-market-bet-multi-will-execute-output.json"),
+        ("test/resources/cancel-bet/cancel-bet-basic.json", "test/resources/cancel-bet/cancel-bet-basic-output.json")
+    ]
+)
+@pytest.mark.parametrize("engine", ENGINES)
+@pytest.mark.parametrize("batched", [False, True])
+def test_instrumented_executor_keeps_outputs_and_exports_metrics(batched, test_input_path, test_output_path, engine, logger, redis_client, kinesis_client, output_kinesis_stream_name):
+    metrics = Metrics()
+    bet_executor = InstrumentedBetExecutor(
+        metrics=metrics,
+        logger=logger,
+        redis_client=InstrumentedRedis(client=redis_client, metrics=metrics),
+        kinesis_client=InstrumentedKinesis(client=kinesis_client, metrics=metrics),
+        output_stream_name=output_kinesis_stream_name,
+        engine=engine
+    )
+    records = get_records(path=test_input_path)
+    if batched:
+        bet_executor.handle_records(records=records)
+    else:
+        for record in records:
+            bet_executor.handle_record(record=record)
+
+    compare_bets_on_exchange(
+        expected_output_path=test_output_path,
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        team_abbrevs=["DEN", "KAN"],
+        event_id="202012060kan",
+        output_stream_name=output_kinesis_stream_name
+    )
+
+    exported = metrics.render_prometheus()
+    actions = [loads(record["Data"])["action"] for record in records]
+    for action in set(actions):
+        assert f'bexh_exchange_records_total{{action="{action}"}} {actions.count(action)}' in exported
+        assert f'bexh_exchange_record_seconds_count{{action="{action}"}} {actions.count(action)}' in exported
+    # a batch decodes its records before any is handled
+    for stage in ("get_status", "redis_writes", "publish", "match") if batched else ("decode", "get_status", "redis_writes", "publish", "match"):
+        assert f'bexh_exchange_stage_seconds_count{{stage="{stage}"}}' in exported
+    assert "bexh_exchange_redis_round_trips_per_record_bucket" in exported
+    depth = sum(redis_client.zcard(f"pq:202012060kan:{team_abbrev}") for team_abbrev in ("DEN", "KAN"))
+    assert f"bexh_exchange_book_depth {depth}" in exported and "bexh_exchange_books 2" in exported
+    assert "event_id=" not in exported
+    if "execute" in test_input_path:
+        assert "bexh_exchange_fills_total" in exported and "bexh_exchange_levels_swept_total" in exported
+
+    emf = [loads(line) for line in metrics.render_emf()]
+    assert any(line.get("kinesis_calls", 0) > 0 for line in emf)
+    assert not any("kinesis_calls" in line for line in map(loads, metrics.render_emf())), "EMF reports deltas"
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_book_depth_is_summed_over_the_executors_of_a_pool(engine, logger, redis_client, kinesis_client, output_kinesis_stream_name):
+    metrics = Metrics()
+    for event_id in ("202012060kan", "202012130buf"):
+        redis_client.set(name=Exchange.status_name(event_id), value=str(StatusDetails(status="ACTIVE", home_team_abbrev="DEN", away_team_abbrev="KAN")))
+        bet_executor = InstrumentedBetExecutor(
+            metrics=metrics,
+            logger=logger,
+            redis_client=redis_client,
+            kinesis_client=kinesis_client,
+            output_stream_name=output_kinesis_stream_name,
+            engine=engine
+        )
+        for record in get_records(path="test/resources/limit-bet/new-limit-bet-basic-execute.json"):
+            data = loads(record["Data"])
+            data["value"]["event_id"] = event_id
+            bet_executor.handle_data(data=data)
+
+    depth = sum(redis_client.zcard(f"pq:{event_id}:{team_abbrev}") for event_id in ("202012060kan", "202012130buf") for team_abbrev in ("DEN", "KAN"))
+    assert depth > 0
+    metrics.collect()
+    _, gauges, _ = metrics.snapshot()
+    assert gauges == {("book_depth", ()): depth, ("books", ()): 4}
+
+
+def test_logger_defers_formatting_and_keeps_fields(caplog):
+    class Counted:
+        formatted = 0
+
+        def __str__(self):
+            Counted.formatted += 1
+            return "counted value"
+
+    info_logger = LoggerFactory().get_logger(name="test_logger_info", log_level="INFO")
+    info_logger.debug("popped bet %s", Counted(), bet=Counted())
+    assert Counted.formatted == 0
+    assert not info_logger.is_enabled_for("DEBUG")
+
+    debug_logger = LoggerFactory().get_logger(name="test_logger_debug", log_level="DEBUG")
+    LoggerFactory().get_logger(name="test_logger_debug", log_level="DEBUG")
+    assert len(logging.getLogger("test_logger_debug").handlers) == 1
+    with caplog.at_level(logging.DEBUG, logger="test_logger_debug"):
+        debug_logger.debug("popped bet", bet_id=7, team="DEN", status=Counted())
+    assert list(caplog.records[-1].fields) == ["bet_id", "team", "status"]
+    assert logger_module.format_fields(caplog.records[-1].fields) == ' bet_id=7 team=DEN status="counted value"'
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_price_levels_follow_submits_fills_and_cancels(engine, logger, redis_client, kinesis_client, output_kinesis_stream_name):
+    bet_executor = BetExecutor(
+        logger=logger,
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        output_stream_name=output_kinesis_stream_name,
+        engine=engine
+    )
+
+    def handle(action: str, **value):
+        value.update(event_id="202012060kan", sport="football", brokerage_id=1, user_id=1)
+        bet_executor.handle_record(record={"Data": dumps({"action": action, "value": value}).encode("utf-8")})
+
+    for bet_id, odds, amount in [(1, 150, 9.0), (2, 150, 9.0), (3, 200, 20.0), (4, 120, 8.0)]:
+        handle("NEW_LIMIT_BET", bet_id=bet_id, amount=amount, odds=odds, order_type="limit", on_team_abbrev="KAN")
+    handle("NEW_MARKET_BET", bet_id=5, amount=16.0, order_type="market", on_team_abbrev="DEN")
+    handle("CANCEL_BET", bet_id=4, odds=120, on_team_abbrev="KAN")
+
+    exchange = Exchange(redis_client=redis_client)
+    levels = exchange.book_levels(event_id="202012060kan", team_abbrev="KAN", is_home_team=False)
+    assert levels == [PriceLevel(odds=150, amount=9.0, count=1)]
+    assert exchange.top_of_book(event_id="202012060kan", team_abbrev="KAN", is_home_team=False) == levels[0]
+    assert exchange.book_levels(event_id="202012060kan", team_abbrev="DEN", is_home_team=True) == []
+
+    exchange.rebuild_levels(event_id="202012060kan", team_abbrev="KAN")
+    assert exchange.book_levels(event_id="202012060kan", team_abbrev="KAN", is_home_team=False, depth=5) == levels
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_legacy_books_get_levels_from_the_migration_before_they_are_popped(engine, logger, redis_client, kinesis_client, output_kinesis_stream_name):
+    # written before the levels were kept
+    for bet_id, amount, odds in [(10, 20.0, 200), (11, 10.0, 300), (12, 7.5, 300)]:
+        legacy_bet = Bet(event_id="202012060kan", sport="football", bet_id=bet_id, brokerage_id=1, user_id=1, amount=amount, odds=odds, on_team_abbrev="KAN")
+        redis_client.zadd(name="pq:202012060kan:KAN", mapping={str(legacy_bet): legacy_bet.odds})
+    assert migrate_keys.rebuild_levels(client=redis_client) == 1
+
+    bet_executor = BetExecutor(
+        logger=logger,
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        output_stream_name=output_kinesis_stream_name,
+        engine=engine
+    )
+    new_bet = {
+        "event_id": "202012060kan",
+        "sport": "football",
+        "bet_id": 13,
+        "brokerage_id": 1,
+        "user_id": 1,
+        "amount": 5.0,
+        "order_type": "market",
+        "on_team_abbrev": "DEN"
+    }
+    bet_executor.handle_record(record={"Data": dumps({"action": "NEW_MARKET_BET", "value": new_bet}).encode("utf-8")})
+
+    levels = {}
+    for data, score in redis_client.zrange(name="pq:202012060kan:KAN", start=0, end=-1, withscores=True):
+        resting_bet = decode_member(data=data, event_id="202012060kan", team_abbrev="KAN", score=score)
+        amount, count = levels.get(resting_bet.odds, (0, 0))
+        levels[resting_bet.odds] = (round(amount + resting_bet.amount, 2), count + 1)
+    assert sum(count for _, count in levels.values()) == 2, "The market bet should have filled one resting bet"
+    exchange = Exchange(redis_client=redis_client)
+    assert exchange.book_levels(event_id="202012060kan", team_abbrev="KAN", is_home_team=False) == [
+        PriceLevel(odds=odds, amount=amount, count=count) for odds, (amount, count) in sorted(levels.items(), reverse=True)
+    ]
+
+
+@pytest.mark.parametrize("engine", ["redis", "lua"])
+@pytest.mark.parametrize("upgrade", ["migration", "legacy_cancel_scan"])
+def test_legacy_books_are_cancelled_from_the_migrated_index(upgrade, engine, logger, redis_client, kinesis_client, output_kinesis_stream_name):
+    # written before the index was kept
+    for bet_id, odds in [(10, 200), (11, 200), (12, 300)]:
+        legacy_bet = Bet(event_id="202012060kan", sport="football", bet_id=bet_id, brokerage_id=1, user_id=1, amount=20.0, odds=odds, on_team_abbrev="KAN")
+        redis_client.zadd(name="pq:202012060kan:KAN", mapping={str(legacy_bet): legacy_bet.odds})
+    cancel_record = {"Data": dumps({"action": "CANCEL_BET", "value": {
+        "event_id": "202012060kan",
+        "sport": "football",
+        "bet_id": 11,
+        "brokerage_id": 1,
+        "user_id": 1,
+        "odds": 200,
+        "on_team_abbrev": "KAN"
+    }}).encode("utf-8")}
+
+    def create_bet_executor(legacy_cancel_scan: bool):
+        return BetExecutor(
+            logger=logger,
+            redis_client=redis_client,
+            kinesis_client=kinesis_client,
+            output_stream_name=output_kinesis_stream_name,
+            engine=engine,
+            legacy_cancel_scan=legacy_cancel_scan
+        )
+
+    # the odds are not scanned by default
+    create_bet_executor(legacy_cancel_scan=False).handle_record(record=cancel_record)
+    assert not kinesis_client.streams.get(output_kinesis_stream_name)
+    assert redis_client.zcard("pq:202012060kan:KAN") == 3
+
+    if upgrade == "migration":
+        assert migrate_keys.rebuild_indexes(client=redis_client) == 1
+        assert len(redis_client.hgetall("idx:202012060kan:KAN")) == 3
+    create_bet_executor(legacy_cancel_scan=upgrade == "legacy_cancel_scan").handle_record(record=cancel_record)
+    cancelled = loads(kinesis_client.streams[output_kinesis_stream_name][-1])["bets"][0]
+    assert cancelled["bet_id"] == 11 and cancelled["status"] == "CANCELLED"
+    assert redis_client.zcard("pq:202012060kan:KAN") == 2
+
+
+def test_market_data_coalesces_snapshots_per_event(logger, redis_client, kinesis_client, output_kinesis_stream_name):
+    market_data = MarketDataPublisher(
+        logger=logger,
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        stream_name="market-data",
+        depth=2,
+        max_events=1
     )
+    bet_executor = BetExecutor(
+        logger=logger,
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        output_stream_name=output_kinesis_stream_name,
+        market_data=market_data
+    )
+    for bet_id, odds in enumerate([150, 200, 120, 150]):
+        value = dict(event_id="202012060kan", sport="football", bet_id=bet_id, brokerage_id=1, user_id=1, amount=10.0, odds=odds, order_type="limit", on_team_abbrev="KAN")
+        bet_executor.handle_record(record={"Data": dumps({"action": "NEW_LIMIT_BET", "value": value}).encode("utf-8")})
+    market_data.mark(event_id="202012070buf")
+    market_data.publish_changed()
+
+    snapshots = [loads(data) for data in kinesis_client.streams["market-data"]]
+    assert len(snapshots) == 1, "A burst on one event should give one snapshot and marks past max_events are dropped"
+    assert snapshots[0]["home"] == []
+    assert snapshots[0]["away"] == [{"odds": 200, "amount": 10.0, "count": 1}, {"odds": 150, "amount": 20.0, "count": 2}]
+
+    market_data.mark(event_id="202012060kan")
+    market_data.publish_changed()
+    assert len(kinesis_client.streams["market-data"]) == 1, "An unchanged book should not be published again"
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_replayed_records_are_skipped(engine, logger, redis_client, kinesis_client, output_kinesis_stream_name):
+    records = get_records(path="test/resources/limit-bet/new-limit-bet-multi-execute.json")
+
+    def create_bet_executor():
+        return BetExecutor(
+            logger=logger,
+            redis_client=redis_client,
+            kinesis_client=kinesis_client,
+            output_stream_name=output_kinesis_stream_name,
+            engine=engine,
+            replay_guard_ttl_seconds=3600
+        )
+
+    bet_executor = create_bet_executor()
+    for record in records:
+        bet_executor.handle_record(record=record)
+
+    # a restart replays every record since the last checkpoint
+    bet_executor = create_bet_executor()
+    for record in records:
+        bet_executor.handle_record(record=record)
+
+    compare_bets_on_exchange(
+        expected_output_path="test/resources/limit-bet/new-limit-bet-multi-execute-output.json",
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        team_abbrevs=["DEN", "KAN"],
+        event_id="202012060kan",
+        output_stream_name=output_kinesis_stream_name
+    )
+
+
+@pytest.mark.parametrize("batched", [False, True])
+@pytest.mark.parametrize("engine", ENGINES)
+def test_records_whose_publish_failed_are_handled_again_on_replay(batched, engine, logger, redis_client, kinesis_client, output_kinesis_stream_name, monkeypatch):
+    records = get_records(path="test/resources/limit-bet/new-limit-bet-expired-event.json")
+
+    def create_bet_executor():
+        return BetExecutor(
+            logger=logger,
+            redis_client=redis_client,
+            kinesis_client=kinesis_client,
+            output_stream_name=output_kinesis_stream_name,
+            engine=engine,
+            replay_guard_ttl_seconds=3600
+        )
+
+    def handle(bet_executor: BetExecutor):
+        if batched:
+            bet_executor.handle_records(records=records)
+        else:
+            for record in records:
+                bet_executor.handle_record(record=record)
+
+    def fail(self, records: list):
+        raise PublishError(f"Failed to put {len(records)} records")
+
+    with monkeypatch.context() as m:
+        m.setattr(KinesisPublisher, "_put_records", fail)
+        with pytest.raises(PublishError):
+            handle(bet_executor=create_bet_executor())
+    assert kinesis_client.streams.get(output_kinesis_stream_name) is None
+
+    # the restart replays the record, which was not marked handled
+    handle(bet_executor=create_bet_executor())
+    # and once its executions are out it is
+    handle(bet_executor=create_bet_executor())
+
+    compare_bets_on_exchange(
+        expected_output_path="test/resources/limit-bet/new-limit-bet-expired-event-output.json",
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        team_abbrevs=["DEN", "KAN"],
+        event_id="NOT_REAL_EVENT",
+        output_stream_name=output_kinesis_stream_name
+    )
+
+
+def test_batched_checkpoints_pass_on_every_n_records_or_seconds():
+    class State:
+        def __init__(self):
+            self.checkpoints = []
+
+        def checkpoint(self, shard_id: str, seq: str):
+            self.checkpoints.append((shard_id, seq))
+
+    now = [0.0]
+    state = State()
+    batched_state = BatchedCheckpointState(state=state, every_records=3, every_seconds=10, clock=lambda: now[0])
+    for seq in range(1, 6):
+        batched_state.checkpoint("shard-0", str(seq))
+    assert state.checkpoints == [("shard-0", "3")]
+
+    batched_state.checkpoint("shard-1", "1")
+    now[0] = 11.0
+    batched_state.checkpoint("shard-1", "2")
+    assert state.checkpoints == [("shard-0", "3"), ("shard-1", "2")]
+
+    batched_state.flush()
+    assert state.checkpoints == [("shard-0", "3"), ("shard-1", "2"), ("shard-0", "5")]
+
+
+def test_batched_checkpoints_count_the_records_a_deferred_checkpoint_advances_past():
+    class State:
+        def __init__(self):
+            self.checkpoints = []
+
+        def checkpoint(self, shard_id: str, seq: str):
+            self.checkpoints.append((shard_id, seq))
+
+    state = State()
+    deferred_state = DeferredCheckpointState(state=BatchedCheckpointState(state=state, every_records=3))
+    tickets = []
+    for seq in range(1, 5):
+        ticket = RecordTicket(sequence_number=str(seq))
+        tickets.append(ticket)
+        deferred_state.track(ticket)
+        deferred_state.checkpoint("shard-0", str(seq))
+    assert state.checkpoints == []
+
+    # record 1 finishing last moves the shard past four records at once
+    for ticket in tickets[1:] + tickets[:1]:
+        ticket.done = True
+        deferred_state.advance()
+    assert state.checkpoints == [("shard-0", "4")]
+
+
+def test_handled_records_outlive_a_ttl_under_a_second():
+    fakeredis = pytest.importorskip("fakeredis")
+    client = fakeredis.FakeStrictRedis()
+    handled_records = HandledRecords(redis_client=client)
+    handled_records.add(handled_name="handled:202012060kan", keys=["shard-0:1"], ttl_seconds=0.5)
+    assert handled_records.contains(handled_name="handled:202012060kan", key="shard-0:1")
+    assert 0 < client.pttl("handled:202012060kan") <= 500
+
+
+@pytest.mark.parametrize("mode", ["cprofile", "sampling"])
+def test_profiler_wraps_executors_only_for_a_window(mode, tmp_path, logger, redis_client, kinesis_client, output_kinesis_stream_name):
+    records = get_records(path="test/resources/limit-bet/new-limit-bet-multi-execute.json")
+    bet_executor = BetExecutor(
+        logger=logger,
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        output_stream_name=output_kinesis_stream_name
+    )
+    profiler = Profiler(logger=logger, mode=mode, records=2, output_dir=str(tmp_path), sample_interval_ms=0.1)
+    profiler.attach(bet_executor)
+    assert "handle_record" not in vars(bet_executor)
+
+    profiler.start()
+    assert "handle_record" in vars(bet_executor)
+    for record in records[:2]:
+        bet_executor.handle_record(record=record)
+    assert "handle_record" not in vars(bet_executor)
+    assert len(list(tmp_path.iterdir())) == 1
+
+    for record in records[2:]:
+        bet_executor.handle_record(record=record)
+    assert len(list(tmp_path.iterdir())) == 1
+
+    compare_bets_on_exchange(
+        expected_output_path="test/resources/limit-bet/new-limit-bet-multi-execute-output.json",
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        team_abbrevs=["DEN", "KAN"],
+        event_id="202012060kan",
+        output_stream_name=output_kinesis_stream_name
+    )
+
+
+def test_profiler_signal_does_not_take_the_lock_of_the_interrupted_thread(logger, redis_client, kinesis_client, output_kinesis_stream_name):
+    bet_executor = BetExecutor(
+        logger=logger,
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        output_stream_name=output_kinesis_stream_name
+    )
+    profiler = Profiler(logger=logger, records=2)
+    profiler.attach(bet_executor)
+    previous = signal.getsignal(signal.SIGUSR1)
+    try:
+        profiler.install_signals(profile_signal=signal.SIGUSR1, memory_signal=None)
+        # as if the signal came while a record was finishing a window
+        with profiler._lock:
+            os.kill(os.getpid(), signal.SIGUSR1)
+            time.sleep(0.01)
+            assert "handle_record" not in vars(bet_executor)
+        for _ in range(100):
+            if "handle_record" in vars(bet_executor):
+                break
+            time.sleep(0.01)
+        assert "handle_record" in vars(bet_executor)
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+
+
+def test_profiler_reports_allocation_growth_between_snapshots(tmp_path, logger):
+    profiler = Profiler(logger=logger, output_dir=str(tmp_path))
+    profiler.snapshot_memory()
+    try:
+        retained = [bytearray(1024) for _ in range(100)]
+        profiler.snapshot_memory()
+    finally:
+        tracemalloc.stop()
+    assert len(retained) == 100
+    assert [path.name.split("-")[0] for path in tmp_path.iterdir()] == ["tracemalloc"]
+
+
+def test_replay_script_runs_recorded_records_end_to_end(tmp_path, monkeypatch, capsys):
+    pytest.importorskip("fakeredis")
+    with open("test/resources/limit-bet/new-limit-bet-multi-execute-output.json") as f:
+        expected = load(f)
+    records_path = tmp_path / "records.jsonl"
+    with open("test/resources/limit-bet/new-limit-bet-multi-execute.json") as f:
+        records_path.write_text("".join(dumps(data) + "\n" for data in load(f)))
+    statuses_path = tmp_path / "statuses.jsonl"
+    statuses_path.write_text(dumps({"event_id": "202012060kan", "status": "ACTIVE", "home_team_abbrev": "DEN", "away_team_abbrev": "KAN"}) + "\n")
+
+    outputs = {}
+    for engine in ("memory", "lua"):
+        out_path, books_path = tmp_path / f"{engine}.jsonl", tmp_path / f"{engine}-books.jsonl"
+        monkeypatch.setattr("sys.argv", [
+            "replay", str(records_path), "--statuses", str(statuses_path), "--engine", engine,
+            "--out", str(out_path), "--books", str(books_path)
+        ])
+        replay.main()
+        summary = loads(capsys.readouterr().out)
+        assert summary["records"] == len(records_path.read_text().splitlines())
+        assert summary["outputs"] == len(expected["kinesis"])
+        books = {book["team_abbrev"]: book["bets"] for book in map(loads, books_path.read_text().splitlines())}
+        assert sorted(bet["bet_id"] for bet in books["KAN"]) == sorted(bet["bet_id"] for bet in expected["redis"]["KAN"])
+        assert sorted(bet["bet_id"] for bet in books["DEN"]) == sorted(bet["bet_id"] for bet in expected["redis"]["DEN"])
+        outputs[engine] = out_path.read_bytes()
+    assert [loads(line)["bets"][0]["bet_id"] for line in outputs["memory"].splitlines()] == [bets["bets"][0]["bet_id"] for bets in expected["kinesis"]]
+    # the clock is frozen, so engines that agree write the same bytes
+    assert outputs["memory"] == outputs["lua"]
+
+
+def test_engines_agree_on_integer_amounts(tmp_path, monkeypatch, capsys):
+    pytest.importorskip("fakeredis")
+    flow = OrderFlow(seed=1, events=3, records=500)
+    records_path = tmp_path / "records.jsonl"
+    with open(records_path, "w") as f:
+        for record in flow.generate():
+            data = loads(record["Data"])
+            if "amount" in data["value"]:
+                data["value"]["amount"] = max(round(data["value"]["amount"]), 1)
+            f.write(dumps(data) + "\n")
+    statuses_path = tmp_path / "statuses.jsonl"
+    statuses_path.write_text("".join(dumps({"event_id": event_id, **loads(str(status_details))}) + "\n" for event_id, status_details in flow.statuses()))
+
+    outputs = {}
+    for engine in ENGINES:
+        out_path, books_path = tmp_path / f"{engine}.jsonl", tmp_path / f"{engine}-books.jsonl"
+        monkeypatch.setattr("sys.argv", [
+            "replay", str(records_path), "--statuses", str(statuses_path), "--engine", engine,
+            "--out", str(out_path), "--books", str(books_path)
+        ])
+        replay.main()
+        capsys.readouterr()
+        outputs[engine] = (out_path.read_bytes(), books_path.read_bytes())
+    assert any(isinstance(bet["amount"], int) for line in outputs["redis"][0].splitlines() for bet in loads(line)["bets"])
+    assert outputs["lua"] == outputs["redis"]
+    assert outputs["memory"] == outputs["redis"]
+
+
+@pytest.mark.parametrize("engine", ["lua"])
+def test_event_lease_hands_over_and_fences_the_old_owner(engine, logger, redis_client, kinesis_client, output_kinesis_stream_name):
+    records = get_records(path="test/resources/limit-bet/new-limit-bet-multi-execute.json")
+
+    def create_bet_executor(event_leases: EventLeases):
+        return BetExecutor(
+            logger=logger,
+            redis_client=redis_client,
+            kinesis_client=kinesis_client,
+            output_stream_name=output_kinesis_stream_name,
+            engine=engine,
+            event_leases=event_leases
+        )
+
+    old_leases = EventLeases(logger=logger, redis_client=redis_client, owner_id="old", ttl_ms=60000)
+    new_leases = EventLeases(logger=logger, redis_client=redis_client, owner_id="new", ttl_ms=60000)
+    old_bet_executor = create_bet_executor(event_leases=old_leases)
+    new_bet_executor = create_bet_executor(event_leases=new_leases)
+    old_bet_executor.handle_record(record=records[0])
+    assert old_leases.value("202012060kan") == "1:old"
+
+    # the old owner keeps its local copy of the lease, as if it had stalled
+    redis_client.delete(EventLeases.lease_name("202012060kan"))
+    new_bet_executor.handle_record(record=records[1])
+    assert new_leases.value("202012060kan") == "2:new"
+    with pytest.raises(LeaseLostError):
+        old_bet_executor.handle_record(record=records[2])
+
+    new_bet_executor.handle_record(record=records[2])
+    compare_bets_on_exchange(
+        expected_output_path="test/resources/limit-bet/new-limit-bet-multi-execute-output.json",
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        team_abbrevs=["DEN", "KAN"],
+        event_id="202012060kan",
+        output_stream_name=output_kinesis_stream_name
+    )
+
+    new_leases.release_all()
+    assert redis_client.get(EventLeases.lease_name("202012060kan")) is None
+
+
+@pytest.mark.parametrize("engine", ["lua"])
+def test_cancels_and_purges_of_a_fenced_owner_are_refused(engine, logger, redis_client, kinesis_client, output_kinesis_stream_name):
+    limit_record, cancel_record = get_records(path="test/resources/cancel-bet/cancel-bet-basic.json")
+    inactive_record = get_records(path="test/resources/inactive-event/inactive-event.json")[-1]
+    old_leases = EventLeases(logger=logger, redis_client=redis_client, owner_id="old", ttl_ms=60000)
+    new_leases = EventLeases(logger=logger, redis_client=redis_client, owner_id="new", ttl_ms=60000)
+    old_bet_executor = BetExecutor(
+        logger=logger,
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        output_stream_name=output_kinesis_stream_name,
+        engine=engine,
+        event_leases=old_leases
+    )
+    old_bet_executor.handle_record(record=limit_record)
+
+    # the old owner keeps its local copy of the lease, as if it had stalled
+    redis_client.delete(EventLeases.lease_name("202012060kan"))
+    new_leases.hold("202012060kan")
+    for record in (cancel_record, inactive_record):
+        with pytest.raises(LeaseLostError):
+            old_bet_executor.handle_record(record=record)
+    bet = Bet.fromvalue(value=loads(cancel_record["Data"])["value"])
+
+    async def refused_async():
+        old_exchange = AsyncExchange(redis_client=async_redis_client(redis_client), event_leases=old_leases)
+        with pytest.raises(LeaseLostError):
+            await old_exchange.remove_bet(bet=bet)
+        with pytest.raises(LeaseLostError):
+            await old_exchange.purge_bets(event_id="202012060kan", home_team_abbrev="DEN", away_team_abbrev="KAN")
+
+    asyncio.run(refused_async())
+    assert redis_client.zcard("pq:202012060kan:KAN") == 1
+
+    new_exchange = Exchange(redis_client=redis_client, event_leases=new_leases)
+    assert new_exchange.remove_bet(bet=bet).bet_id == 1
+    assert redis_client.zcard("pq:202012060kan:KAN") == 0
+
+
+@pytest.mark.parametrize("engine", ["lua"])
+def test_event_lease_held_by_the_other_owner_is_not_waited_for(engine, logger, redis_client):
+    leases = EventLeases(logger=logger, redis_client=redis_client, owner_id="a", ttl_ms=50)
+    other_leases = EventLeases(logger=logger, redis_client=redis_client, owner_id="b", ttl_ms=50)
+    assert leases.hold("202012060kan")
+    assert not leases.hold("202012060kan")
+    with pytest.raises(LeaseHeldError) as e:
+        other_leases.hold("202012060kan")
+    assert 1 <= e.value.retry_in_ms <= 12.5
+
+    time.sleep(0.06)
+    assert other_leases.hold("202012060kan")
+    assert other_leases.value("202012060kan") == "2:b"
+
+
+@pytest.mark.parametrize("engine", ["lua"])
+@pytest.mark.parametrize("batched", [False, True])
+def test_records_of_an_event_leased_elsewhere_are_parked_in_order(batched, engine, logger, redis_client, kinesis_client, output_kinesis_stream_name):
+    records = [
+        dict(record, SequenceNumber=str(seq))
+        for seq, record in enumerate(get_records(path="test/resources/limit-bet/new-limit-bet-multi-execute.json"), start=1)
+    ]
+    other_data = loads(records[0]["Data"])
+    other_data["value"]["event_id"] = "202012130buf"
+    other_record = {"SequenceNumber": "other", "Data": dumps(other_data).encode("utf-8")}
+    other_leases = EventLeases(logger=logger, redis_client=redis_client, owner_id="other", ttl_ms=100)
+    other_leases.hold("202012060kan")
+    bet_executor = BetExecutor(
+        logger=logger,
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        output_stream_name=output_kinesis_stream_name,
+        engine=engine,
+        event_leases=EventLeases(logger=logger, redis_client=redis_client, owner_id="own", ttl_ms=100)
+    )
+    parked_tickets = ParkedTickets(bet_executor=bet_executor)
+    tickets = [RecordTicket(sequence_number=record["SequenceNumber"]) for record in records]
+
+    started = time.monotonic()
+    if batched:
+        bet_executor.handle_records(records=records + [other_record])
+    else:
+        for record in records + [other_record]:
+            bet_executor.handle_record(record=record)
+    for ticket in tickets:
+        parked_tickets.handled(ticket=ticket)
+    # nothing waited for the lease and the record of the other event went through
+    assert time.monotonic() - started < 0.1
+    assert all(bet_executor.is_parked(record["SequenceNumber"]) for record in records)
+    assert not bet_executor.is_parked("other")
+    assert len(parked_tickets) == len(records) and not any(ticket.done for ticket in tickets)
+    assert [loads(data)["event_id"] for data in kinesis_client.streams[output_kinesis_stream_name]] == ["202012130buf"]
+    kinesis_client.streams.clear()
+
+    time.sleep(0.11)
+    bet_executor.retry_parked()
+    parked_tickets.handled()
+    assert not bet_executor.has_parked
+    assert all(ticket.done for ticket in tickets)
+    compare_bets_on_exchange(
+        expected_output_path="test/resources/limit-bet/new-limit-bet-multi-execute-output.json",
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        team_abbrevs=["DEN", "KAN"],
+        event_id="202012060kan",
+        output_stream_name=output_kinesis_stream_name
+    )
+
+
+@pytest.mark.parametrize("engine", ["lua"])
+def test_a_parked_record_is_retried_while_the_stream_is_idle(engine, monkeypatch, logger, redis_client, kinesis_client, output_kinesis_stream_name):
+    record = dict(get_records(path="test/resources/limit-bet/new-limit-bet-multi-execute.json")[0], SequenceNumber="1")
+    stream_closed = threading.Event()
+    checkpoints = []
+
+    class Consumer:
+        def __init__(self, stream_name: str, state):
+            self._state = state
+
+        def __iter__(self):
+            yield record
+            self._state.checkpoint("shard-0", record["SequenceNumber"])
+            # no record comes after the parked one until the test is done
+            stream_closed.wait(timeout=5)
+
+    class State:
+        def checkpoint(self, shard_id: str, seq: str):
+            checkpoints.append((shard_id, seq))
+
+    monkeypatch.setattr(core_module, "KinesisConsumer", Consumer)
+    EventLeases(logger=logger, redis_client=redis_client, owner_id="other", ttl_ms=100).hold("202012060kan")
+    core = core_module.Core()
+    core._logger = logger
+    core._stream_name = "input"
+    core._bet_executor = BetExecutor(
+        logger=logger,
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        output_stream_name=output_kinesis_stream_name,
+        engine=engine,
+        event_leases=EventLeases(logger=logger, redis_client=redis_client, owner_id="own", ttl_ms=100)
+    )
+    run = threading.Thread(target=core._run_leased, kwargs=dict(state=State()))
+    run.start()
+    try:
+        deadline = time.monotonic() + 2
+        while redis_client.zcard("pq:202012060kan:KAN") == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert redis_client.zcard("pq:202012060kan:KAN") == 1
+        assert not core._bet_executor.has_parked
+    finally:
+        stream_closed.set()
+        run.join(timeout=5)
+    assert checkpoints == [("shard-0", "1")]
+
+
+@pytest.fixture
+def hash_tagged_keys():
+    keys.set_layout(keys.HASH_TAGGED)
+    yield
+    keys.set_layout(keys.LEGACY)
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_hash_tagged_keys_of_an_event_share_a_slot(engine, hash_tagged_keys, logger, redis_client, kinesis_client, output_kinesis_stream_name):
+    redis_client.set(name=Exchange.status_name("202012060kan"), value=str(StatusDetails(status="ACTIVE", home_team_abbrev="DEN", away_team_abbrev="KAN")))
+    bet_executor = BetExecutor(
+        logger=logger,
+        redis_client=redis_client,
+        kinesis_client=kinesis_client,
+        output_stream_name=output_kinesis_stream_name,
+        engine=engine,
+        replay_guard_ttl_seconds=3600
+    )
+    for record in get_records(path="test/resources/limit-bet/new-limit-bet-basic-execute.json"):
+        bet_executor.handle_record(record=record)
+
+    names = [name.decode("utf-8") if isinstance(name, bytes) else name for name in (redis_client.keys() if engine == "lua" else redis_client.kv_store)]
+    event_names = [name for name in names if name != "event:202012060kan"]
+    assert {name.split(":")[0] for name in event_names} >= {"pq", "idx", "lvl", "handled", "event"}
+    assert {key_slot(name.encode("utf-8")) for name in event_names} == {key_slot(b"{202012060kan}")}
+    assert {keys.parse_event_key(name)[1] for name in event_names} == {"202012060kan"}
+    assert keys.parse_event_key("pq:{202012060kan}:KAN") == keys.parse_event_key("pq:202012060kan:KAN") == ("pq", "202012060kan", "KAN")
+
+
+@pytest.mark.parametrize("engine", ["redis", "memory"])
+def test_vectorized_sweeps_match_the_scalar_sweeps(engine, monkeypatch, logger):
+    pytest.importorskip("numpy")
+    resting_bets = [
+        Bet(event_id="202012060kan", sport="football", bet_id=i, brokerage_id=1, user_id=1, amount=round(1 + (i * 7.31) % 40, 2), odds=-100 - 5 * (i % 60), on_team_abbrev="DEN")
+        for i in range(300)
+    ]
+    records = [
+        {"action": "NEW_MARKET_BET", "value": {"event_id": "202012060kan", "sport": "football", "bet_id": 1000, "brokerage_id": 1, "user_id": 1, "amount": 2000, "order_type": "market", "on_team_abbrev": "KAN"}},
+        {"action": "NEW_LIMIT_BET", "value": {"event_id": "202012060kan", "sport": "football", "bet_id": 1001, "brokerage_id": 1, "user_id": 1, "amount": 5000.0, "odds": 215, "order_type": "limit", "on_team_abbrev": "KAN"}}
+    ]
+
+    def sweep():
+        redis_client = MockRedis()
+        redis_client.set(name="event:202012060kan", value=str(StatusDetails(status="ACTIVE", home_team_abbrev="DEN", away_team_abbrev="KAN")))
+        kinesis_client = MockKinesis()
+        bet_executor = BetExecutor(logger=logger, redis_client=redis_client, kinesis_client=kinesis_client, output_stream_name="out", engine=engine)
+        bet_executor._exchange.submit_bets(bets=[bet.copy() for bet in resting_bets])
+        for record in records:
+            bet_executor.handle_record(record={"Data": dumps(record).encode("utf-8")})
+        books = [redis_client.zrange(name=f"pq:202012060kan:{team_abbrev}", start=0, end=-1, withscores=True) for team_abbrev in ("DEN", "KAN")]
+        return kinesis_client.streams["out"], books
+
+    now = datetime.utcnow()
+    monkeypatch.setattr(utils, "_now", lambda: now)
+    monkeypatch.setattr(sweep_planner, "MIN_VECTORIZED_BETS", 1)
+    vectorized_outputs, vectorized_books = sweep()
+    monkeypatch.setattr(sweep_planner, "np", None)
+    scalar_outputs, scalar_books = sweep()
+
+    assert len(scalar_outputs) > 100
+    assert vectorized_outputs == scalar_outputs
+    assert vectorized_books == scalar_books